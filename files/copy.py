@@ -19,7 +19,21 @@
 # along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import stat
+import shutil
 import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import hashlib
+    HAS_HASHLIB = True
+except ImportError:
+    HAS_HASHLIB = False
 
 DOCUMENTATION = '''
 ---
@@ -80,7 +94,12 @@ options:
   remote_src:
     description:
       - If False, it will search for src at originating/master machine, if True it will go to the remote/target machine for the src. Default is False.
-      - Currently remote_src does not support recursive copying.
+      - With remote_src, a directory src is copied recursively into dest, following the same trailing "/" rule as
+        for local sources. Files whose size and modification time match are left alone and files of the same size
+        are only checksummed when their times differ. Changed files are copied by a pool of threads, using reflinks
+        where the filesystem supports them, else copy_file_range or sendfile on pythons that have them, and are
+        listed in C(changed_files). With C(force=no) files and links that already exist in dest are left alone.
+        Special files such as fifos, sockets and devices are not copied, they are listed in C(skipped_files).
     choices: [ "True", "False" ]
     required: false
     default: "no"
@@ -118,6 +137,9 @@ EXAMPLES = '''
 
 # Copy a new "sudoers" file into place, after passing validation with visudo
 - copy: src=/mine/sudoers dest=/etc/sudoers validate='visudo -cf %s'
+
+# Stage a build tree that is already on the target, only copying what changed
+- copy: src=/srv/build/output/ dest=/opt/app remote_src=yes
 '''
 
 RETURN = '''
@@ -181,6 +203,21 @@ state:
     returned: success
     type: string
     sample: "file"
+hashed_bytes:
+    description: number of bytes read to compute checksums of src and dest
+    returned: success, when src is a file
+    type: int
+    sample: 2048
+changed_files:
+    description: files and links created or updated by a recursive remote_src copy, with how their data was copied
+    returned: success, when src is a directory and remote_src is used
+    type: list
+    sample: [ { "dest": "/opt/app/bin/app", "action": "updated", "method": "reflink" } ]
+skipped_files:
+    description: special files, such as fifos, sockets and devices, found in a recursive remote_src copy and not copied
+    returned: success, when src is a directory and remote_src is used
+    type: list
+    sample: [ "/srv/build/output/run/app.sock" ]
 '''
 
 def split_pre_existing_dir(dirname):
@@ -210,6 +247,281 @@ def adjust_recursive_directory_permissions(pre_existing_dir, new_directory_list,
     return changed
 
 
+# Number of threads copying files in a recursive remote_src copy
+COPY_WORKERS = 4
+# ioctl sharing the extents of a file with another on filesystems such as btrfs and xfs
+FICLONE = 0x40049409
+COPY_BUFSIZE = 1024 * 1024
+
+
+def kernel_copies(in_fd, out_fd):
+    '''
+    The in-kernel copies this python offers, as (name, call(count, offset)) pairs returning
+    the bytes copied. os.copy_file_range (python 3.8) and os.sendfile (python 3.3) are not
+    available on python 2, where copies fall back to read/write after trying a reflink.
+    '''
+
+    copies = []
+    if hasattr(os, 'copy_file_range'):
+        copies.append(('copy_file_range', lambda count, offset: os.copy_file_range(in_fd, out_fd, count, offset, offset)))
+    if hasattr(os, 'sendfile'):
+        # writes at the position of out_fd, which starts at 0 and advances with every call
+        copies.append(('sendfile', lambda count, offset: os.sendfile(out_fd, in_fd, offset, count)))
+    return copies
+
+
+def copy_data(src, dest):
+    '''
+    Copy the content of src to dest, as a reflink where the filesystem can share the data,
+    else with copy_file_range or sendfile where python offers them, else with read/write.
+    Return the mechanism that was used.
+    '''
+
+    fsrc = open(src, 'rb')
+    try:
+        fdst = open(dest, 'wb')
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                    return 'reflink'
+                except (IOError, OSError):
+                    pass
+
+            for method, call in kernel_copies(fsrc.fileno(), fdst.fileno()):
+                copied = 0
+                try:
+                    while True:
+                        n = call(COPY_BUFSIZE * 8, copied)
+                        if not n:
+                            return method
+                        copied += n
+                except OSError:
+                    # not supported between these files, start over the next way
+                    os.lseek(fdst.fileno(), 0, 0)
+                    os.ftruncate(fdst.fileno(), 0)
+
+            shutil.copyfileobj(fsrc, fdst, COPY_BUFSIZE)
+            return 'read/write'
+        finally:
+            fdst.close()
+    finally:
+        fsrc.close()
+
+
+def file_digests(module, path, algorithms):
+    '''
+    Read path once, feeding every block to each of the algorithms. Digests the host
+    cannot compute (md5 in FIPS mode) are None. Return the digests and the bytes read.
+    '''
+
+    if not HAS_HASHLIB:
+        digests = {}
+        for algorithm in algorithms:
+            try:
+                digests[algorithm] = module.digest_from_file(path, algorithm)
+            except ValueError:
+                digests[algorithm] = None
+        return digests, os.path.getsize(path) * len(algorithms)
+
+    hashes = {}
+    for algorithm in algorithms:
+        try:
+            hashes[algorithm] = hashlib.new(algorithm)
+        except ValueError:
+            pass
+
+    read = 0
+    f = open(path, 'rb')
+    try:
+        block = f.read(COPY_BUFSIZE)
+        while block:
+            read += len(block)
+            for h in hashes.values():
+                h.update(block)
+            block = f.read(COPY_BUFSIZE)
+    finally:
+        f.close()
+
+    digests = {}
+    for algorithm in algorithms:
+        digests[algorithm] = None
+        if algorithm in hashes:
+            digests[algorithm] = hashes[algorithm].hexdigest()
+    return digests, read
+
+
+def sync_file(module, src, dest, backup):
+    '''
+    Copy src over dest unless they already match. Sizes and modification times are
+    compared first, the files are only checksummed when those do not settle it.
+    Return None if dest was left alone, else a dict describing the change.
+    '''
+
+    src_st = os.stat(src)
+    try:
+        dest_st = os.lstat(dest)
+    except OSError:
+        dest_st = None
+
+    if dest_st is None:
+        action = 'created'
+    elif stat.S_ISDIR(dest_st.st_mode):
+        raise IOError("%s is a directory, cannot replace it with a file" % dest)
+    else:
+        action = 'updated'
+        if stat.S_ISREG(dest_st.st_mode) and src_st.st_size == dest_st.st_size:
+            if int(src_st.st_mtime) == int(dest_st.st_mtime):
+                return None
+            if module.sha1(src) == module.sha1(dest):
+                # same content, align the times so the next run does not checksum it again
+                if not module.check_mode:
+                    os.utime(dest, (dest_st.st_atime, src_st.st_mtime))
+                return None
+
+    result = dict(dest=dest, action=action, method=None)
+    if module.check_mode:
+        return result
+
+    if backup and dest_st is not None:
+        result['backup_file'] = module.backup_local(dest)
+
+    fd, tmpdest = tempfile.mkstemp(prefix='.ansible_copy', dir=os.path.dirname(dest))
+    os.close(fd)
+    try:
+        result['method'] = copy_data(src, tmpdest)
+        shutil.copystat(src, tmpdest)
+        os.rename(tmpdest, dest)
+    except (IOError, OSError):
+        os.unlink(tmpdest)
+        raise
+    return result
+
+
+def sync_files(module, pairs, backup, workers=COPY_WORKERS):
+    '''
+    Run sync_file() over the (src, dest) pairs on a pool of threads, return the changes
+    and the first error met, if any.
+    '''
+
+    pending = list(pairs)
+    changes = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            lock.acquire()
+            try:
+                if not pending or errors:
+                    return
+                src, dest = pending.pop()
+            finally:
+                lock.release()
+            try:
+                result = sync_file(module, src, dest, backup)
+            except (IOError, OSError):
+                e = get_exception()
+                errors.append("failed to copy %s to %s: %s" % (src, dest, str(e)))
+                continue
+            if result is not None:
+                changes.append(result)
+
+    threads = [threading.Thread(target=worker) for i in range(min(workers, len(pending)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    changes.sort(key=lambda c: c['dest'])
+    return changes, errors
+
+
+def copy_tree(module, src, dest):
+    '''
+    Recursively copy the src directory on the target into dest, like a local src directory
+    is copied by the action plugin: the directory itself, or only its content if src ends with "/".
+    Without force, files and links already in dest are left as they are.
+    '''
+
+    force = module.params['force']
+
+    if not src.endswith(os.sep):
+        dest = os.path.join(dest, os.path.basename(src))
+    src = src.rstrip(os.sep) or os.sep
+
+    directory_args = module.load_file_common_arguments(module.params)
+    directory_args['mode'] = None
+    file_args = module.load_file_common_arguments(module.params)
+
+    changes = []
+    directories = []
+    pairs = []
+    links = []
+    skipped = []
+    for root, dirs, files in os.walk(src):
+        target = os.path.normpath(os.path.join(dest, root[len(src):].lstrip(os.sep)))
+        if not os.path.isdir(target):
+            if os.path.lexists(target):
+                module.fail_json(msg="Destination %s exists and is not a directory" % target)
+            changes.append(dict(dest=target, action='created', method=None))
+            if not module.check_mode:
+                os.makedirs(target)
+            directories.append((target, True))
+        else:
+            directories.append((target, False))
+
+        # os.walk lists symlinks to directories with the directories, but does not descend into them
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            if not force and os.path.lexists(os.path.join(target, name)):
+                continue
+            if os.path.islink(path):
+                links.append((path, os.path.join(target, name)))
+            elif name not in files:
+                continue
+            elif os.path.isfile(path):
+                pairs.append((path, os.path.join(target, name)))
+            else:
+                # fifos, sockets and devices would block or be read as data, like
+                # shutil.copytree leave them out, but say so
+                skipped.append(path)
+
+    file_changes, errors = sync_files(module, pairs, module.params['backup'])
+    if errors:
+        module.fail_json(msg=errors[0], src=src, dest=dest, changed_files=changes + file_changes)
+    changes.extend(file_changes)
+
+    for path, target in links:
+        linkto = os.readlink(path)
+        if os.path.islink(target) and os.readlink(target) == linkto:
+            continue
+        if os.path.isdir(target) and not os.path.islink(target):
+            module.fail_json(msg="%s is a directory, cannot replace it with a link" % target)
+        changes.append(dict(dest=target, action=os.path.lexists(target) and 'updated' or 'created', method='symlink'))
+        if not module.check_mode:
+            if os.path.lexists(target):
+                os.unlink(target)
+            os.symlink(linkto, target)
+
+    changed = len(changes) > 0
+    directory_mode = module.params["directory_mode"]
+    for target, created in directories:
+        if created and module.check_mode:
+            continue
+        directory_args['path'] = target
+        directory_args['mode'] = None
+        if created:
+            directory_args['mode'] = directory_mode
+        changed = module.set_fs_attributes_if_different(directory_args, changed)
+    for path, target in pairs:
+        file_args['path'] = target
+        if not module.check_mode or os.path.exists(target):
+            changed = module.set_fs_attributes_if_different(file_args, changed)
+
+    module.exit_json(src=src, dest=dest, changed=changed, changed_files=changes, skipped_files=sorted(skipped))
+
+
 def main():
 
     module = AnsibleModule(
@@ -244,15 +556,15 @@ def main():
     if not os.access(src, os.R_OK):
         module.fail_json(msg="Source %s not readable" % (src))
     if os.path.isdir(src):
-        module.fail_json(msg="Remote copy does not support recursive copy of directory: %s" % (src))
+        if not remote_src:
+            module.fail_json(msg="Remote copy does not support recursive copy of directory: %s" % (src))
+        if validate:
+            module.fail_json(msg="validate cannot be used when copying a directory: %s" % (src))
+        copy_tree(module, src, dest)
 
-    checksum_src = module.sha1(src)
     checksum_dest = None
-    # Backwards compat only.  This will be None in FIPS mode
-    try:
-        md5sum_src = module.md5(src)
-    except ValueError:
-        md5sum_src = None
+    # Only a dest of the same size as src needs to be checksummed
+    dest_same_size = False
 
     changed = False
 
@@ -281,8 +593,9 @@ def main():
             if original_basename:
                 basename = original_basename
             dest = os.path.join(dest, basename)
-        if os.access(dest, os.R_OK):
-            checksum_dest = module.sha1(dest)
+        if os.path.isfile(dest) and os.access(dest, os.R_OK) and \
+                os.path.getsize(dest) == os.path.getsize(src):
+            dest_same_size = True
     else:
         if not os.path.exists(os.path.dirname(dest)):
             try:
@@ -298,6 +611,16 @@ def main():
     if not os.access(os.path.dirname(dest), os.W_OK):
         module.fail_json(msg="Destination %s not writable" % (os.path.dirname(dest)))
 
+    # One pass over src for all its checksums, md5 is for backwards compat only
+    # and will be None in FIPS mode
+    digests, hashed_bytes = file_digests(module, src, ['sha1', 'md5'])
+    checksum_src = digests['sha1']
+    md5sum_src = digests['md5']
+    if dest_same_size:
+        digests, read = file_digests(module, dest, ['sha1'])
+        checksum_dest = digests['sha1']
+        hashed_bytes += read
+
     backup_file = None
     if checksum_src != checksum_dest or os.path.islink(dest):
         try:
@@ -332,7 +655,8 @@ def main():
         changed = False
 
     res_args = dict(
-        dest = dest, src = src, md5sum = md5sum_src, checksum = checksum_src, changed = changed
+        dest = dest, src = src, md5sum = md5sum_src, checksum = checksum_src, changed = changed,
+        hashed_bytes = hashed_bytes
     )
     if backup_file:
         res_args['backup_file'] = backup_file
@@ -345,4 +669,5 @@ def main():
 
 # import module snippets
 from ansible.module_utils.basic import *
-main()
+if __name__ == '__main__':
+    main()
@@ -21,10 +21,33 @@
 
 
 import os
+import errno
 import stat
 import fnmatch
 import time
 import re
+import mmap
+import tempfile
+import threading
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+try:
+    import hashlib
+    HAS_HASHLIB = True
+except ImportError:
+    HAS_HASHLIB = False
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 DOCUMENTATION = '''
 ---
@@ -57,6 +80,23 @@ options:
         default: null
         description:
             - One or more re patterns which should be matched against the file content
+            - The pattern is matched at the start of each line, against that line only. Regular files
+              are memory mapped and searched in one pass.
+    contains_mode:
+        required: false
+        default: "first"
+        choices: [ "first", "count" ]
+        version_added: "2.1"
+        description:
+            - With C(first) a file is selected as soon as one line matches C(contains).
+            - With C(count) every matching line is counted and returned as C(contains_count).
+    max_read_bytes:
+        required: false
+        default: null
+        version_added: "2.1"
+        description:
+            - Only search the first N bytes of each file for C(contains). Unqualified values are in bytes,
+              but b, k, m, g, and t can be appended as for C(size).
     paths:
         required: true
         aliases: [ "name", "path" ]
@@ -107,12 +147,60 @@ options:
         choices: [ True, False ]
         description:
             - Set this to true to retrieve a file's sha1 checksum
+            - Checksums are computed after the search, on C(threads) worker threads.
+    checksum_algorithm:
+        required: false
+        default: "sha1"
+        aliases: [ "checksum_algo" ]
+        version_added: "2.1"
+        description:
+            - One or more algorithms used for C(get_checksum), such as sha1 or sha256.
+              The first is returned as C(checksum). When several are given all of them are
+              returned in C(checksums), computed from a single read of each file.
+            - Without hashlib, as on python 2.4, only sha1 is available.
     use_regex:
         required: false
         default: "False"
         choices: [ True, False ]
         description:
             - If false the patterns are file globs (shell) if true they are python regexes
+    excludes:
+        required: false
+        default: null
+        version_added: "2.1"
+        description:
+            - One or more (shell or regex) patterns, which type is controled by C(use_regex) option.
+            - Files whose basenames match any of these patterns are not returned, and directories whose
+              basenames match are not descended into, so whole subtrees can be pruned from the search.
+    index:
+        required: false
+        default: null
+        version_added: "2.1"
+        description:
+            - Path of an on-host index file caching directory listings, the file type of their entries and the
+              stat data of the entries that matched the name and type criteria.
+              When set, directories whose mtime and ctime have not changed since they were indexed are not
+              listed again and their entries are not stat()ed again, so repeated C(age) and C(size) queries over a
+              mostly static tree cost about one stat per directory.
+            - Changing a file in place does not change its directory, so such changes are not seen until an
+              entry is added to, removed from or renamed in that directory. Only use this for trees where files
+              are written once, such as logs rotated into place or build artifacts.
+            - The index is not updated in check mode.
+    index_max_size:
+        required: false
+        default: "32m"
+        version_added: "2.1"
+        description:
+            - Upper bound on the size of the C(index) file. The least recently used directories are dropped from
+              the index to stay below it. Accepts the same unit suffixes as C(size).
+    threads:
+        required: false
+        default: 1
+        version_added: "2.1"
+        description:
+            - Number of worker threads used to scan directories when C(recurse) is set.
+              Subdirectories are handed out to the workers as they are found, which helps on
+              large trees and on network or otherwise high latency filesystems.
 '''
 
 
@@ -131,6 +219,18 @@ EXAMPLES = '''
 
 # find /var/log files equal or greater than 10 megabytes ending with .old or .log.gz via regex
 - find: paths="/var/tmp" patterns="^.*?\.(?:old|log\.gz)$" size="10m" use_regex=True
+
+# find logs that mention a failed job within their first 16 megabytes, counting the failures
+- find: paths="/var/log/jobs" patterns="*.log" contains="FAILED" contains_mode=count max_read_bytes=16m
+
+# sha256 and sha1 checksums of release tarballs, hashed on 4 threads
+- find: paths="/srv/releases" patterns="*.tar.gz" get_checksum=yes checksum_algorithm="sha256,sha1" threads=4
+
+# cleanup cron job over a large static tree, remembering directory listings between runs
+- find: paths="/srv/archive" age="30d" recurse=yes index="/var/cache/find/archive.idx"
+
+# Recursively find *.log files in /srv, skipping .git and cache directories, using 8 threads
+- find: paths="/srv" patterns="*.log" excludes=".git,cache" recurse=yes threads=8
 '''
 
 RETURN = '''
@@ -158,24 +258,43 @@ examined:
     returned: success
     type: string
     sample: 34
+indexed:
+    description: number of directories whose entries were taken from the index instead of the filesystem
+    returned: success
+    type: int
+    sample: 1200
+elapsed:
+    description: seconds spent in each phase of the search; phases run by several threads are summed across them
+    returned: success
+    type: dictionary
+    sample: { "scan": 0.52, "stat": 0.11, "content": 1.3, "checksum": 4.2, "total": 3.1 }
+checksum_stats:
+    description: amount of data read for checksums and the resulting throughput in bytes per second
+    returned: success, when get_checksum is true
+    type: dictionary
+    sample: { "files": 12, "bytes": 1073741824, "bytes_per_sec": 268435456.0 }
 '''
 
-def pfilter(f, patterns=None, use_regex=False):
-    '''filter using glob patterns'''
+def compile_patterns(patterns, use_regex=False):
+    '''compile glob or regex patterns once so they can be reused for every file'''
 
     if patterns is None:
-        return True
+        return None
 
     if use_regex:
-        for p in patterns:
-            r =  re.compile(p)
-            if r.match(f):
-                return True
-    else:
+        return [re.compile(p) for p in patterns]
+    return [re.compile(fnmatch.translate(p)) for p in patterns]
 
-        for p in patterns:
-            if fnmatch.fnmatch(f, p):
-                return True
+
+def pfilter(f, patterns=None):
+    '''filter using compiled patterns'''
+
+    if patterns is None:
+        return True
+
+    for r in patterns:
+        if r.match(f):
+            return True
 
     return False
 
@@ -200,23 +319,95 @@ def sizefilter(st, size):
 
     return False
 
-def contentfilter(fsname, pattern):
-    '''filter files which contain the given expression'''
-    if pattern is None: return True
+def parse_size(value):
+    '''convert a size such as 10m to bytes, None if it cannot be parsed'''
+    m = re.match("^(-?\d+)(b|k|m|g|t)?$", str(value).lower())
+    bytes_per_unit = {"b": 1, "k": 1024, "m": 1024**2, "g": 1024**3, "t": 1024**4}
+    if not m:
+        return None
+    return int(m.group(1)) * bytes_per_unit.get(m.group(2), 1)
 
-    try:
-       f = open(fsname)
-       prog = re.compile(pattern)
-       for line in f:
-           if prog.match (line):
-               f.close()
-               return True
 
-       f.close() 
-    except:
-       pass
+class ContentSearch(object):
+    '''search file contents with a single compiled regex over a memory map'''
+
+    def __init__(self, pattern, mode='first', max_read_bytes=None):
+        try:
+            pattern = pattern.encode('utf-8')
+        except (AttributeError, UnicodeError):
+            # already a byte string
+            pass
+        # match at the start of any line, like re.match() against each line
+        self.prog = re.compile('^(?:'.encode('ascii') + pattern + ')'.encode('ascii'), re.MULTILINE)
+        self.newline = '\n'.encode('ascii')
+        self.mode = mode
+        self.max_read_bytes = max_read_bytes
+
+    def budget(self, size):
+        if self.max_read_bytes is None:
+            return size
+        return min(size, self.max_read_bytes)
+
+    def count(self, data, endpos):
+        matches = 0
+        pos = 0
+        while pos <= endpos:
+            m = self.prog.search(data, pos, endpos)
+            if not m:
+                break
+            start = m.start()
+            line_end = data.find(self.newline, start, endpos)
+            if line_end == -1:
+                line_end = endpos
+            else:
+                line_end += 1
+            if m.end() > line_end:
+                # the match runs into the next lines, only what the line it
+                # starts on matches by itself counts, as with re.match() per line
+                m = self.prog.match(data, start, line_end)
+            if m:
+                matches += 1
+                if self.mode == 'first':
+                    break
+            # each line counts once, and the search always advances
+            pos = max(line_end, start + 1)
+        return matches
+
+    def search(self, fsname, st):
+        '''return the number of matching lines (at most 1 in first mode), raise on I/O errors'''
+        length = self.budget(st.st_size)
+        f = open(fsname, 'rb')
+        try:
+            if length > 0 and stat.S_ISREG(st.st_mode):
+                try:
+                    data = mmap.mmap(f.fileno(), length, access=mmap.ACCESS_READ)
+                except (mmap.error, ValueError, OverflowError):
+                    data = None
+                if data is not None:
+                    try:
+                        return self.count(data, length)
+                    finally:
+                        data.close()
+            return self.search_lines(f)
+        finally:
+            f.close()
+
+    def search_lines(self, f):
+        '''fallback for files that cannot be mapped, such as pseudo files reporting a zero size'''
+        matches = 0
+        remaining = self.max_read_bytes
+        for line in f:
+            if remaining is not None:
+                if remaining <= 0:
+                    break
+                line = line[:remaining]
+                remaining -= len(line)
+            if self.prog.match(line):
+                matches += 1
+                if self.mode == 'first':
+                    break
+        return matches
 
-    return False
 
 def statinfo(st):
     return {
@@ -251,12 +442,520 @@ def statinfo(st):
     }
 
 
+class DirEntry(object):
+    '''minimal stand in for os.DirEntry on pythons without scandir'''
+
+    def __init__(self, root, name):
+        self.name = name
+        self.path = os.path.join(root, name)
+        self._lstat = None
+        self._stat = None
+
+    def stat(self, follow_symlinks=True):
+        if self._lstat is None:
+            self._lstat = os.lstat(self.path)
+        if not follow_symlinks:
+            return self._lstat
+        if self._stat is None:
+            if stat.S_ISLNK(self._lstat.st_mode):
+                self._stat = os.stat(self.path)
+            else:
+                self._stat = self._lstat
+        return self._stat
+
+    def is_symlink(self):
+        try:
+            return stat.S_ISLNK(self.stat(follow_symlinks=False).st_mode)
+        except OSError:
+            return False
+
+    def is_dir(self, follow_symlinks=True):
+        try:
+            return stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def is_file(self, follow_symlinks=True):
+        try:
+            return stat.S_ISREG(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+
+def listdir(path):
+    '''list a directory, using the file type info returned by readdir when available'''
+    if scandir is not None:
+        return list(scandir(path))
+    return [DirEntry(path, name) for name in os.listdir(path)]
+
+
+class CachedStat(object):
+    '''the subset of a stat result kept in the directory index'''
+
+    fields = ('st_mode', 'st_ino', 'st_dev', 'st_nlink', 'st_uid', 'st_gid',
+              'st_size', 'st_atime', 'st_mtime', 'st_ctime')
+
+    def __init__(self, values):
+        for name, value in zip(self.fields, values):
+            setattr(self, name, value)
+
+    @staticmethod
+    def dump(st):
+        return [getattr(st, name) for name in CachedStat.fields]
+
+
+class IndexingEntry(object):
+    '''wraps a freshly listed entry to remember the stat done while scanning it'''
+
+    def __init__(self, entry):
+        self.entry = entry
+        self.name = entry.name
+        self.path = entry.path
+        self.st = None
+
+    def stat(self, follow_symlinks=True):
+        st = self.entry.stat(follow_symlinks=follow_symlinks)
+        if follow_symlinks:
+            self.st = st
+        return st
+
+    def is_symlink(self):
+        return self.entry.is_symlink()
+
+    def is_dir(self, follow_symlinks=True):
+        return self.entry.is_dir(follow_symlinks=follow_symlinks)
+
+    def is_file(self, follow_symlinks=True):
+        return self.entry.is_file(follow_symlinks=follow_symlinks)
+
+
+class IndexedEntry(object):
+    '''directory entry rebuilt from the index, same interface as DirEntry
+
+    Entries that were not stat()ed when they were indexed are stat()ed on
+    first use, and the result is kept in the index for the next runs.
+    '''
+
+    def __init__(self, root, row):
+        self.name = row[0]
+        self.path = os.path.join(root, self.name)
+        self.row = row
+        self._stat = None
+        if row[4] is not None:
+            self._stat = CachedStat(row[4])
+
+    def stat(self, follow_symlinks=True):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+            self.row[4] = CachedStat.dump(self._stat)
+        return self._stat
+
+    def is_symlink(self):
+        return self.row[1]
+
+    def is_dir(self, follow_symlinks=True):
+        return self.row[2]
+
+    def is_file(self, follow_symlinks=True):
+        return self.row[3]
+
+
+class DirIndex(object):
+    '''on-host cache of directory listings, keyed on the directory path
+
+    A listing is reused while the mtime and ctime of its directory are unchanged.
+    It keeps the file type of every entry, as given by readdir, and the stat data
+    of the entries that had to be stat()ed.
+    The least recently used directories are dropped to keep the file under max_size.
+    '''
+
+    version = 2
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.dirs = {}
+        self.hits = 0
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            f = open(self.path)
+            try:
+                data = json.load(f)
+            finally:
+                f.close()
+            if data['version'] == self.version:
+                self.dirs = data['dirs']
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            # missing, unreadable or from another version, start over
+            self.dirs = {}
+
+    def lookup(self, root, dirst, now):
+        '''return the cached entries of root or None if its listing has changed'''
+        cached = self.dirs.get(root)
+        if cached is None or cached[0] != dirst.st_mtime or cached[1] != dirst.st_ctime:
+            return None
+        cached[2] = now
+        self.lock.acquire()
+        try:
+            self.hits += 1
+        finally:
+            self.lock.release()
+
+        return [IndexedEntry(root, row) for row in cached[3]]
+
+    def store(self, root, dirst, entries, now):
+        '''index the IndexingEntry list of root once it has been scanned'''
+        # a directory changed within the timestamp granularity could change again unnoticed
+        if now - max(dirst.st_mtime, dirst.st_ctime) < 2:
+            return
+
+        listing = []
+        for entry in entries:
+            values = None
+            if entry.st is not None:
+                values = CachedStat.dump(entry.st)
+            listing.append([entry.name, entry.is_symlink(), entry.is_dir(), entry.is_file(), values])
+
+        self.lock.acquire()
+        try:
+            self.dirs[root] = [dirst.st_mtime, dirst.st_ctime, now, listing]
+        finally:
+            self.lock.release()
+
+    def evict(self, data):
+        '''drop the least recently used directories until data would fit in max_size'''
+        excess = len(data) - self.max_size
+        by_use = sorted(self.dirs.keys(), key=lambda root: self.dirs[root][2])
+        for root in by_use:
+            if excess <= 0:
+                break
+            excess -= len(json.dumps({root: self.dirs[root]}))
+            del self.dirs[root]
+
+    def save(self):
+        data = json.dumps({'version': self.version, 'dirs': self.dirs})
+        if len(data) > self.max_size:
+            self.evict(data)
+            data = json.dumps({'version': self.version, 'dirs': self.dirs})
+
+        dirname = os.path.dirname(self.path) or '.'
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        fd, tmp = tempfile.mkstemp(prefix='.find-index', dir=dirname)
+        try:
+            os.write(fd, data)
+            os.close(fd)
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+
+class Checksummer(object):
+    '''compute several digests of a file from a single read'''
+
+    blocksize = 1024 * 1024
+
+    def __init__(self, algorithms):
+        self.algorithms = algorithms
+        # raises ValueError for algorithms this python does not provide
+        for algorithm in algorithms:
+            hashlib.new(algorithm)
+
+    def digest(self, fsname):
+        '''return ({algorithm: hexdigest}, bytes read), raise on I/O errors'''
+        digests = [hashlib.new(algorithm) for algorithm in self.algorithms]
+        read = 0
+        f = open(fsname, 'rb')
+        try:
+            block = f.read(self.blocksize)
+            while block:
+                read += len(block)
+                for d in digests:
+                    d.update(block)
+                block = f.read(self.blocksize)
+        finally:
+            f.close()
+
+        result = {}
+        for algorithm, d in zip(self.algorithms, digests):
+            result[algorithm] = d.hexdigest()
+        return result, read
+
+
+class ModuleChecksummer(object):
+    '''sha1 only stand in for Checksummer on pythons without hashlib'''
+
+    def __init__(self, module):
+        self.module = module
+        self.algorithms = ['sha1']
+
+    def digest(self, fsname):
+        checksum = self.module.sha1(fsname)
+        if checksum is None:
+            raise IOError(errno.ENOENT, "No such file or directory", fsname)
+        return {'sha1': checksum}, os.path.getsize(fsname)
+
+
+def run_workers(items, handler, threads=1):
+    '''call handler(item) for every item, on a pool of threads if threads > 1
+
+    handler returns a list of further items to process, such as the
+    subdirectories of the directory it was given, which are handed out to
+    the workers as they are discovered.
+    '''
+    pending = list(items)
+
+    if threads <= 1:
+        while pending:
+            pending.extend(handler(pending.pop()))
+        return
+
+    cond = threading.Condition()
+    state = {'busy': 0}
+    errors = []
+
+    def worker():
+        while True:
+            cond.acquire()
+            try:
+                while not pending and state['busy'] and not errors:
+                    cond.wait()
+                if not pending or errors:
+                    cond.notifyAll()
+                    return
+                path = pending.pop()
+                state['busy'] += 1
+            finally:
+                cond.release()
+
+            subdirs = []
+            try:
+                subdirs = handler(path)
+            except Exception:
+                errors.append(get_exception())
+
+            cond.acquire()
+            try:
+                pending.extend(subdirs)
+                state['busy'] -= 1
+                cond.notifyAll()
+            finally:
+                cond.release()
+
+    workers = [threading.Thread(target=worker) for i in range(threads)]
+    for t in workers:
+        t.setDaemon(True)
+        t.start()
+    for t in workers:
+        t.join()
+
+    if errors:
+        raise errors[0]
+
+
+class Finder(object):
+    '''collect the files below a set of paths that match the given criteria'''
+
+    def __init__(self, module, age=None, size=None, max_read_bytes=None, index=None, checksummer=None):
+        self.module = module
+        self.params = module.params
+        self.age = age
+        self.size = size
+        self.now = time.time()
+        self.patterns = compile_patterns(self.params['patterns'], self.params['use_regex'])
+        self.excludes = compile_patterns(self.params['excludes'], self.params['use_regex'])
+        self.content = None
+        if self.params['contains'] is not None:
+            try:
+                self.content = ContentSearch(self.params['contains'], self.params['contains_mode'], max_read_bytes)
+            except re.error:
+                e = get_exception()
+                module.fail_json(contains=self.params['contains'], msg="invalid contains pattern: %s" % str(e))
+        self.index = index
+        self.checksummer = checksummer
+        self.hashed = {'files': 0, 'bytes': 0}
+        self.filelist = []
+        self.msg = ''
+        self.looked = 0
+        self.elapsed = {'scan': 0.0, 'stat': 0.0, 'content': 0.0}
+        self.lock = threading.Lock()
+
+    def listdir(self, root):
+        '''return the entries of root, and the stat of root when they are to be indexed after the scan'''
+        if self.index is None:
+            return listdir(root), None
+
+        # stat the directory before listing it, so changes made while listing invalidate the entry
+        dirst = os.stat(root)
+        entries = self.index.lookup(root, dirst, self.now)
+        if entries is not None:
+            return entries, None
+        return [IndexingEntry(entry) for entry in listdir(root)], dirst
+
+    def excluded(self, name):
+        return self.excludes is not None and pfilter(name, self.excludes)
+
+    def contentfilter(self, fsname, st, r):
+        '''filter files which contain the given expression, return (selected, error message)'''
+        if self.content is None:
+            return True, ''
+
+        try:
+            matches = self.content.search(fsname, st)
+        except (IOError, OSError):
+            return False, "%s was skipped as its content could not be read\n" % fsname
+
+        if self.params['contains_mode'] == 'count':
+            r['contains_count'] = matches
+        return matches > 0, ''
+
+    def scan(self, root):
+        '''examine the entries of one directory, return the subdirectories to descend into'''
+        params = self.params
+        start = time.time()
+        dirst = None
+        try:
+            entries, dirst = self.listdir(root)
+        except OSError:
+            entries = []
+            msg = "%s was skipped as it does not seem to be a valid directory or it cannot be accessed\n" % root
+        else:
+            msg = ''
+        scanned = time.time()
+
+        found = []
+        subdirs = []
+        content_time = 0.0
+        for entry in entries:
+            fsobj = entry.name
+            if self.excluded(fsobj):
+                continue
+
+            isdir = entry.is_dir()
+            if isdir and params['recurse'] and (params['follow'] or not entry.is_symlink()):
+                subdirs.append(entry.path)
+
+            if fsobj.startswith('.') and not params['hidden']:
+                continue
+
+            # the name and the type from readdir are enough to discard most entries without a stat
+            if params['file_type'] == 'directory':
+                if not isdir or not pfilter(fsobj, self.patterns):
+                    continue
+            elif isdir or not pfilter(fsobj, self.patterns):
+                continue
+
+            fsname = os.path.normpath(entry.path)
+            try:
+                st = entry.stat()
+            except OSError:
+                msg += "%s was skipped as it does not seem to be a valid file or it cannot be accessed\n" % fsname
+                continue
+
+            r = {'path': fsname}
+            if stat.S_ISDIR(st.st_mode) and params['file_type'] == 'directory':
+                if agefilter(st, self.now, self.age, params['age_stamp']):
+
+                    r.update(statinfo(st))
+                    found.append(r)
+
+            elif stat.S_ISREG(st.st_mode) and params['file_type'] == 'file':
+                if agefilter(st, self.now, self.age, params['age_stamp']) and \
+                   sizefilter(st, self.size):
+
+                    searched = time.time()
+                    selected, error = self.contentfilter(fsname, st, r)
+                    content_time += time.time() - searched
+                    msg += error
+                    if not selected:
+                        continue
+
+                    r.update(statinfo(st))
+                    found.append(r)
+
+        # only the entries which passed the name and type filters have been stat()ed
+        if dirst is not None:
+            self.index.store(root, dirst, entries, self.now)
+
+        self.lock.acquire()
+        try:
+            self.looked += len(entries)
+            self.filelist.extend(found)
+            self.msg += msg
+            self.elapsed['scan'] += scanned - start
+            self.elapsed['stat'] += time.time() - scanned - content_time
+            self.elapsed['content'] += content_time
+        finally:
+            self.lock.release()
+
+        return subdirs
+
+    def checksum(self, r):
+        try:
+            digests, read = self.checksummer.digest(r['path'])
+        except (IOError, OSError):
+            msg = "%s could not be read to compute its checksum\n" % r['path']
+            digests, read = None, 0
+        else:
+            msg = ''
+
+        if digests is None:
+            r['checksum'] = None
+        else:
+            r['checksum'] = digests[self.checksummer.algorithms[0]]
+            if len(digests) > 1:
+                r['checksums'] = digests
+
+        self.lock.acquire()
+        try:
+            self.msg += msg
+            self.hashed['files'] += 1
+            self.hashed['bytes'] += read
+        finally:
+            self.lock.release()
+        return []
+
+    def run(self, paths):
+        start = time.time()
+        roots = []
+        for npath in paths:
+            if os.path.isdir(npath):
+                roots.append(npath)
+            else:
+                self.msg += "%s was skipped as it does not seem to be a valid directory or it cannot be accessed\n" % npath
+
+        run_workers(roots, self.scan, self.params['threads'])
+
+        # workers finish in no particular order, keep the output stable
+        self.filelist.sort(key=lambda r: r['path'])
+
+        if self.checksummer is not None:
+            hashing = time.time()
+            # only regular files have contents to hash, and big files go
+            # first so one of them does not end up hashed alone at the end
+            by_size = sorted([r for r in self.filelist if r['isreg']], key=lambda r: r['size'], reverse=True)
+            run_workers(by_size, self.checksum, self.params['threads'])
+            self.elapsed['checksum'] = time.time() - hashing
+            self.hashed['bytes_per_sec'] = 0.0
+            if self.elapsed['checksum'] > 0:
+                self.hashed['bytes_per_sec'] = self.hashed['bytes'] / self.elapsed['checksum']
+
+        self.elapsed['total'] = time.time() - start
+
+
 def main():
     module = AnsibleModule(
         argument_spec = dict(
             paths         = dict(required=True, aliases=['name','path'], type='list'),
             patterns      = dict(default=['*'], type='list', aliases=['pattern']),
             contains      = dict(default=None, type='str'),
+            contains_mode = dict(default="first", choices=['first', 'count'], type='str'),
+            max_read_bytes = dict(default=None, type='str'),
             file_type     = dict(default="file", choices=['file', 'directory'], type='str'),
             age           = dict(default=None, type='str'),
             age_stamp     = dict(default="mtime", choices=['atime','mtime','ctime'], type='str'),
@@ -265,15 +964,18 @@ def main():
             hidden        = dict(default="False", type='bool'),
             follow        = dict(default="False", type='bool'),
             get_checksum  = dict(default="False", type='bool'),
+            checksum_algorithm = dict(default=['sha1'], type='list', aliases=['checksum_algo']),
             use_regex     = dict(default="False", type='bool'),
+            excludes      = dict(default=None, type='list'),
+            index         = dict(default=None, type='path'),
+            index_max_size = dict(default="32m", type='str'),
+            threads       = dict(default=1, type='int'),
         ),
         supports_check_mode=True,
     )
 
     params = module.params
 
-    filelist = []
-
     if params['age'] is None:
         age = None
     else:
@@ -288,63 +990,62 @@ def main():
     if params['size'] is None:
         size = None
     else:
-        # convert size to bytes:
-        m = re.match("^(-?\d+)(b|k|m|g|t)?$", params['size'].lower())
-        bytes_per_unit = {"b": 1, "k": 1024, "m": 1024**2, "g": 1024**3, "t": 1024**4}
-        if m:
-            size = int(m.group(1)) * bytes_per_unit.get(m.group(2), 1)
-        else:
+        size = parse_size(params['size'])
+        if size is None:
             module.fail_json(size=params['size'], msg="failed to process size")
 
-    now = time.time()
-    msg = ''
-    looked = 0
-    for npath in params['paths']:
-        if os.path.isdir(npath):
-
-            ''' ignore followlinks for python version < 2.6 '''
-            for root,dirs,files in (sys.version_info < (2,6,0) and os.walk(npath)) or \
-                                    os.walk( npath, followlinks=params['follow']):
-                looked = looked + len(files) + len(dirs)
-                for fsobj in (files + dirs):
-                    fsname=os.path.normpath(os.path.join(root, fsobj))
-
-                    if os.path.basename(fsname).startswith('.') and not params['hidden']:
-                       continue
-
-                    try:
-                        st = os.stat(fsname)
-                    except:
-                        msg+="%s was skipped as it does not seem to be a valid file or it cannot be accessed\n" % fsname
-                        continue
+    if params['max_read_bytes'] is None:
+        max_read_bytes = None
+    else:
+        max_read_bytes = parse_size(params['max_read_bytes'])
+        if max_read_bytes is None or max_read_bytes < 0:
+            module.fail_json(max_read_bytes=params['max_read_bytes'], msg="failed to process max_read_bytes")
 
-                    r = {'path': fsname}
-                    if stat.S_ISDIR(st.st_mode) and params['file_type'] == 'directory':
-                        if pfilter(fsobj, params['patterns'], params['use_regex']) and agefilter(st, now, age, params['age_stamp']):
+    if params['threads'] < 1:
+        module.fail_json(threads=params['threads'], msg="threads must be a positive integer")
 
-                            r.update(statinfo(st))
-                            filelist.append(r)
+    index = None
+    if params['index'] is not None:
+        index_max_size = parse_size(params['index_max_size'])
+        if index_max_size is None or index_max_size < 0:
+            module.fail_json(index_max_size=params['index_max_size'], msg="failed to process index_max_size")
+        index = DirIndex(params['index'], index_max_size)
 
-                    elif stat.S_ISREG(st.st_mode) and params['file_type'] == 'file':
-                        if pfilter(fsobj, params['patterns'], params['use_regex']) and \
-                           agefilter(st, now, age, params['age_stamp']) and \
-                           sizefilter(st, size) and \
-                           contentfilter(fsname, params['contains']):
+    checksummer = None
+    if params['get_checksum']:
+        if not params['checksum_algorithm']:
+            module.fail_json(checksum_algorithm=params['checksum_algorithm'], msg="checksum_algorithm must name at least one algorithm")
+        if HAS_HASHLIB:
+            try:
+                checksummer = Checksummer(params['checksum_algorithm'])
+            except ValueError:
+                module.fail_json(checksum_algorithm=params['checksum_algorithm'], msg="unsupported checksum algorithm")
+        elif [a.lower() for a in params['checksum_algorithm']] == ['sha1']:
+            checksummer = ModuleChecksummer(module)
+        else:
+            module.fail_json(checksum_algorithm=params['checksum_algorithm'], msg="hashlib is required for algorithms other than sha1")
 
-                            r.update(statinfo(st))
-                            if params['get_checksum']:
-                                r['checksum'] = module.sha1(fsname)
-                            filelist.append(r)
+    finder = Finder(module, age, size, max_read_bytes, index, checksummer)
+    finder.run(params['paths'])
 
-                if not params['recurse']:
-                    break
-        else:
-            msg+="%s was skipped as it does not seem to be a valid directory or it cannot be accessed\n" % npath
+    indexed = 0
+    if index is not None:
+        indexed = index.hits
+        if not module.check_mode:
+            try:
+                index.save()
+            except (IOError, OSError):
+                e = get_exception()
+                module.fail_json(msg="failed to write index %s: %s" % (params['index'], str(e)))
 
-    matched = len(filelist)
-    module.exit_json(files=filelist, changed=False, msg=msg, matched=matched, examined=looked)
+    result = dict(files=finder.filelist, changed=False, msg=finder.msg, matched=len(finder.filelist),
+                  examined=finder.looked, indexed=indexed, elapsed=finder.elapsed)
+    if checksummer is not None:
+        result['checksum_stats'] = finder.hashed
+    module.exit_json(**result)
 
 # import module snippets
 from ansible.module_utils.basic import *
-main()
+if __name__ == '__main__':
+    main()
 
@@ -25,8 +25,20 @@ options:
   path:
     description:
       - The full path of the file/object to get the facts of
-    required: true
+      - Either C(path) or C(paths) is required.
+    required: false
+    default: null
+  paths:
+    description:
+      - A list of full paths to get the facts of in one invocation, returned in C(stats) keyed by path.
+        Each path is expanded as C(path) is.
+      - A path that cannot be examined, for instance because it is not readable, does not fail the others.
+        Its entry in C(stats) holds C(failed) and C(msg) instead of the stat data.
+      - Owner and group names are looked up once per uid and gid, and with C(mime) the 'file'
+        utility is run once for all the paths rather than once per path.
+    required: false
     default: null
+    version_added: "2.1"
   follow:
     description:
       - Whether to follow symlinks
@@ -60,6 +72,28 @@ options:
     default: No
     version_added: "2.1"
     aliases: [ 'mime_type', 'mime-type' ]
+  checksums:
+    description:
+      - List of algorithms to hash the file with, returned as a dictionary in C(checksums).
+      - The file is read only once, however many digests are requested, including C(md5) and C(checksum).
+    required: false
+    choices: [ 'md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512' ]
+    default: null
+    version_added: "2.1"
+  checksum_cache:
+    description:
+      - Directory of an on-host cache of file digests, keyed on device and inode and kept while the
+        file's size, mtime and ctime do not change, so unchanged files are not read again.
+      - In check mode an existing cache is read but never created or updated.
+    required: false
+    default: null
+    version_added: "2.1"
+  checksum_cache_entries:
+    description:
+      - Number of digests kept in C(checksum_cache), the least recently used are dropped first.
+    required: false
+    default: 10000
+    version_added: "2.1"
 author: "Bruce Pennypacker (@bpennypacker)"
 '''
 
@@ -100,12 +134,35 @@ EXAMPLES = '''
 
 # Use sha256 to calculate checksum
 - stat: path=/path/to/something checksum_algorithm=sha256
+
+# Stat several files at once and fail if any of them is missing
+- stat:
+    paths:
+      - /etc/foo.conf
+      - /etc/bar.conf
+    get_md5: no
+  register: st
+- fail: msg="{{ item.key }} is missing"
+  when: not item.value.exists | default(False)
+  with_dict: "{{ st.stats }}"
+
+# Checksum a large image, reusing the digest from previous runs while the file is unchanged
+- stat: path=/srv/images/base.iso checksum_algorithm=sha256 get_md5=no checksum_cache=/var/cache/ansible/checksums
+
+# Get sha256 and sha512 digests from one read of the file, skipping md5
+- stat: path=/path/to/myhugefile get_md5=no get_checksum=no checksums=sha256,sha512
 '''
 
 RETURN = '''
+stats:
+    description: dictionary of stat data dictionaries, as described for C(stat), keyed by path.
+                 Paths that could not be examined map to a dictionary with C(failed), C(msg) and C(path).
+    returned: success, when paths is used
+    type: dictionary
+    sample: { "/etc/foo.conf": { "exists": true, "path": "/etc/foo.conf", "...": "..." } }
 stat:
     description: dictionary containing all the stat data
-    returned: success
+    returned: success, when path is used
     type: dictionary
     contains:
         exists:
@@ -274,6 +331,11 @@ stat:
             type: string
             sample: 50ba294cdf28c0d5bcde25708df53346825a429f
             aliases: ['checksum', 'checksum_algo']
+        checksums:
+            description: hashes of the path keyed by algorithm
+            returned: success, path exists, user can read stats, path supports hashing and the checksums option was given
+            type: dictionary
+            sample: { "sha256": "e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855" }
         pw_name:
             description: User name of owner
             returned: success, path exists and user can read stats and installed python supports it
@@ -301,25 +363,160 @@ import sys
 from stat import *
 import pwd
 import grp
+import time
 
-def main():
-    module = AnsibleModule(
-        argument_spec = dict(
-            path = dict(required=True, type='path'),
-            follow = dict(default='no', type='bool'),
-            get_md5 = dict(default='yes', type='bool'),
-            get_checksum = dict(default='yes', type='bool'),
-            checksum_algorithm = dict(default='sha1', type='str', choices=['sha1', 'sha224', 'sha256', 'sha384', 'sha512'], aliases=['checksum_algo', 'checksum']),
-            mime = dict(default=False, type='bool', aliases=['mime_type', 'mime-type']),
-        ),
-        supports_check_mode = True
-    )
+try:
+    import hashlib
+    HAS_HASHLIB = True
+except ImportError:
+    HAS_HASHLIB = False
 
-    path = module.params.get('path')
+try:
+    import sqlite3
+    HAS_SQLITE3 = True
+except ImportError:
+    HAS_SQLITE3 = False
+
+CHECKSUM_ALGORITHMS = ['md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512']
+
+def file_version(st):
+    ''' the parts of a stat result that change whenever the file content may have '''
+    mtime = getattr(st, 'st_mtime_ns', None)
+    ctime = getattr(st, 'st_ctime_ns', None)
+    if mtime is None:
+        mtime = repr(st.st_mtime)
+        ctime = repr(st.st_ctime)
+    return '%d:%s:%s' % (st.st_size, mtime, ctime)
+
+class ChecksumCache(object):
+    ''' digests of files keyed on (dev, inode, algorithm), valid while the size,
+    mtime and ctime recorded with them still match the file, evicted least
+    recently used first '''
+
+    def __init__(self, directory, max_entries, readonly=False):
+        self.max_entries = max_entries
+        self.readonly = readonly
+        self.db = None
+        path = os.path.join(directory, 'stat-checksums.sqlite')
+        if readonly:
+            # never create anything, only read a cache that is already there
+            if os.path.exists(path):
+                self.db = sqlite3.connect(path, timeout=30)
+            return
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.execute('CREATE TABLE IF NOT EXISTS checksums ('
+                        'dev INTEGER, inode INTEGER, algorithm TEXT, version TEXT, digest TEXT, used REAL, '
+                        'PRIMARY KEY (dev, inode, algorithm))')
+        self.db.commit()
+
+    def get(self, st, algorithms):
+        ''' return {algorithm: digest} for the algorithms cached for this version of the file '''
+        found = {}
+        if self.db is None:
+            return found
+        version = file_version(st)
+        try:
+            for algorithm in algorithms:
+                row = self.db.execute('SELECT version, digest FROM checksums WHERE dev = ? AND inode = ? AND algorithm = ?',
+                                      (st.st_dev, st.st_ino, algorithm)).fetchone()
+                if row is not None and row[0] == version:
+                    found[algorithm] = row[1]
+            if found and not self.readonly:
+                self.db.execute('UPDATE checksums SET used = ? WHERE dev = ? AND inode = ?',
+                                (time.time(), st.st_dev, st.st_ino))
+                self.db.commit()
+        except sqlite3.Error:
+            # a busy or damaged cache only costs a read of the file
+            pass
+        return found
+
+    def put(self, st, digests):
+        if self.readonly:
+            return
+        version = file_version(st)
+        now = time.time()
+        try:
+            for algorithm, digest in digests.items():
+                if digest is not None:
+                    self.db.execute('INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?)',
+                                    (st.st_dev, st.st_ino, algorithm, version, digest, now))
+            self.db.execute('DELETE FROM checksums WHERE rowid IN '
+                            '(SELECT rowid FROM checksums ORDER BY used DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+            self.db.commit()
+        except sqlite3.Error:
+            self.db.rollback()
+
+def cached_digests(path, st, algorithms, cache):
+    ''' digest_file() that answers from the cache where it can and fills it with what it had to read '''
+    digests = cache.get(st, algorithms)
+    missing = [algorithm for algorithm in algorithms if algorithm not in digests]
+    if missing:
+        computed = digest_file(path, missing)
+        # only remember digests of a file that did not change while it was read
+        if file_version(os.stat(path)) == file_version(st):
+            cache.put(st, computed)
+        digests.update(computed)
+    return digests
+
+def digest_file(path, algorithms, blocksize=64 * 1024):
+    ''' read path once and feed each block to one hash object per algorithm,
+    returns a dict of hex digests where unavailable algorithms (md5 on FIPS
+    systems for example) map to None '''
+    hashes = {}
+    for algorithm in algorithms:
+        try:
+            hashes[algorithm] = hashlib.new(algorithm)
+        except ValueError:
+            pass
+
+    if hashes:
+        f = open(path, 'rb')
+        try:
+            block = f.read(blocksize)
+            while block:
+                for h in hashes.values():
+                    h.update(block)
+                block = f.read(blocksize)
+        finally:
+            f.close()
+
+    digests = {}
+    for algorithm in algorithms:
+        if algorithm in hashes:
+            digests[algorithm] = hashes[algorithm].hexdigest()
+        else:
+            digests[algorithm] = None
+    return digests
+
+class StatError(Exception):
+    pass
+
+
+class NameCache(object):
+    ''' memoize pwd/grp lookups, the files of a bulk stat usually share a few owners '''
+
+    def __init__(self):
+        self.users = {}
+        self.groups = {}
+
+    def user(self, uid):
+        if uid not in self.users:
+            self.users[uid] = pwd.getpwuid(uid).pw_name
+        return self.users[uid]
+
+    def group(self, gid):
+        if gid not in self.groups:
+            self.groups[gid] = grp.getgrgid(gid).gr_name
+        return self.groups[gid]
+
+def stat_path(module, path, names, cache=None):
     follow = module.params.get('follow')
     get_md5 = module.params.get('get_md5')
     get_checksum = module.params.get('get_checksum')
     checksum_algorithm = module.params.get('checksum_algorithm')
+    checksums = module.params.get('checksums') or []
 
     try:
         if follow:
@@ -328,10 +525,9 @@ def main():
             st = os.lstat(path)
     except OSError, e:
         if e.errno == errno.ENOENT:
-            d = { 'exists' : False }
-            module.exit_json(changed=False, stat=d)
+            return { 'exists' : False }
 
-        module.fail_json(msg = e.strerror)
+        raise StatError(e.strerror)
 
     mode = st.st_mode
 
@@ -372,41 +568,153 @@ def main():
     if S_ISLNK(mode):
         d['lnk_source'] = os.path.realpath(path)
 
-    if S_ISREG(mode) and get_md5 and os.access(path,os.R_OK):
-        # Will fail on FIPS-140 compliant systems
-        try:
-            d['md5']       = module.md5(path)
-        except ValueError:
-            d['md5']       = None
+    if S_ISREG(mode) and (get_md5 or get_checksum or checksums) and os.access(path,os.R_OK):
+        if HAS_HASHLIB:
+            # a single pass over the file for every requested digest
+            algorithms = list(checksums)
+            if get_md5:
+                algorithms.append('md5')
+            if get_checksum:
+                algorithms.append(checksum_algorithm)
+            algorithms = list(dict.fromkeys(algorithms).keys())
+            try:
+                if cache is None:
+                    digests = digest_file(path, algorithms)
+                else:
+                    digests = cached_digests(path, st, algorithms, cache)
+            except (IOError, OSError):
+                e = get_exception()
+                raise StatError("Could not hash file '%s': %s" % (path, str(e)))
 
-    if S_ISREG(mode) and get_checksum and os.access(path,os.R_OK):
-        d['checksum']      = module.digest_from_file(path, checksum_algorithm)
+            for algorithm in checksums + [checksum_algorithm]:
+                # md5 is expected to be missing on FIPS-140 compliant systems
+                if algorithm != 'md5' and algorithm in digests and digests[algorithm] is None:
+                    raise StatError("Could not hash file '%s' with algorithm '%s', it is not available on this host" % (path, algorithm))
 
-    try:
-        pw = pwd.getpwuid(st.st_uid)
+            if get_md5:
+                d['md5'] = digests['md5']
+            if get_checksum:
+                d['checksum'] = digests[checksum_algorithm]
+            if checksums:
+                d['checksums'] = dict([(algorithm, digests[algorithm]) for algorithm in checksums])
+        else:
+            if get_md5:
+                # Will fail on FIPS-140 compliant systems
+                try:
+                    d['md5']       = module.md5(path)
+                except ValueError:
+                    d['md5']       = None
+
+            if get_checksum:
+                d['checksum']      = module.digest_from_file(path, checksum_algorithm)
 
-        d['pw_name']   = pw.pw_name
+            if checksums:
+                d['checksums'] = {}
+                for algorithm in checksums:
+                    d['checksums'][algorithm] = module.digest_from_file(path, algorithm)
 
-        grp_info = grp.getgrgid(st.st_gid)
-        d['gr_name'] = grp_info.gr_name
+    try:
+        d['pw_name']   = names.user(st.st_uid)
+        d['gr_name']   = names.group(st.st_gid)
     except:
         pass
 
-    if module.params.get('mime'):
-        d['mime_type'] = 'unknown'
-        d['charset'] = 'unknown'
+    return d
+
 
-        filecmd = [module.get_bin_path('file', True),'-i', path]
+def add_mime(module, stats, batch=1000):
+    ''' fill in mime_type and charset, running 'file' once per batch of paths '''
+    paths = [path for path in stats if stats[path].get('exists')]
+    for path in paths:
+        stats[path]['mime_type'] = 'unknown'
+        stats[path]['charset'] = 'unknown'
+
+    filecmd = [module.get_bin_path('file', True), '-b', '-i']
+    for i in range(0, len(paths), batch):
+        chunk = paths[i:i + batch]
         try:
-            rc, out, err = module.run_command(filecmd)
-            if rc == 0:
-                mtype, chset = out.split(':')[1].split(';')
-                d['mime_type'] = mtype.strip()
-                d['charset'] = chset.split('=')[1].strip()
+            rc, out, err = module.run_command(filecmd + chunk)
+            if rc != 0:
+                continue
+            # brief mode prints one line per path, in the order they were given
+            for path, line in zip(chunk, out.splitlines()):
+                try:
+                    mtype, chset = line.split(';')
+                    stats[path]['mime_type'] = mtype.strip()
+                    stats[path]['charset'] = chset.split('=')[1].strip()
+                except:
+                    pass
         except:
             pass
 
-    module.exit_json(changed=False, stat=d)
+def main():
+    module = AnsibleModule(
+        argument_spec = dict(
+            path = dict(required=False, type='path'),
+            paths = dict(required=False, type='list'),
+            follow = dict(default='no', type='bool'),
+            get_md5 = dict(default='yes', type='bool'),
+            get_checksum = dict(default='yes', type='bool'),
+            checksum_algorithm = dict(default='sha1', type='str', choices=['sha1', 'sha224', 'sha256', 'sha384', 'sha512'], aliases=['checksum_algo', 'checksum']),
+            mime = dict(default=False, type='bool', aliases=['mime_type', 'mime-type']),
+            checksums = dict(default=None, type='list'),
+            checksum_cache = dict(default=None, type='path'),
+            checksum_cache_entries = dict(default=10000, type='int'),
+        ),
+        mutually_exclusive = [['path', 'paths']],
+        required_one_of = [['path', 'paths']],
+        supports_check_mode = True
+    )
+
+    path = module.params.get('path')
+    paths = module.params.get('paths')
+    checksums = module.params.get('checksums') or []
+
+    for algorithm in checksums:
+        if algorithm not in CHECKSUM_ALGORITHMS:
+            module.fail_json(msg="unsupported checksum algorithm '%s', choose from %s" % (algorithm, ', '.join(CHECKSUM_ALGORITHMS)))
+
+    if module.params.get('checksum_cache_entries') < 1:
+        module.fail_json(msg="checksum_cache_entries must be a positive integer")
+
+    cache = None
+    if module.params.get('checksum_cache') is not None and HAS_HASHLIB:
+        if not HAS_SQLITE3:
+            module.fail_json(msg="the python sqlite3 module is required for checksum_cache")
+        try:
+            cache = ChecksumCache(module.params.get('checksum_cache'), module.params.get('checksum_cache_entries'), module.check_mode)
+        except (OSError, sqlite3.Error):
+            e = get_exception()
+            module.fail_json(msg="could not open checksum cache in %s: %s" % (module.params.get('checksum_cache'), str(e)))
+
+    names = NameCache()
+
+    if paths is None:
+        try:
+            stats = { path: stat_path(module, path, names, cache) }
+        except StatError:
+            e = get_exception()
+            module.fail_json(msg=str(e), path=path)
+    else:
+        stats = {}
+        for path in paths:
+            # the same expansion as type='path' does for path
+            path = os.path.expanduser(os.path.expandvars(path))
+            if path in stats:
+                continue
+            try:
+                stats[path] = stat_path(module, path, names, cache)
+            except StatError:
+                e = get_exception()
+                # one path that cannot be examined does not fail the others
+                stats[path] = { 'failed': True, 'msg': str(e), 'path': path }
+
+    if module.params.get('mime'):
+        add_mime(module, stats)
+
+    if paths is None:
+        module.exit_json(changed=False, stat=stats[path])
+    module.exit_json(changed=False, stats=stats)
 
 # import module snippets
 from ansible.module_utils.basic import *
@@ -79,6 +79,50 @@ options:
     default:
     required: false
     version_added: "2.1"
+  compare:
+    description:
+      - How files already in C(dest) are compared with the members of a zip archive.
+      - C(checksum) compares size and modification time, and the CRC32 of the content of files
+        where both of those match.
+      - C(size_mtime) trusts files whose size and modification time match the archive and
+        does not read them, which makes re-running against a large extracted tree cheap.
+      - CRC32 checksums are computed in parallel and read the files in chunks. Tar archives are
+        always compared by gtar.
+    required: false
+    choices: [ "checksum", "size_mtime" ]
+    default: "checksum"
+    version_added: "2.1"
+  engine:
+    description:
+      - How archives are read and unpacked.
+      - C(command) uses the C(gtar) and C(unzip) commands.
+      - C(python) uses python's tarfile and zipfile modules, and needs no command on the target
+        other than C(xz) for xz compressed archives. Every member is compared with C(dest) and
+        extracted if it differs in the same pass, so a compressed tar file is only decompressed
+        once. Members are written to a temporary file and moved into place.
+      - C(extra_opts) cannot be used with C(python).
+    required: false
+    choices: [ "command", "python" ]
+    default: "command"
+    version_added: "2.1"
+  manifest:
+    description:
+      - Record the archive's size, modification time and checksum, together with the size and
+        modification time of every extracted path, in a hidden file in C(dest) after unpacking.
+      - Later runs that find the same archive and unchanged paths report no change from a stat of
+        each path, without listing, decompressing or checksumming the archive.
+    required: false
+    choices: [ "yes", "no" ]
+    default: "no"
+    version_added: "2.1"
+  verify:
+    description:
+      - With C(manifest), C(fast) trusts the manifest when it matches, C(full) always compares the
+        archive with C(dest) as if there were no manifest, and then records a new one.
+    required: false
+    choices: [ "fast", "full" ]
+    default: "fast"
+    version_added: "2.1"
   validate_certs:
       description:
         - This only applies if using a https url as the source of the file.
@@ -89,11 +133,8 @@ options:
       choices: ["yes", "no"]
       version_added: "2.2"
 author: "Dag Wieers (@dagwieers)"
-todo:
-    - re-implement tar support using native tarfile module
-    - re-implement zip support using native zipfile module
 notes:
-    - requires C(gtar)/C(unzip) command on target host
+    - requires C(gtar)/C(unzip) command on target host, unless engine=python is used
     - can handle I(gzip), I(bzip2) and I(xz) compressed as well as uncompressed tar files
     - detects type of archive automatically
     - uses gtar's C(--diff arg) to calculate if changed or not. If this C(arg) is not
@@ -113,6 +154,15 @@ EXAMPLES = '''
 
 # Unarchive a file that needs to be downloaded (added in 2.0)
 - unarchive: src=https://example.com/example.zip dest=/usr/local/bin copy=no
+
+# Skip re-reading a large archive on every run when nothing changed
+- unarchive: src=/srv/dist/sdk.tar.gz dest=/opt/sdk copy=no manifest=yes
+
+# Unpack in process, without gtar or unzip on the target
+- unarchive: src=/tmp/foo.tar.gz dest=/opt/foo copy=no engine=python
+
+# Only checksum files whose size or modification time differ from the zip
+- unarchive: src=/srv/dist/large.zip dest=/opt/large copy=no compare=size_mtime
 '''
 
 import re
@@ -123,9 +173,19 @@ import grp
 import datetime
 import time
 import binascii
-from zipfile import ZipFile
+import fnmatch
+import shutil
+import tempfile
+import zipfile
+from zipfile import ZipFile, BadZipfile
 import tarfile
 import subprocess
+import threading
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
 # String from tar that shows the tar contents are different from the
 # filesystem
@@ -138,10 +198,48 @@ ZIP_FILE_MODE_RE = re.compile(r'([r-][w-][stx-]){3}')
 # When downloading an archive, how much of the archive to download before
 # saving to a tempfile (64k)
 BUFSIZE = 65536
+# Number of threads computing checksums of already extracted files
+CRC32_WORKERS = 4
 
-# Return a CRC32 checksum of a file
+# Return a CRC32 checksum of a file, read in chunks
 def crc32(path):
-    return binascii.crc32(open(path).read()) & 0xffffffff
+    crc = 0
+    f = open(path, 'rb')
+    try:
+        data = f.read(BUFSIZE * 16)
+        while data:
+            crc = binascii.crc32(data, crc)
+            data = f.read(BUFSIZE * 16)
+    finally:
+        f.close()
+    return crc & 0xffffffff
+
+# Return a dict of CRC32 checksums (None if unreadable) of paths, computed by a pool of threads
+def crc32_files(paths, workers=CRC32_WORKERS):
+    crcs = {}
+    pending = list(paths)
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            lock.acquire()
+            try:
+                if not pending:
+                    return
+                path = pending.pop()
+            finally:
+                lock.release()
+            try:
+                crcs[path] = crc32(path)
+            except (IOError, OSError):
+                crcs[path] = None
+
+    threads = [threading.Thread(target=worker) for i in range(min(workers, len(pending)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return crcs
 
 class UnarchiveError(Exception):
     pass
@@ -206,6 +304,38 @@ class ZipArchive(object):
         archive.close()
         return self._files_in_archive
 
+    def _zipinfo_timestamp(self, datestr):
+        dt_object = datetime.datetime(*(time.strptime(datestr, '%Y%m%d.%H%M%S')[0:6]))
+        return time.mktime(dt_object.timetuple())
+
+    def _files_to_checksum(self, zipinfo):
+        ''' Return the extracted files whose content has to be checksummed to tell if they changed '''
+        paths = []
+        if self.module.params['compare'] == 'size_mtime':
+            return paths
+        for line in zipinfo.splitlines():
+            pcs = line.split()
+            if len(pcs) != 8 or pcs[0][0] not in ('-', '?'):
+                continue
+            path = pcs[7]
+            if path in self.excludes or path[-1] == '/':
+                continue
+
+            dest = os.path.join(self.dest, path)
+            try:
+                st = os.lstat(dest)
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+
+            # A differing size or mtime is already a change, checksums only
+            # matter for files that look identical
+            if int(pcs[3]) != st.st_size or self._zipinfo_timestamp(pcs[6]) != st.st_mtime:
+                continue
+            paths.append(dest)
+        return paths
+
     def is_unarchived(self):
         cmd = '%s -ZT -s "%s"' % (self.cmd_path, self.src)
         if self.excludes:
@@ -275,6 +405,9 @@ class ZipArchive(object):
                 pass
             fut_gid = run_gid
 
+        # Checksum the candidates up front, on a pool of threads
+        crcs = crc32_files(self._files_to_checksum(old_out))
+
         for line in old_out.splitlines():
             change = False
 
@@ -356,8 +489,7 @@ class ZipArchive(object):
 
             itemized = list('.%s.......??' % ftype)
 
-            dt_object = datetime.datetime(*(time.strptime(pcs[6], '%Y%m%d.%H%M%S')[0:6]))
-            timestamp = time.mktime(dt_object.timetuple())
+            timestamp = self._zipinfo_timestamp(pcs[6])
 
             # Compare file timestamps
             if stat.S_ISREG(st.st_mode):
@@ -384,10 +516,14 @@ class ZipArchive(object):
                 err += 'File %s differs in size (%d vs %d)\n' % (path, size, st.st_size)
                 itemized[3] = 's'
 
-            # Compare file checksums
-            if stat.S_ISREG(st.st_mode):
-                crc = crc32(dest)
-                if crc != self._crc32(path):
+            # Compare file checksums, where size and mtime alone could not tell
+            if stat.S_ISREG(st.st_mode) and dest in crcs:
+                crc = crcs[dest]
+                if crc is None:
+                    change = True
+                    err += 'File %s could not be read to compute its CRC32 checksum\n' % path
+                    itemized[2] = 'c'
+                elif crc != self._crc32(path):
                     change = True
                     err += 'File %s differs in CRC32 checksum (0x%08x vs 0x%08x)\n' % (path, self._crc32(path), crc)
                     itemized[2] = 'c'
@@ -638,9 +774,545 @@ class TarXzArchive(TgzArchive):
         return xz_stdout
 
 
+# Describes one member of an archive read by the native handlers
+class ArchiveMember(object):
+
+    def __init__(self, name, ftype, size=0, mtime=0, mode=None, linkname=None, uid=None, gid=None, info=None):
+        self.name = name
+        # 'f' file, 'd' directory, 'L' symlink, 'h' hardlink, 'o' other (devices, fifos)
+        self.ftype = ftype
+        self.size = size
+        self.mtime = mtime
+        self.mode = mode
+        self.linkname = linkname
+        self.uid = uid
+        self.gid = gid
+        self.info = info
+
+
+# Base class for the handlers unpacking archives with python's zipfile and tarfile
+# modules instead of unzip/gtar. Each member is compared with dest and, when it
+# differs, extracted right away, so the archive is read (and decompressed) only
+# once and the same member table drives both the check and the extraction. This
+# is possible because the module does not support check mode.
+# Subclasses provide _walk(visit), calling visit() with an ArchiveMember for every
+# member in archive order, and _open(member), returning a file object for the data
+# of the member visit() was called with.
+class NativeArchive(object):
+
+    def __init__(self, src, dest, file_args, module):
+        self.src = src
+        self.dest = dest
+        self.file_args = file_args
+        self.module = module
+        self.excludes = [ path.rstrip('/') for path in module.params['exclude']]
+        self.includes = []
+        self.members = None
+        self.run_uid = os.getuid()
+        self.umask = os.umask(0)
+        os.umask(self.umask)
+        self._dest_real = os.path.realpath(dest)
+        # real paths of the regular files of the archive, as found or put in dest by this run
+        self._regular_files = set()
+        self._results = None
+
+    def _excluded(self, name):
+        # like gtar, an excluded directory excludes everything below it
+        parts = name.rstrip('/').split('/')
+        for i in range(1, len(parts) + 1):
+            prefix = '/'.join(parts[:i])
+            for pattern in self.excludes:
+                if fnmatch.fnmatch(prefix, pattern):
+                    return True
+        return False
+
+    def _dest_path(self, name):
+        dest = os.path.normpath(self.dest)
+        path = os.path.normpath(os.path.join(dest, name))
+        if os.path.isabs(name) or not (path + os.sep).startswith(dest + os.sep):
+            raise UnarchiveError('Path %s would be extracted outside of %s' % (name, self.dest))
+        # do not follow symlinks from the archive out of dest, checked before
+        # anything looks at, or writes next to, the path
+        if path != dest:
+            real_parent = os.path.realpath(os.path.dirname(path))
+            if not (real_parent + os.sep).startswith(self._dest_real + os.sep):
+                raise UnarchiveError('Path %s would be extracted outside of %s' % (name, self.dest))
+        return path
+
+    def _temp_copy(self, dirname, write):
+        ''' Create a temporary file in dirname, fill it with write(fileobj) and return its name.
+        The file is removed if write fails '''
+        fd, tmp = tempfile.mkstemp(prefix='.ansible_unarchive', dir=dirname)
+        try:
+            out = os.fdopen(fd, 'wb')
+            try:
+                write(out)
+            finally:
+                out.close()
+        except:
+            os.unlink(tmp)
+            raise
+        return tmp
+
+    def _mode(self, member):
+        mode = member.mode
+        if mode is None:
+            if member.ftype == 'd':
+                mode = int('0777', 8)
+            else:
+                mode = int('0666', 8)
+        return mode & ~self.umask
+
+    def _owner(self, member):
+        ''' uid/gid to give a member, None unless running as root without owner/group set '''
+        return None, None
+
+    @property
+    def files_in_archive(self, force_refresh=False):
+        if self.members is None or force_refresh:
+            self.members = []
+            self._walk(self.members.append)
+        return [ m.name for m in self.members if not self._excluded(m.name) ]
+
+    def _compare_content(self, member, path):
+        ''' Return None if the data of member matches path, or the name of a temporary
+        file next to path holding the data of member '''
+        data = self._open(member)
+        try:
+            f = open(path, 'rb')
+            try:
+                pos = 0
+                while True:
+                    chunk = data.read(BUFSIZE)
+                    if chunk != f.read(len(chunk) or 1):
+                        break
+                    if not chunk:
+                        return None
+                    pos += len(chunk)
+            finally:
+                f.close()
+
+            # The first pos bytes on disk are what the archive holds, write them out
+            # followed by the rest of the member, the archive is not rewound
+            def write(out):
+                remaining = pos
+                f = open(path, 'rb')
+                try:
+                    while remaining > 0:
+                        block = f.read(min(remaining, BUFSIZE))
+                        if not block:
+                            break
+                        out.write(block)
+                        remaining -= len(block)
+                finally:
+                    f.close()
+                out.write(chunk)
+                shutil.copyfileobj(data, out, BUFSIZE * 16)
+            return self._temp_copy(os.path.dirname(path), write)
+        finally:
+            data.close()
+
+    def _compare(self, member, path):
+        ''' Return (itemized change or None, temporary file already holding the data or None) '''
+        ftype = member.ftype
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return '>%s++++++.?? ' % ftype, None
+
+        if ftype == 'd' and not stat.S_ISDIR(st.st_mode) or \
+           ftype in ('f', 'h') and not stat.S_ISREG(st.st_mode) or \
+           ftype == 'L' and not stat.S_ISLNK(st.st_mode) or \
+           ftype == 'o' and stat.S_IFMT(st.st_mode) != stat.S_IFMT(member.mode):
+            return 'c%s++++++.?? ' % ftype, None
+
+        itemized = list('.%s.......??' % ftype)
+        tmp = None
+        if ftype == 'L':
+            if os.readlink(path) != member.linkname:
+                itemized[2] = 'c'
+        elif ftype == 'h':
+            target = self._link_target(member)
+            try:
+                if not os.path.samefile(path, target):
+                    itemized[2] = 'c'
+            except OSError:
+                itemized[2] = 'c'
+        elif ftype == 'f':
+            if self.module.params['keep_newer'] and st.st_mtime > member.mtime:
+                return None, None
+            if member.size != st.st_size:
+                itemized[3] = 's'
+            if int(st.st_mtime) != int(member.mtime):
+                itemized[4] = 't'
+            if itemized[3] == '.' and itemized[4] == '.' and self.module.params['compare'] != 'size_mtime':
+                tmp = self._compare_content(member, path)
+                if tmp is not None:
+                    itemized[2] = 'c'
+
+        if ftype not in ('L', 'h') and not self.file_args['mode'] and self._mode(member) != stat.S_IMODE(st.st_mode):
+            itemized[5] = 'p'
+
+        uid, gid = self._owner(member)
+        if uid is not None and uid != st.st_uid:
+            itemized[6] = 'o'
+        if gid is not None and gid != st.st_gid:
+            itemized[6] = 'g'
+
+        if itemized[2:7] == list('.....'):
+            return None, tmp
+        return ''.join(itemized) + ' ', tmp
+
+    def _extract_to_temp(self, member, path):
+        data = self._open(member)
+        try:
+            return self._temp_copy(os.path.dirname(path), lambda out: shutil.copyfileobj(data, out, BUFSIZE * 16))
+        finally:
+            data.close()
+
+    def _link_target(self, member):
+        ''' The path a hardlink member links to, which must resolve to a regular file of the
+        archive in dest, not to anything reached through a symlink out of it '''
+        target = os.path.realpath(self._dest_path(member.linkname))
+        if not (target + os.sep).startswith(self._dest_real + os.sep):
+            raise UnarchiveError('Hardlink %s to %s would point outside of %s' % (member.name, member.linkname, self.dest))
+        if target not in self._regular_files or not stat.S_ISREG(os.lstat(target).st_mode):
+            raise UnarchiveError('Hardlink %s to %s does not point to a file of the archive' % (member.name, member.linkname))
+        return target
+
+    def _extract_other(self, member, path):
+        raise UnarchiveError('Cannot extract %s, unsupported file type' % member.name)
+
+    def _extract(self, member, path, tmp=None):
+        ''' Put member in place at path, a name returned by _dest_path. tmp is a temporary
+        file already holding the data of a regular file, it is removed if extraction fails '''
+        try:
+            parent = os.path.dirname(path)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+
+            if member.ftype == 'd':
+                if os.path.islink(path) or os.path.lexists(path) and not os.path.isdir(path):
+                    os.unlink(path)
+                if not os.path.isdir(path):
+                    os.mkdir(path)
+                os.chmod(path, self._mode(member))
+            else:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    raise UnarchiveError('Cannot replace directory %s with a %s' % (member.name, member.ftype == 'L' and 'symlink' or 'file'))
+                if member.ftype == 'f':
+                    if tmp is None:
+                        tmp = self._extract_to_temp(member, path)
+                    os.chmod(tmp, self._mode(member))
+                    os.utime(tmp, (member.mtime, member.mtime))
+                    os.rename(tmp, path)
+                else:
+                    if os.path.lexists(path):
+                        os.unlink(path)
+                    if member.ftype == 'L':
+                        os.symlink(member.linkname, path)
+                    elif member.ftype == 'h':
+                        os.link(self._link_target(member), path)
+                    else:
+                        self._extract_other(member, path)
+
+            uid, gid = self._owner(member)
+            if uid is not None or gid is not None:
+                if uid is None:
+                    uid = -1
+                if gid is None:
+                    gid = -1
+                os.lchown(path, uid, gid)
+        finally:
+            if tmp is not None and os.path.lexists(tmp):
+                os.unlink(tmp)
+
+    def is_unarchived(self):
+        if self._results is not None:
+            return self._results
+
+        results = dict(out='', err='', diff='')
+        self.members = []
+
+        def visit(member):
+            self.members.append(member)
+            if self._excluded(member.name):
+                results['out'] += 'Path %s is excluded on request\n' % member.name
+                return
+            path = self._dest_path(member.name)
+            itemized, tmp = self._compare(member, path)
+            if itemized is None:
+                if tmp is not None:
+                    os.unlink(tmp)
+            else:
+                results['diff'] += itemized + member.name + '\n'
+                self._extract(member, path, tmp)
+                self.includes.append(member.name)
+            if member.ftype == 'f':
+                self._regular_files.add(os.path.realpath(path))
+
+        try:
+            self._walk(visit)
+        except (IOError, OSError, tarfile.TarError, BadZipfile):
+            e = get_exception()
+            raise UnarchiveError('Failed to unpack %s: %s' % (self.src, str(e)))
+
+        self._results = dict(unarchived=not self.includes, rc=0, **results)
+        return self._results
+
+    def unarchive(self):
+        # the members that differed were extracted while checking
+        result = self.is_unarchived()
+        return dict(rc=0, out=result['out'], err=result['err'], files=self.includes)
+
+
+# class to handle .zip files with python's zipfile module
+class NativeZipArchive(NativeArchive):
+
+    def __init__(self, src, dest, file_args, module):
+        super(NativeZipArchive, self).__init__(src, dest, file_args, module)
+        self.excludes = module.params['exclude']
+        self._archive = None
+
+    def _walk(self, visit):
+        self._archive = ZipFile(self.src)
+        try:
+            for member in self._read_infolist():
+                visit(member)
+        finally:
+            self._archive.close()
+
+    def _read_infolist(self):
+        members = []
+        for info in self._archive.infolist():
+            mode = None
+            ftype = 'f'
+            if info.create_system == 3 and info.external_attr >> 16:
+                attr = info.external_attr >> 16
+                mode = stat.S_IMODE(attr)
+                if stat.S_ISLNK(attr):
+                    ftype = 'L'
+            if info.filename.endswith('/'):
+                ftype = 'd'
+            mtime = time.mktime(info.date_time + (0, 0, -1))
+            member = ArchiveMember(info.filename, ftype, info.file_size, mtime, mode, info=info)
+            if ftype == 'L':
+                member.linkname = self._archive.read(info.filename)
+            members.append(member)
+        return members
+
+    def _open(self, member):
+        return self._archive.open(member.info)
+
+    def _compare_content(self, member, path):
+        # zip keeps a CRC32 of every member, no need to decompress it
+        try:
+            if crc32(path) == member.info.CRC & 0xffffffff:
+                return None
+        except (IOError, OSError):
+            pass
+        return self._extract_to_temp(member, path)
+
+    def can_handle_archive(self):
+        return zipfile.is_zipfile(self.src)
+
+
+# class to handle tar files, compressed or not, with python's tarfile module
+class NativeTarArchive(NativeArchive):
+
+    def __init__(self, src, dest, file_args, module):
+        super(NativeTarArchive, self).__init__(src, dest, file_args, module)
+        self._tarfile = None
+        self._xz = None
+
+    def _is_xz(self):
+        f = open(self.src, 'rb')
+        try:
+            return binascii.hexlify(f.read(6)).decode('ascii') == 'fd377a585a00'
+        finally:
+            f.close()
+
+    def _open_tar(self):
+        # read the archive as a stream, decompressing it only once
+        if self._is_xz():
+            # older tarfile modules cannot read xz, let xz decompress into a pipe
+            xz_bin_path = self.module.get_bin_path('xz', True)
+            self._xz = subprocess.Popen([xz_bin_path, '-dc', self.src], stdout=subprocess.PIPE)
+            return tarfile.open(fileobj=self._xz.stdout, mode='r|')
+        return tarfile.open(self.src, mode='r|*')
+
+    def _walk(self, visit):
+        self._tarfile = self._open_tar()
+        complete = False
+        try:
+            for info in self._tarfile:
+                if info.isdir():
+                    ftype = 'd'
+                elif info.issym():
+                    ftype = 'L'
+                elif info.islnk():
+                    ftype = 'h'
+                elif info.isfile():
+                    ftype = 'f'
+                else:
+                    ftype = 'o'
+                mode = info.mode
+                if ftype == 'o':
+                    mode = mode | {tarfile.CHRTYPE: stat.S_IFCHR, tarfile.BLKTYPE: stat.S_IFBLK}.get(info.type, stat.S_IFIFO)
+                name = info.name.rstrip('/')
+                if not name or name == '.':
+                    continue
+                visit(ArchiveMember(name, ftype, info.size, info.mtime, mode, info.linkname, info.uid, info.gid, info))
+            complete = True
+        finally:
+            self._tarfile.close()
+            if self._xz is not None:
+                if complete:
+                    # tarfile stops at the end of archive marker, let xz finish the padding
+                    while self._xz.stdout.read(BUFSIZE):
+                        pass
+                self._xz.stdout.close()
+                rc = self._xz.wait()
+                self._xz = None
+                if complete and rc != 0:
+                    raise UnarchiveError('Could not uncompress %s with xz' % self.src)
+
+    def _open(self, member):
+        return self._tarfile.extractfile(member.info)
+
+    def _mode(self, member):
+        # like tar, root keeps the permissions stored in the archive
+        if self.run_uid == 0:
+            return stat.S_IMODE(member.mode)
+        return super(NativeTarArchive, self)._mode(member)
+
+    def _owner(self, member):
+        # like tar, root restores the ownership stored in the archive
+        if self.run_uid != 0 or member.ftype == 'h':
+            return None, None
+        uid = gid = None
+        if not self.file_args['owner']:
+            try:
+                uid = pwd.getpwnam(member.info.uname).pw_uid
+            except (KeyError, TypeError):
+                uid = member.uid
+        if not self.file_args['group']:
+            try:
+                gid = grp.getgrnam(member.info.gname).gr_gid
+            except (KeyError, TypeError):
+                gid = member.gid
+        return uid, gid
+
+    def _extract_other(self, member, path):
+        self._tarfile.extract(member.info, self.dest)
+
+    def can_handle_archive(self):
+        try:
+            if self._is_xz():
+                return bool(self.module.get_bin_path('xz'))
+            tf = tarfile.open(self.src, mode='r|*')
+            try:
+                return tf.next() is not None
+            finally:
+                tf.close()
+        except (IOError, OSError, tarfile.TarError):
+            return False
+
+
+# Record of a successful extraction kept in dest, telling later runs that the
+# archive is already unarchived from its fingerprint and a stat of each path
+class ExtractionManifest(object):
+
+    version = 1
+
+    def __init__(self, src, dest, module):
+        self.src = src
+        self.dest = dest
+        self.module = module
+        name = module.params['original_basename'] or os.path.basename(src)
+        self.path = os.path.join(dest, '.ansible_unarchive.%s.json' % name)
+        self.data = self._load()
+
+    def _load(self):
+        try:
+            f = open(self.path)
+            try:
+                data = json.load(f)
+            finally:
+                f.close()
+        except (IOError, OSError, ValueError):
+            return None
+        if not isinstance(data, dict) or data.get('version') != self.version:
+            return None
+        return data
+
+    def _describe(self, st):
+        ''' The parts of a path's stat result recorded in the manifest '''
+        if stat.S_ISREG(st.st_mode):
+            return ['f', st.st_size, st.st_mtime]
+        if stat.S_ISDIR(st.st_mode):
+            return ['d', 0, 0]
+        if stat.S_ISLNK(st.st_mode):
+            return ['L', 0, 0]
+        return ['o', 0, 0]
+
+    @property
+    def handler(self):
+        return self.data['handler']
+
+    @property
+    def files(self):
+        return [ member[0] for member in self.data['members'] ]
+
+    def _same_archive(self):
+        st = os.stat(self.src)
+        if st.st_size != self.data['size']:
+            return False
+        if st.st_mtime == self.data['mtime']:
+            return True
+        # Same size but touched, for instance copied over again, compare content
+        return self.module.sha1(self.src) == self.data['checksum']
+
+    def is_current(self):
+        if self.data is None:
+            return False
+        try:
+            if self.data['exclude'] != self.module.params['exclude'] or not self._same_archive():
+                return False
+            for member in self.data['members']:
+                st = os.lstat(os.path.join(self.dest, member[0]))
+                if self._describe(st) != member[1:]:
+                    return False
+        except (OSError, KeyError, TypeError, IndexError):
+            return False
+        return True
+
+    def write(self, handler, files):
+        st = os.stat(self.src)
+        members = []
+        for filename in files:
+            try:
+                members.append([filename] + self._describe(os.lstat(os.path.join(self.dest, filename))))
+            except OSError:
+                pass
+        data = dict(version=self.version, handler=handler, size=st.st_size, mtime=st.st_mtime,
+                    checksum=self.module.sha1(self.src), exclude=self.module.params['exclude'], members=members)
+
+        fd, tmp = tempfile.mkstemp(prefix='.ansible_unarchive', dir=self.dest)
+        f = os.fdopen(fd, 'w')
+        try:
+            json.dump(data, f)
+        finally:
+            f.close()
+        os.rename(tmp, self.path)
+
+
 # try handlers in order and return the one that works or bail if none work
 def pick_handler(src, dest, file_args, module):
-    handlers = [TgzArchive, ZipArchive, TarArchive, TarBzipArchive, TarXzArchive]
+    if module.params['engine'] == 'python':
+        handlers = [NativeTarArchive, NativeZipArchive]
+    else:
+        handlers = [TgzArchive, ZipArchive, TarArchive, TarBzipArchive, TarXzArchive]
     for handler in handlers:
         obj = handler(src, dest, file_args, module)
         if obj.can_handle_archive():
@@ -662,6 +1334,10 @@ def main():
             exclude           = dict(requited=False, default=[], type='list'),
             extra_opts        = dict(required=False, default=[], type='list'),
             validate_certs    = dict(required=False, default=True, type='bool'),
+            compare           = dict(required=False, default='checksum', choices=['checksum', 'size_mtime']),
+            engine            = dict(required=False, default='command', choices=['command', 'python']),
+            manifest          = dict(required=False, default=False, type='bool'),
+            verify            = dict(required=False, default='fast', choices=['fast', 'full']),
         ),
         add_file_common_args = True,
 #        supports_check_mode = True,
@@ -713,44 +1389,69 @@ def main():
     if not os.path.isdir(dest):
         module.fail_json(msg="Destination '%s' is not a directory" % dest)
 
-    handler = pick_handler(src, dest, file_args, module)
+    if module.params['engine'] == 'python' and module.params['extra_opts']:
+        module.fail_json(msg="extra_opts cannot be used with engine=python")
 
-    res_args = dict(handler=handler.__class__.__name__, dest=dest, src=src)
+    manifest = None
+    if module.params['manifest']:
+        manifest = ExtractionManifest(src, dest, module)
 
-    # do we need to do unpack?
-    check_results = handler.is_unarchived()
+    if manifest is not None and module.params['verify'] == 'fast' and manifest.is_current():
+        res_args = dict(handler=manifest.handler, dest=dest, src=src, changed=False, manifest='current')
+        files_in_archive = manifest.files
+    else:
+        handler = pick_handler(src, dest, file_args, module)
 
-    # DEBUG
-#    res_args['check_results'] = check_results
+        res_args = dict(handler=handler.__class__.__name__, dest=dest, src=src)
 
-    if check_results['unarchived']:
-        res_args['changed'] = False
-    else:
-        # do the unpack
+        # do we need to do unpack?
         try:
-            res_args['extract_results'] = handler.unarchive()
-            if res_args['extract_results']['rc'] != 0:
-                module.fail_json(msg="failed to unpack %s to %s" % (src, dest), **res_args)
-        except IOError:
-            module.fail_json(msg="failed to unpack %s to %s" % (src, dest))
+            check_results = handler.is_unarchived()
+        except UnarchiveError:
+            e = get_exception()
+            module.fail_json(msg=str(e), **res_args)
+
+        # DEBUG
+#        res_args['check_results'] = check_results
+
+        if check_results['unarchived']:
+            res_args['changed'] = False
         else:
-            res_args['changed'] = True
+            # do the unpack
+            try:
+                res_args['extract_results'] = handler.unarchive()
+                if res_args['extract_results']['rc'] != 0:
+                    module.fail_json(msg="failed to unpack %s to %s" % (src, dest), **res_args)
+            except IOError:
+                module.fail_json(msg="failed to unpack %s to %s" % (src, dest))
+            else:
+                res_args['changed'] = True
+
+            if check_results.get('diff', False):
+                res_args['diff'] = { 'prepared': check_results['diff'] }
 
-        if check_results.get('diff', False):
-            res_args['diff'] = { 'prepared': check_results['diff'] }
+        files_in_archive = handler.files_in_archive
 
     # Run only if we found differences (idempotence) or diff was missing
     if res_args.get('diff', True):
         # do we need to change perms?
-        for filename in handler.files_in_archive:
+        for filename in files_in_archive:
             file_args['path'] = os.path.join(dest, filename)
             try:
                 res_args['changed'] = module.set_fs_attributes_if_different(file_args, res_args['changed'])
             except (IOError, OSError), e:
                 module.fail_json(msg="Unexpected error when accessing exploded file: %s" % str(e))
 
+    if manifest is not None and 'manifest' not in res_args:
+        try:
+            manifest.write(res_args['handler'], files_in_archive)
+            res_args['manifest'] = 'written'
+        except (IOError, OSError):
+            e = get_exception()
+            res_args['manifest'] = 'failed to write %s: %s' % (manifest.path, str(e))
+
     if module.params['list_files']:
-        res_args['files'] = handler.files_in_archive
+        res_args['files'] = files_in_archive
 
     module.exit_json(**res_args)
 
@@ -24,6 +24,19 @@ import shutil
 import datetime
 import re
 import tempfile
+import threading
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+try:
+    import hashlib
+    HAS_HASHLIB = True
+except ImportError:
+    HAS_HASHLIB = False
 
 DOCUMENTATION = '''
 ---
@@ -156,6 +169,33 @@ options:
     required: false
     choices: [ "yes", "no" ]
     default: "no"
+  segments:
+    description:
+      - Number of connections to download C(url) over. Above one, and if the
+        server answers range requests, the file is fetched as that many byte
+        ranges at once. The checksum is verified once the file is complete.
+      - With C(tmp_dest) set, a segmented download that failed part way is kept
+        there and carried on by the next run, as long as the server still
+        reports the same size and ETag or Last-Modified for the url.
+    required: false
+    default: 1
+    version_added: '2.1'
+  http_cache:
+    description:
+      - Directory in which the ETag and Last-Modified headers of downloads are
+        kept, per C(url) and C(dest). While the downloaded file keeps its size
+        and modification time, the next request for the same url is made
+        conditional on them, and a C(304 Not Modified) answer leaves the file in
+        place without downloading or checksumming it, even with C(force=yes).
+    required: false
+    default: null
+    version_added: '2.1'
+  http_cache_entries:
+    description:
+      - Number of urls kept in C(http_cache), least recently used ones are dropped first.
+    required: false
+    default: 1000
+    version_added: '2.1'
   others:
     description:
       - all arguments accepted by the M(file) module also work here
@@ -179,35 +219,367 @@ EXAMPLES='''
   get_url: url=http://example.com/path/file.conf dest=/etc/foo.conf checksum=sha256:b5bb9d8014a0f9b1d61e21e796d78dccdf1352f23cd32812f4850b878ae4944c
   get_url: url=http://example.com/path/file.conf dest=/etc/foo.conf checksum=md5:66dffb5228a211e61d6d7ef4a86f5758
 
+- name: download a release artifact only when the server has a new one
+  get_url: url=http://example.com/releases/app-latest.tar.gz dest=/srv/app.tar.gz force=yes http_cache=/var/cache/ansible/get_url
+
+- name: download a large image over four connections, resuming on retries
+  get_url: url=http://example.com/images/disk.qcow2 dest=/srv/disk.qcow2 segments=4 tmp_dest=/srv/tmp checksum=sha256:b5bb9d8014a0f9b1d61e21e796d78dccdf1352f23cd32812f4850b878ae4944c
+  register: image
+  until: image|success
+  retries: 5
+
 - name: download file from a file path
   get_url: url="file:///tmp/afile.txt" dest=/tmp/afilecopy.txt  
 '''
 
 import urlparse
 
+CHUNK_SIZE = 64 * 1024
+# how much a range fetches between two saves of the download state
+SEGMENT_STATE_INTERVAL = 8 * 1024 * 1024
+
 # ==============================================================
 # url handling
 
+def new_hashes(algorithms):
+    """
+    Create a hash object for each of the algorithms hashlib provides here.
+
+    Algorithms that are missing, like md5 in FIPS mode, are left out so
+    the caller can fall back to hashing the file afterwards."""
+    hashes = {}
+    if not HAS_HASHLIB:
+        return hashes
+    for algorithm in algorithms:
+        try:
+            hashes[algorithm] = hashlib.new(algorithm)
+        except ValueError:
+            pass
+    return hashes
+
+class ValidatorCache(object):
+    """
+    ETag and Last-Modified headers of earlier downloads, per url and dest.
+
+    An entry is only handed out while the file it was recorded for still has
+    the size and mtime it had then, and the same checksum is asked for."""
+
+    def __init__(self, directory, max_entries):
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+        self.directory = directory
+        self.path = os.path.join(directory, 'get_url-validators.json')
+        self.max_entries = max_entries
+        self.entries = {}
+        self.dirty = False
+        try:
+            f = open(self.path)
+            try:
+                data = json.load(f)
+            finally:
+                f.close()
+            if data.get('version') == 1:
+                self.entries = data['entries']
+        except (IOError, ValueError, KeyError, AttributeError):
+            # a missing or damaged cache only costs a full download
+            pass
+
+    def headers(self, key, checksum):
+        """
+        Return the conditional request headers for key, or None."""
+        entry = self.entries.get(key)
+        if entry is None or entry.get('checksum') != checksum:
+            return None
+        try:
+            st = os.stat(entry['dest'])
+        except OSError:
+            return None
+        if st.st_size != entry['size'] or st.st_mtime != entry['mtime']:
+            return None
+
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        entry['used'] = time.time()
+        self.dirty = True
+        return headers
+
+    def store(self, key, dest, info, checksum):
+        etag = info.get('etag')
+        last_modified = info.get('last-modified')
+        if not etag and not last_modified:
+            if key in self.entries:
+                del self.entries[key]
+                self.dirty = True
+            return
+        st = os.stat(dest)
+        self.entries[key] = dict(dest=dest, size=st.st_size, mtime=st.st_mtime, etag=etag,
+                                 last_modified=last_modified, checksum=checksum, used=time.time())
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        if len(self.entries) > self.max_entries:
+            used = [(entry.get('used', 0), key) for key, entry in self.entries.items()]
+            used.sort()
+            for junk, key in used[:len(used) - self.max_entries]:
+                del self.entries[key]
+        try:
+            fd, tempname = tempfile.mkstemp(dir=self.directory)
+            f = os.fdopen(fd, 'w')
+            try:
+                json.dump(dict(version=1, entries=self.entries), f)
+            finally:
+                f.close()
+            os.rename(tempname, self.path)
+        except (IOError, OSError):
+            pass
+
 def url_filename(url):
     fn = os.path.basename(urlparse.urlsplit(url)[2])
     if fn == '':
         return 'index.html'
     return fn
 
-def url_get(module, url, dest, use_proxy, last_mod_time, force, timeout=10, headers=None, tmp_dest=''):
+def parse_content_range(value):
+    """
+    Return the full length of the resource from a Content-Range header
+    such as "bytes 0-0/1234", or None if the server did not give it."""
+    match = re.match(r'bytes\s+\d+-\d+/(\d+)', value or '')
+    if match:
+        return int(match.group(1))
+    return None
+
+class SegmentedDownload(object):
+    """
+    Fetch a url of known length as byte ranges over several connections at
+    once, each written at its offset into one preallocated file.
+
+    The progress of every range is kept in a state file next to the data so
+    that a download which failed part way can carry on from there, as long
+    as the server still reports the same length and validator for the url.
+    """
+
+    def __init__(self, module, url, total, validator, segments, path, use_proxy, timeout, headers):
+        self.module = module
+        self.url = url
+        self.total = total
+        self.validator = validator
+        self.path = path
+        self.state_path = path + '.json'
+        self.use_proxy = use_proxy
+        self.timeout = timeout
+        self.headers = headers or {}
+        self.lock = threading.Lock()
+        self.errors = []
+        # the resource changed under us, what is on disk cannot be resumed
+        self.stale = False
+        self.resumed = False
+
+        # ranges are [start, end, next byte to fetch], end inclusive
+        count = max(1, min(segments, total // CHUNK_SIZE))
+        size = total // count
+        self.ranges = []
+        for i in range(count):
+            end = (i + 1) * size - 1
+            if i == count - 1:
+                end = total - 1
+            self.ranges.append([i * size, end, i * size])
+
+    def _load(self):
+        """
+        Pick up the ranges of an earlier attempt at the same resource."""
+        if self.validator is None or not os.path.exists(self.path):
+            return False
+        try:
+            f = open(self.state_path)
+            try:
+                state = json.load(f)
+            finally:
+                f.close()
+            if state['url'] != self.url or state['total'] != self.total or state['validator'] != self.validator:
+                return False
+            if os.path.getsize(self.path) != self.total:
+                return False
+            self.ranges = state['ranges']
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return False
+        return True
+
+    def _save(self):
+        self.lock.acquire()
+        try:
+            state = dict(url=self.url, total=self.total, validator=self.validator, ranges=self.ranges)
+            tempname = self.state_path + '.tmp'
+            f = open(tempname, 'w')
+            try:
+                json.dump(state, f)
+            finally:
+                f.close()
+            os.rename(tempname, self.state_path)
+        finally:
+            self.lock.release()
+
+    def _preallocate(self):
+        f = open(self.path, 'wb')
+        try:
+            if hasattr(os, 'posix_fallocate'):
+                try:
+                    os.posix_fallocate(f.fileno(), 0, self.total)
+                except OSError:
+                    # not every filesystem can, a sparse file does as well
+                    f.truncate(self.total)
+            else:
+                f.truncate(self.total)
+        finally:
+            f.close()
+
+    def _fetch(self, span):
+        headers = dict(self.headers)
+        headers['Range'] = 'bytes=%d-%d' % (span[2], span[1])
+        if self.validator is not None:
+            headers['If-Range'] = self.validator
+        try:
+            # the probe in url_get has already been through whatever makes
+            # fetch_url fail the module, so errors come back in info here
+            rsp, info = fetch_url(self.module, self.url, use_proxy=self.use_proxy, timeout=self.timeout, headers=headers)
+            if info['status'] != 206:
+                if info['status'] == 200:
+                    self.stale = True
+                    raise Exception("%s changed during the download" % self.url)
+                raise Exception("range request failed with status %s: %s" % (info['status'], info.get('msg', '')))
+
+            f = open(self.path, 'r+b')
+            try:
+                f.seek(span[2])
+                unsaved = 0
+                chunk = rsp.read(CHUNK_SIZE)
+                while chunk and span[2] <= span[1]:
+                    chunk = chunk[:span[1] + 1 - span[2]]
+                    f.write(chunk)
+                    span[2] += len(chunk)
+                    unsaved += len(chunk)
+                    if unsaved >= SEGMENT_STATE_INTERVAL:
+                        # the state must never claim bytes that are not in the file yet
+                        f.flush()
+                        self._save()
+                        unsaved = 0
+                    chunk = rsp.read(CHUNK_SIZE)
+                f.flush()
+            finally:
+                f.close()
+                rsp.close()
+            if span[2] <= span[1]:
+                raise Exception("connection closed at byte %d of %d-%d" % (span[2], span[0], span[1]))
+        except Exception, e:
+            self.lock.acquire()
+            try:
+                self.errors.append(str(e))
+            finally:
+                self.lock.release()
+
+    def run(self):
+        """
+        Download what is missing. Return None when the file is complete,
+        or the first error otherwise."""
+        self.resumed = self._load()
+        if not self.resumed:
+            self._preallocate()
+        self._save()
+
+        threads = []
+        for span in self.ranges:
+            if span[2] <= span[1]:
+                t = threading.Thread(target=self._fetch, args=(span,))
+                t.start()
+                threads.append(t)
+        for t in threads:
+            t.join()
+
+        if self.stale or self.validator is None:
+            os.remove(self.state_path)
+        elif self.errors:
+            self._save()
+        else:
+            os.remove(self.state_path)
+        if self.errors:
+            return self.errors[0]
+        return None
+
+    def discard(self):
+        """
+        Remove the data and the state of a download that cannot be resumed."""
+        for path in (self.path, self.state_path, self.state_path + '.tmp'):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def digest(self, hashes):
+        """
+        Hash the finished file, the ranges came in out of order."""
+        if not hashes:
+            return
+        f = open(self.path, 'rb')
+        try:
+            chunk = f.read(CHUNK_SIZE)
+            while chunk:
+                for h in hashes.values():
+                    h.update(chunk)
+                chunk = f.read(CHUNK_SIZE)
+        finally:
+            f.close()
+
+def segment_path(tmp_dest, url):
+    """
+    Fixed name for the partial download of url in tmp_dest, so the next
+    attempt finds it. None where there is nothing to resume from.
+    """
+    if tmp_dest == '' or not HAS_HASHLIB:
+        return None
+    return os.path.join(tmp_dest, '.get_url-%s.part' % hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+def url_get(module, url, dest, use_proxy, last_mod_time, force, timeout=10, headers=None, tmp_dest='', hashes=None, segments=1):
     """
-    Download data from the url and store in a temporary file.
+    Download data from the url and store in a temporary file, feeding
+    every chunk to the hash objects in hashes on the way.
+
+    With segments above one the request asks for the first byte only. If
+    the server answers that with a partial response the file is fetched in
+    that many ranges at once, otherwise the answer is the whole file.
 
     Return (tempfile, info about the request)
     """
 
-    rsp, info = fetch_url(module, url, use_proxy=use_proxy, force=force, last_mod_time=last_mod_time, timeout=timeout, headers=headers)
+    if hashes is None:
+        hashes = {}
+    request_headers = headers
+    segmented = segments > 1 and urlparse.urlsplit(url)[0] in ('http', 'https')
+    if segmented:
+        request_headers = dict(headers or {})
+        request_headers['Range'] = 'bytes=0-0'
+
+    rsp, info = fetch_url(module, url, use_proxy=use_proxy, force=force, last_mod_time=last_mod_time, timeout=timeout, headers=request_headers)
+
+    if segmented and info['status'] == 416:
+        # nothing to split, an empty file cannot satisfy any range
+        rsp, info = fetch_url(module, url, use_proxy=use_proxy, force=force, last_mod_time=last_mod_time, timeout=timeout, headers=headers)
 
     if info['status'] == 304:
         module.exit_json(url=url, dest=dest, changed=False, msg=info.get('msg', ''))
 
+    total = None
+    if info['status'] == 206:
+        total = parse_content_range(info.get('content-range'))
+        rsp.close()
+        if total is None:
+            module.fail_json(msg="Request failed, the partial response has no length", status_code=info['status'], url=url, dest=dest)
+
     # create a temporary file and copy content to do checksum-based replacement
-    if info['status'] != 200 and not url.startswith('file:/'):
+    if info['status'] not in (200, 206) and not url.startswith('file:/'):
         module.fail_json(msg="Request failed", status_code=info['status'], response=info['msg'], url=url, dest=dest)
 
     if tmp_dest != '':
@@ -219,13 +591,44 @@ def url_get(module, url, dest, use_proxy, last_mod_time, force, timeout=10, head
             else:
                 module.fail_json(msg="%s directoy does not exist." % tmp_dest)
 
+    if total is not None:
+        tempname = segment_path(tmp_dest, url)
+        resumable = tempname is not None
+        if not resumable:
+            fd, tempname = tempfile.mkstemp(dir=tmp_dest or None)
+            os.close(fd)
+        # If-Range only takes a strong etag, a date does otherwise
+        validator = info.get('etag')
+        if not validator or validator.startswith('W/'):
+            validator = info.get('last-modified')
+        download = SegmentedDownload(module, info['url'], total, validator, segments, tempname,
+                                     use_proxy, timeout, headers)
+        try:
+            error = download.run()
+        except (IOError, OSError), err:
+            error = str(err)
+        if error is not None:
+            if download.validator is None or download.stale or not resumable:
+                download.discard()
+            module.fail_json(msg="failed to download %s: %s" % (url, error), url=url, dest=dest)
+        download.digest(hashes)
+        info['msg'] = 'OK (%d bytes in %d segments)' % (total, len(download.ranges))
+        info['resumed'] = download.resumed
+        return tempname, info
+
+    if tmp_dest != '':
         fd, tempname = tempfile.mkstemp(dir=tmp_dest)
     else:
         fd, tempname = tempfile.mkstemp()
 
     f = os.fdopen(fd, 'wb')
     try:
-        shutil.copyfileobj(rsp, f)
+        chunk = rsp.read(CHUNK_SIZE)
+        while chunk:
+            f.write(chunk)
+            for h in hashes.values():
+                h.update(chunk)
+            chunk = rsp.read(CHUNK_SIZE)
     except Exception, err:
         os.remove(tempname)
         module.fail_json(msg="failed to create temporary content file: %s" % str(err))
@@ -267,6 +670,9 @@ def main():
         timeout = dict(required=False, type='int', default=10),
         headers = dict(required=False, default=None),
         tmp_dest = dict(required=False, default=''),
+        segments = dict(required=False, type='int', default=1),
+        http_cache = dict(required=False, type='path', default=None),
+        http_cache_entries = dict(required=False, type='int', default=1000),
     )
 
     module = AnsibleModule(
@@ -284,6 +690,7 @@ def main():
     use_proxy = module.params['use_proxy']
     timeout = module.params['timeout']
     tmp_dest = os.path.expanduser(module.params['tmp_dest'])
+    http_cache = module.params['http_cache']
 
     # Parse headers to dict
     if module.params['headers']:
@@ -296,6 +703,8 @@ def main():
 
     dest_is_dir = os.path.isdir(dest)
     last_mod_time = None
+    cache = None
+    cache_key = '%s %s' % (url, dest)
 
     # workaround for usage of deprecated sha256sum parameter
     if sha256sum != '':
@@ -312,10 +721,12 @@ def main():
             int(checksum, 16)
         except ValueError:
             module.fail_json(msg="The checksum parameter has to be in format <algorithm>:<checksum>")
+        checksum_param = '%s:%s' % (algorithm, checksum)
+    else:
+        checksum_param = ''
 
+    checksum_mismatch = False
     if not dest_is_dir and os.path.exists(dest):
-        checksum_mismatch = False
-
         # If the download is not forced and there is a checksum, allow
         # checksum match to skip the download.
         if not force and checksum != '':
@@ -343,8 +754,32 @@ def main():
         mtime = os.path.getmtime(dest)
         last_mod_time = datetime.datetime.utcfromtimestamp(mtime)
 
-    # download to tmpsrc
-    tmpsrc, info = url_get(module, url, dest, use_proxy, last_mod_time, force, timeout, headers, tmp_dest)
+    if http_cache:
+        try:
+            cache = ValidatorCache(http_cache, module.params['http_cache_entries'])
+        except OSError, e:
+            module.fail_json(msg="could not open http cache in %s: %s" % (http_cache, str(e)))
+        # a dest known not to match the checksum has to be downloaded again
+        conditional = None
+        if not checksum_mismatch:
+            conditional = cache.headers(cache_key, checksum_param)
+        if conditional:
+            if headers is None:
+                headers = {}
+            for name, value in conditional.items():
+                headers.setdefault(name, value)
+            # the validators of the server take the place of our own mtime
+            last_mod_time = None
+            # and saving here keeps their use recorded when a 304 ends the run
+            cache.save()
+
+    # download to tmpsrc, hashing it for the checks below on the way
+    algorithms = ['sha1', 'md5']
+    if checksum != '' and algorithm not in algorithms:
+        algorithms.append(algorithm)
+    hashes = new_hashes(algorithms)
+    tmpsrc, info = url_get(module, url, dest, use_proxy, last_mod_time, force, timeout, headers, tmp_dest, hashes,
+                           module.params['segments'])
 
     # Now the request has completed, we can finally generate the final
     # destination file name from the info dict.
@@ -368,7 +803,10 @@ def main():
     if not os.access(tmpsrc, os.R_OK):
         os.remove(tmpsrc)
         module.fail_json( msg="Source %s not readable" % (tmpsrc))
-    checksum_src = module.sha1(tmpsrc)
+    if 'sha1' in hashes:
+        checksum_src = hashes['sha1'].hexdigest()
+    else:
+        checksum_src = module.sha1(tmpsrc)
 
     # check if there is no dest file
     if os.path.exists(dest):
@@ -379,7 +817,9 @@ def main():
         if not os.access(dest, os.R_OK):
             os.remove(tmpsrc)
             module.fail_json( msg="Destination %s not readable" % (dest))
-        checksum_dest = module.sha1(dest)
+        # a dest of another size cannot hold the same content
+        if os.path.getsize(dest) == os.path.getsize(tmpsrc):
+            checksum_dest = module.sha1(dest)
     else:
         if not os.access(os.path.dirname(dest), os.W_OK):
             os.remove(tmpsrc)
@@ -399,11 +839,16 @@ def main():
     else:
         changed = False
 
+    # dest now holds what was downloaded, so the digests of the download are its digests
     if checksum != '':
-        destination_checksum = module.digest_from_file(dest, algorithm)
+        if algorithm in hashes:
+            destination_checksum = hashes[algorithm].hexdigest()
+        else:
+            destination_checksum = module.digest_from_file(dest, algorithm)
 
         if checksum != destination_checksum:
             os.remove(dest)
+            os.remove(tmpsrc)
             module.fail_json(msg="The checksum for %s did not match %s; it was %s." % (dest, checksum, destination_checksum))
 
     os.remove(tmpsrc)
@@ -415,10 +860,17 @@ def main():
     changed = module.set_fs_attributes_if_different(file_args, changed)
 
     # Backwards compat only.  We'll return None on FIPS enabled systems
-    try:
-        md5sum = module.md5(dest)
-    except ValueError:
-        md5sum = None
+    if 'md5' in hashes:
+        md5sum = hashes['md5'].hexdigest()
+    else:
+        try:
+            md5sum = module.md5(dest)
+        except ValueError:
+            md5sum = None
+
+    if cache is not None:
+        cache.store(cache_key, dest, info, checksum_param)
+        cache.save()
 
     res_args = dict(
         url = url, dest = dest, src = tmpsrc, md5sum = md5sum, checksum_src = checksum_src,
@@ -426,6 +878,8 @@ def main():
     )
     if backup_file:
         res_args['backup_file'] = backup_file
+    if 'resumed' in info:
+        res_args['resumed'] = info['resumed']
 
     # Mission complete
     module.exit_json(**res_args)
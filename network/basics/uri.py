@@ -20,16 +20,36 @@
 #
 # see examples/playbooks/uri.yml
 
+import base64
 import cgi
-import shutil
+import httplib
+import re
+import socket
 import tempfile
 import datetime
+import urllib
+from StringIO import StringIO
 
 try:
     import json
 except ImportError:
     import simplejson as json
 
+try:
+    import hashlib
+    HAS_HASHLIB = True
+except ImportError:
+    HAS_HASHLIB = False
+
+try:
+    import ssl
+    HAS_SSL_CONTEXT = hasattr(ssl, 'create_default_context')
+except ImportError:
+    HAS_SSL_CONTEXT = False
+
+CHUNK_SIZE = 64 * 1024
+MAX_REDIRECTS = 10
+
 DOCUMENTATION = '''
 ---
 module: uri
@@ -90,6 +110,46 @@ options:
     required: false
     choices: [ "yes", "no" ]
     default: "no"
+  return_content_max_bytes:
+    description:
+      - Most bytes of the body held in memory for C(content) and C(json). A
+        longer body is cut there and C(content_truncated) is returned; C(json)
+        is then left out.
+      - With C(dest) the body is always written out in full. It is only held in
+        memory when C(return_content) is set, it is JSON, or the status code
+        is not one of C(status_code).
+    required: false
+    default: null
+    version_added: '2.1'
+  filename_from:
+    description:
+      - How the name of the file is found when C(dest) is a directory.
+        C(redirect) makes a first request that does not follow redirects,
+        takes the name from the url it is redirected to, and then makes the
+        real request. C(response) makes only the real request, and takes the
+        name from its Content-Disposition header or else from the url the
+        request ended up at. As the file is not known beforehand, no
+        If-Modified-Since is sent with C(response).
+    required: false
+    choices: [ "redirect", "response" ]
+    default: "redirect"
+    version_added: '2.1'
+  requests:
+    description:
+      - A list of requests to make in this one task, in order, stopping at the
+        first one whose status code is not expected. Each is a hash with a
+        C(url), relative to C(url) if that is given, and optionally
+        C(method), C(body), C(body_format), C(headers), C(status_code) and
+        C(return_content). Anything left out is taken from the options of
+        the task. The results are returned as a C(results) list.
+      - Requests to the same host reuse one keep-alive connection. Requests
+        through a proxy, with credentials that are not sent up front, or
+        over HTTPS on a python without ssl.create_default_context use a new
+        connection each.
+      - Cannot be used with C(dest).
+    required: false
+    default: null
+    version_added: '2.1'
   force_basic_auth:
     description:
       - The library used by the uri module only sends authentication information when a webservice
@@ -203,6 +263,28 @@ EXAMPLES = '''
     return_content: yes
     HEADER_Cookie: "{{login.set_cookie}}"
 
+# Download into a directory, named after the Content-Disposition header, in one request
+- uri:
+    url: https://artifacts.example.com/api/builds/latest/download
+    dest: /srv/builds/
+    filename_from: response
+
+# Several calls to one API over a single connection
+- uri:
+    url: https://api.example.com/v1/
+    method: PUT
+    body_format: json
+    status_code: 200,201
+    requests:
+      - url: users/alice
+        body: {"shell": "/bin/bash"}
+      - url: users/bob
+        body: {"shell": "/bin/zsh"}
+      - url: users/carol
+        method: DELETE
+        status_code: 204
+  register: api
+
 # Queue build of a project in Jenkins:
 - uri:
     url: "http://{{ jenkins.host }}/job/{{ jenkins.job }}/build?token={{ jenkins.token }}"
@@ -215,29 +297,9 @@ EXAMPLES = '''
 '''
 
 
-def write_file(module, url, dest, content):
-    # create a tempfile with some test content
-    fd, tmpsrc = tempfile.mkstemp()
-    f = open(tmpsrc, 'wb')
-    try:
-        f.write(content)
-    except Exception, err:
-        os.remove(tmpsrc)
-        module.fail_json(msg="failed to create temporary content file: %s" % str(err))
-    f.close()
-
-    checksum_src   = None
+def write_file(module, dest, tmpsrc, checksum_src):
     checksum_dest  = None
 
-    # raise an error if there is no tmpsrc file
-    if not os.path.exists(tmpsrc):
-        os.remove(tmpsrc)
-        module.fail_json(msg="Source %s does not exist" % (tmpsrc))
-    if not os.access(tmpsrc, os.R_OK):
-        os.remove(tmpsrc)
-        module.fail_json( msg="Source %s not readable" % (tmpsrc))
-    checksum_src = module.sha1(tmpsrc)
-
     # check if there is no dest file
     if os.path.exists(dest):
         # raise an error if copy has no permission on dest
@@ -247,21 +309,77 @@ def write_file(module, url, dest, content):
         if not os.access(dest, os.R_OK):
             os.remove(tmpsrc)
             module.fail_json(msg="Destination %s not readable" % (dest))
-        checksum_dest = module.sha1(dest)
-    else:
-        if not os.access(os.path.dirname(dest), os.W_OK):
-            os.remove(tmpsrc)
-            module.fail_json(msg="Destination dir %s not writable" % (os.path.dirname(dest)))
+        # a dest of another size cannot hold the same content
+        if os.path.getsize(dest) == os.path.getsize(tmpsrc):
+            checksum_dest = module.sha1(dest)
 
     if checksum_src != checksum_dest:
-        try:
-            shutil.copyfile(tmpsrc, dest)
-        except Exception, err:
-            os.remove(tmpsrc)
-            module.fail_json(msg="failed to copy %s to %s: %s" % (tmpsrc, dest, str(err)))
+        # tmpsrc was written next to dest, so this is a rename
+        module.atomic_move(tmpsrc, dest)
+    else:
+        os.remove(tmpsrc)
+
+def read_body(module, resp, info, dest, keep, max_bytes):
+    """Reads the response body in chunks.  With a dest the whole body goes
+    into a temporary file in the directory of dest, hashed on the way.  Up
+    to max_bytes of it are kept in memory if keep is set.
 
-    os.remove(tmpsrc)
+    Returns (content, truncated, tmpsrc, checksum_src).
+    """
+    if hasattr(resp, 'read'):
+        source = resp
+    else:
+        # there was no content, but the error read()
+        # may have been stored in the info as 'body'
+        source = StringIO(info.pop('body', ''))
 
+    f = None
+    tmpsrc = None
+    sha1 = None
+    if dest is not None:
+        if not os.access(os.path.dirname(dest), os.W_OK):
+            module.fail_json(msg="Destination dir %s not writable" % (os.path.dirname(dest)))
+        fd, tmpsrc = tempfile.mkstemp(dir=os.path.dirname(dest), prefix='.%s.' % os.path.basename(dest))
+        f = os.fdopen(fd, 'wb')
+        if HAS_HASHLIB:
+            sha1 = hashlib.sha1()
+
+    kept = []
+    kept_bytes = 0
+    truncated = False
+    try:
+        chunk = source.read(CHUNK_SIZE)
+        while chunk:
+            if f is not None:
+                f.write(chunk)
+                if sha1 is not None:
+                    sha1.update(chunk)
+            if keep and not truncated:
+                if max_bytes is not None and kept_bytes + len(chunk) > max_bytes:
+                    chunk = chunk[:max_bytes - kept_bytes]
+                    truncated = True
+                kept.append(chunk)
+                kept_bytes += len(chunk)
+            if truncated and f is None:
+                # nothing else wants the rest of the body
+                break
+            chunk = source.read(CHUNK_SIZE)
+    except Exception, err:
+        if tmpsrc is not None:
+            f.close()
+            os.remove(tmpsrc)
+        module.fail_json(msg="failed to read the response body: %s" % str(err))
+    if f is not None:
+        f.close()
+    if hasattr(resp, 'close'):
+        resp.close()
+
+    checksum_src = None
+    if sha1 is not None:
+        checksum_src = sha1.hexdigest()
+    elif tmpsrc is not None:
+        checksum_src = module.sha1(tmpsrc)
+    return ''.join(kept), truncated, tmpsrc, checksum_src
 
 def url_filename(url):
     fn = os.path.basename(urlparse.urlsplit(url)[2])
@@ -291,13 +409,250 @@ def absolute_location(url, location):
         return location
 
 
-def uri(module, url, dest, body, body_format, method, headers, socket_timeout):
+def filename_from_headers(info):
+    """Returns the filename a Content-Disposition header of the response
+    asks for, or None.
+    """
+    match = re.match('attachment; ?filename="?([^"]+)', info.get('content-disposition', ''))
+    if match:
+        # Try preventing any funny business.
+        return os.path.basename(match.group(1))
+    return None
+
+
+class ConnectionPool(object):
+    """Keep-alive connections for the requests of one module run, one per
+    scheme, host and port, so that each host only sees one TCP and TLS
+    handshake however many requests go to it.
+
+    Requests that fetch_url handles in ways the pool does not (proxies,
+    credentials in the url or authentication that waits for a 401, or TLS
+    this python cannot verify) are left to fetch_url.
+    """
+
+    def __init__(self, module, timeout):
+        self.module = module
+        self.timeout = timeout
+        self.connections = {}
+
+    def usable(self, url):
+        if sys.version_info < (2, 6):
+            return False
+        parts = urlparse.urlsplit(url)
+        if parts[0] not in ('http', 'https') or parts.username is not None:
+            return False
+        if parts[0] == 'https' and not HAS_SSL_CONTEXT:
+            return False
+        if self.module.params['url_username'] and not self.module.params['force_basic_auth']:
+            return False
+        if self.module.params['use_proxy'] and urllib.getproxies().get(parts[0]) \
+                and not urllib.proxy_bypass(parts.hostname):
+            return False
+        return True
+
+    def _connection(self, key):
+        conn = self.connections.get(key)
+        if conn is None:
+            scheme, host, port = key
+            if scheme == 'https':
+                context = ssl.create_default_context()
+                if not self.module.params['validate_certs']:
+                    context.check_hostname = False
+                    context.verify_mode = ssl.CERT_NONE
+                conn = httplib.HTTPSConnection(host, port, timeout=self.timeout, context=context)
+            else:
+                conn = httplib.HTTPConnection(host, port, timeout=self.timeout)
+            self.connections[key] = conn
+        return conn
+
+    def _key(self, url):
+        parts = urlparse.urlsplit(url)
+        return (parts[0], parts.hostname, parts.port)
+
+    def _send(self, method, url, body, headers):
+        parts = urlparse.urlsplit(url)
+        path = parts[2] or '/'
+        if parts[3]:
+            path = '%s?%s' % (path, parts[3])
+        key = self._key(url)
+        while True:
+            conn = self._connection(key)
+            # a connection that was used before may have been closed by the
+            # server while idle, that one is worth a second try
+            reused = conn.sock is not None
+            try:
+                conn.request(method, path, body, headers)
+                return conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                self.discard(url)
+                if not reused:
+                    raise
+
+    def discard(self, url):
+        """Drops the connection to the host of url, for a response that was
+        not read to the end."""
+        conn = self.connections.pop(self._key(url), None)
+        if conn is not None:
+            conn.close()
+
+    def request(self, method, url, body=None, headers=None):
+        """Makes a request the way fetch_url would, following redirects as
+        follow_redirects says.  Returns (response, info).
+        """
+        params = self.module.params
+        request_headers = {}
+        if params.get('http_agent'):
+            request_headers['User-Agent'] = params['http_agent']
+        if params['url_username'] and params['force_basic_auth']:
+            credentials = '%s:%s' % (params['url_username'], params['url_password'] or '')
+            request_headers['Authorization'] = 'Basic %s' % base64.b64encode(credentials)
+        request_headers.update(headers or {})
+
+        # the same meaning fetch_url gives the values kept for compatibility
+        follow = params['follow_redirects']
+        if follow in ('no', False):
+            follow = 'none'
+        elif follow in ('yes', True):
+            follow = 'all'
+        for hop in range(MAX_REDIRECTS + 1):
+            try:
+                resp = self._send(method, url, body, request_headers)
+            except (httplib.HTTPException, socket.error), e:
+                return None, dict(url=url, status=-1, msg="Request failed: %s" % str(e))
+
+            info = dict((k.lower(), v) for k, v in resp.getheaders())
+            if resp.status < 400:
+                msg = 'OK (%s bytes)' % info.get('content-length', 'unknown')
+            else:
+                msg = 'HTTP Error %s: %s' % (resp.status, resp.reason)
+            info.update(dict(url=url, status=resp.status, msg=msg))
+
+            if resp.status not in (301, 302, 303, 307, 308) or 'location' not in info:
+                break
+            if follow == 'none' or (follow == 'safe' and method not in ('GET', 'HEAD')):
+                break
+            # the body of a redirect has to be read for the connection to be reused
+            resp.read()
+            url = urlparse.urljoin(url, info['location'])
+            if resp.status == 303 or (resp.status in (301, 302) and method not in ('GET', 'HEAD')):
+                method = 'GET'
+                body = None
+        return resp, info
+
+    def close(self):
+        for conn in self.connections.values():
+            conn.close()
+        self.connections = {}
+
+
+def format_response(url, resp, content):
+    """Turns the info of a response into module results.  Returns the
+    results and the decoded content.
+    """
+    # Transmogrify the headers, replacing '-' with '_', since variables dont
+    # work with dashes.
+    uresp = {}
+    for key, value in resp.iteritems():
+        ukey = key.replace("-", "_")
+        uresp[ukey] = value
+
+    try:
+        uresp['location'] = absolute_location(url, uresp['location'])
+    except KeyError:
+        pass
+
+    # Default content_encoding to try
+    content_encoding = 'utf-8'
+    if 'content_type' in uresp:
+        content_type, params = cgi.parse_header(uresp['content_type'])
+        if 'charset' in params:
+            content_encoding = params['charset']
+        u_content = unicode(content, content_encoding, errors='replace')
+        if 'application/json' in content_type or 'text/json' in content_type:
+            try:
+                js = json.loads(u_content)
+                uresp['json'] = js
+            except:
+                pass
+    else:
+        u_content = unicode(content, content_encoding, errors='replace')
+
+    return uresp, u_content
+
+
+def run_requests(module, base_url, items, method, body, body_format, headers, status_code, return_content, max_bytes):
+    """Makes each of the requests in items, relative to base_url, over
+    pooled connections where it can.  Stops at the first one with an
+    unexpected status code.
+    """
+    pool = ConnectionPool(module, module.params['timeout'])
+    results = []
+    try:
+        for item in items:
+            if not isinstance(item, dict):
+                item = dict(url=item)
+            url = urlparse.urljoin(base_url or '', item.get('url', ''))
+            item_method = item.get('method', method).upper()
+            item_headers = dict(headers)
+            item_headers.update(item.get('headers', {}))
+
+            item_body = item.get('body', body)
+            if item.get('body_format', body_format).lower() == 'json' and item_body is not None:
+                if not isinstance(item_body, basestring):
+                    item_body = json.dumps(item_body)
+                item_headers['Content-Type'] = 'application/json'
+
+            codes = item.get('status_code', status_code)
+            if isinstance(codes, basestring):
+                codes = codes.split(',')
+            elif not isinstance(codes, list):
+                codes = [codes]
+            codes = [int(x) for x in codes]
+            item_return = module.boolean(item.get('return_content', return_content))
+
+            pooled = pool.usable(url)
+            if pooled:
+                resp, info = pool.request(item_method, url, item_body, item_headers)
+            else:
+                resp, info = fetch_url(module, url, data=item_body, headers=item_headers,
+                                       method=item_method, timeout=module.params['timeout'])
+            info['status'] = int(info['status'])
+
+            keep = item_return or 'json' in info.get('content-type', '') or info['status'] not in codes
+            content, truncated, tmpsrc, checksum_src = read_body(module, resp, info, None, keep, max_bytes)
+            if truncated:
+                info['content_truncated'] = True
+                if pooled:
+                    # the connection left half read is the one to where the request ended up
+                    pool.discard(info['url'])
+            info['redirected'] = info['url'] != url
+
+            uresp, u_content = format_response(url, info, content)
+            if info['status'] not in codes:
+                uresp['msg'] = 'Status code was not %s: %s' % (codes, uresp.get('msg', ''))
+                uresp['content'] = u_content
+                results.append(uresp)
+                module.fail_json(msg=uresp['msg'], results=results)
+            if item_return:
+                uresp['content'] = u_content
+            results.append(uresp)
+    finally:
+        pool.close()
+    return results
+
+
+def uri(module, url, dest, body, body_format, method, headers, socket_timeout, return_content=True, status_code=None, max_bytes=None,
+        filename_from='redirect'):
     # is dest is set and is a directory, let's check if we get redirected and
     # set the filename from that url
     redirected = False
     redir_info = {}
     r = {}
-    if dest is not None:
+    dest_dir = None
+    if dest is not None and filename_from == 'response' and os.path.isdir(os.path.expanduser(dest)):
+        # the filename is only known once the response is in
+        dest_dir = os.path.expanduser(dest)
+    elif dest is not None:
         # Stash follow_redirects, in this block we don't want to follow
         # we'll reset back to the supplied value soon
         follow_redirects = module.params['follow_redirects']
@@ -327,18 +682,29 @@ def uri(module, url, dest, body, body_format, method, headers, socket_timeout):
     resp, info = fetch_url(module, url, data=body, headers=headers,
                            method=method, timeout=socket_timeout)
 
-    try:
-        content = resp.read()
-    except AttributeError:
-        # there was no content, but the error read()
-        # may have been stored in the info as 'body'
-        content = info.pop('body', '')
+    if dest_dir is not None:
+        filename = filename_from_headers(info)
+        if not filename:
+            filename = url_filename(info['url'])
+        dest = os.path.join(dest_dir, filename)
+
+    download = None
+    if dest is not None and info['status'] != 304:
+        keep = return_content or 'json' in info.get('content-type', '')
+        if status_code is not None and info['status'] not in status_code:
+            keep = True
+        content, truncated, tmpsrc, checksum_src = read_body(module, resp, info, dest, keep, max_bytes)
+        download = (tmpsrc, checksum_src)
+    else:
+        content, truncated, tmpsrc, checksum_src = read_body(module, resp, info, None, True, max_bytes)
+    if truncated:
+        r['content_truncated'] = True
 
     r['redirected'] = redirected or info['url'] != url
     r.update(redir_info)
     r.update(info)
 
-    return r, content, dest
+    return r, content, dest, download
 
 
 def main():
@@ -351,18 +717,23 @@ def main():
         body_format = dict(required=False, default='raw', choices=['raw', 'json']),
         method = dict(required=False, default='GET', choices=['GET', 'POST', 'PUT', 'HEAD', 'DELETE', 'OPTIONS', 'PATCH', 'TRACE', 'CONNECT', 'REFRESH']),
         return_content = dict(required=False, default='no', type='bool'),
+        return_content_max_bytes = dict(required=False, default=None, type='int'),
         follow_redirects = dict(required=False, default='safe', choices=['all', 'safe', 'none', 'yes', 'no']),
         creates = dict(required=False, default=None, type='path'),
         removes = dict(required=False, default=None, type='path'),
         status_code = dict(required=False, default=[200], type='list'),
         timeout = dict(required=False, default=30, type='int'),
-        headers = dict(required=False, type='dict', default={})
+        headers = dict(required=False, type='dict', default={}),
+        filename_from = dict(required=False, default='redirect', choices=['redirect', 'response']),
+        requests = dict(required=False, default=None, type='list'),
     ))
 
     module = AnsibleModule(
         argument_spec=argument_spec,
         check_invalid_arguments=False,
-        add_file_common_args=True
+        add_file_common_args=True,
+        required_one_of=[['url', 'requests']],
+        mutually_exclusive=[['requests', 'dest']],
     )
 
     url  = module.params['url']
@@ -406,9 +777,17 @@ def main():
         if not os.path.exists(removes):
             module.exit_json(stdout="skipped, since %s does not exist" % removes, changed=False, stderr=False, rc=0)
 
+    if module.params['requests']:
+        results = run_requests(module, url, module.params['requests'], method, body, body_format,
+                               dict_headers, status_code, return_content,
+                               module.params['return_content_max_bytes'])
+        module.exit_json(changed=False, results=results)
+
     # Make the request
-    resp, content, dest = uri(module, url, dest, body, body_format, method,
-                              dict_headers, socket_timeout)
+    resp, content, dest, download = uri(module, url, dest, body, body_format, method,
+                                        dict_headers, socket_timeout, return_content, status_code,
+                                        module.params['return_content_max_bytes'],
+                                        module.params['filename_from'])
     resp['status'] = int(resp['status'])
 
     # Write the file out if requested
@@ -416,7 +795,8 @@ def main():
         if resp['status'] == 304:
             changed = False
         else:
-            write_file(module, url, dest, content)
+            tmpsrc, checksum_src = download
+            write_file(module, dest, tmpsrc, checksum_src)
             # allow file attribute changes
             changed = True
             module.params['path'] = dest
@@ -427,33 +807,7 @@ def main():
     else:
         changed = False
 
-    # Transmogrify the headers, replacing '-' with '_', since variables dont
-    # work with dashes.
-    uresp = {}
-    for key, value in resp.iteritems():
-        ukey = key.replace("-", "_")
-        uresp[ukey] = value
-
-    try:
-        uresp['location'] = absolute_location(url, uresp['location'])
-    except KeyError:
-        pass
-
-    # Default content_encoding to try
-    content_encoding = 'utf-8'
-    if 'content_type' in uresp:
-        content_type, params = cgi.parse_header(uresp['content_type'])
-        if 'charset' in params:
-            content_encoding = params['charset']
-        u_content = unicode(content, content_encoding, errors='replace')
-        if 'application/json' in content_type or 'text/json' in content_type:
-            try:
-                js = json.loads(u_content)
-                uresp['json'] = js
-            except:
-                pass
-    else:
-        u_content = unicode(content, content_encoding, errors='replace')
+    uresp, u_content = format_response(url, resp, content)
 
     if resp['status'] not in status_code:
         uresp['msg'] = 'Status code was not %s: %s' % (status_code, uresp.get('msg', ''))
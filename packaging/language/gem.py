@@ -30,6 +30,8 @@ options:
   name:
     description:
       - The name of the gem to be managed.
+      - As of 2.1 this can be a list of gems, and those not yet in the
+        requested state are installed or removed with a single gem command.
     required: true
   state:
     description:
@@ -65,7 +67,7 @@ options:
     version_added: "1.4"
   version:
     description:
-      - Version of the gem to be installed/removed.
+      - Version of the gem to be installed/removed. Only valid with a single I(name).
     required: false
   pre_release:
     description:
@@ -84,6 +86,15 @@ options:
       - Allow adding build flags for gem compilation
     required: false
     version_added: "2.0"
+  cache_dir:
+    description:
+      - A directory of downloaded C(.gem) files. Gems to install are taken from
+        it when it has the wanted version, and fetched into it otherwise, and
+        their dependencies are looked for there before going to the
+        repository. Pointing several hosts at a shared directory saves each
+        of them from downloading the same gems.
+    required: false
+    version_added: "2.1"
 author:
     - "Ansible Core Team"
     - "Johan Wiren"
@@ -96,11 +107,20 @@ EXAMPLES = '''
 # Installs latest available version of rake.
 - gem: name=rake state=latest
 
+# Installs rake and bundler with one gem command, keeping the downloaded gems in a shared cache.
+- gem: name=rake,bundler cache_dir=/srv/cache/gems
+
 # Installs rake version 1.0 from a local gem on disk.
 - gem: name=rake gem_source=/path/to/gems/rake-1.0.gem state=present
 '''
 
+import glob
+import os
 import re
+from distutils.version import LooseVersion
+
+# gem query output per module run, keyed on whether it was a remote query
+gem_queries = {}
 
 def get_rubygems_path(module):
     if module.params['executable']:
@@ -119,6 +139,12 @@ def get_rubygems_version(module):
     return tuple(int(x) for x in match.groups())
 
 def get_installed_versions(module, remote=False):
+    """
+    Versions of the gems in name, keyed on gem name. The query for all of
+    them is run once per module run.
+    """
+    if remote in gem_queries:
+        return gem_queries[remote]
 
     cmd = get_rubygems_path(module)
     cmd.append('query')
@@ -127,33 +153,84 @@ def get_installed_versions(module, remote=False):
         if module.params['repository']:
             cmd.extend([ '--source', module.params['repository'] ])
     cmd.append('-n')
-    cmd.append('^%s$' % module.params['name'])
+    cmd.append('^(%s)$' % '|'.join([ name.replace('.', '\\.') for name in module.params['name'] ]))
     (rc, out, err) = module.run_command(cmd, check_rc=True)
-    installed_versions = []
+    installed_versions = {}
     for line in out.splitlines():
-        match = re.match(r"\S+\s+\((.+)\)", line)
+        match = re.match(r"(\S+)\s+\((.+)\)", line)
         if match:
-            versions = match.group(1)
-            for version in versions.split(', '):
-                installed_versions.append(version.split()[0])
+            versions = installed_versions.setdefault(match.group(1), [])
+            for version in match.group(2).split(', '):
+                versions.append(version.split()[0])
+    gem_queries[remote] = installed_versions
     return installed_versions
 
-def exists(module):
-
+def wanted_version(module, name):
     if module.params['state'] == 'latest':
-        remoteversions = get_installed_versions(module, remote=True)
+        remoteversions = get_installed_versions(module, remote=True).get(name)
         if remoteversions:
-            module.params['version'] = remoteversions[0]
-    installed_versions = get_installed_versions(module)
-    if module.params['version']:
-        if module.params['version'] in installed_versions:
+            return remoteversions[0]
+    return module.params['version']
+
+def exists(module, name):
+
+    version = wanted_version(module, name)
+    installed_versions = get_installed_versions(module).get(name, [])
+    if version:
+        if version in installed_versions:
             return True
     else:
         if installed_versions:
             return True
     return False
 
-def uninstall(module):
+def cached_gem(cache_dir, name, version=None):
+    """ The newest .gem file of name (at version) in cache_dir, or None """
+    found = []
+    for path in glob.glob(os.path.join(cache_dir, '%s-*.gem' % name)):
+        rest = os.path.basename(path)[len(name) + 1:-len('.gem')]
+        if not re.match(r'\d', rest):
+            # another gem whose name starts with this one
+            continue
+        gem_version = rest.split('-')[0]
+        if version is None or gem_version == version:
+            found.append((LooseVersion(gem_version), path))
+    if not found:
+        return None
+    found.sort()
+    return found[-1][1]
+
+def fetch(module, names):
+    """ Paths of .gem files for names in cache_dir, fetching the missing ones """
+    cache_dir = module.params['cache_dir']
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            e = get_exception()
+            module.fail_json(msg="could not create cache_dir %s: %s" % (cache_dir, str(e)))
+
+    paths = []
+    for name in names:
+        version = wanted_version(module, name)
+        path = cached_gem(cache_dir, name, version)
+        if path is None:
+            cmd = get_rubygems_path(module)
+            cmd.extend([ 'fetch', name ])
+            if version:
+                cmd.extend([ '--version', version ])
+            if module.params['repository']:
+                cmd.extend([ '--source', module.params['repository'] ])
+            if module.params['pre_release']:
+                cmd.append('--pre')
+            module.run_command(cmd, check_rc=True, cwd=cache_dir)
+            path = cached_gem(cache_dir, name, version)
+            if path is None:
+                module.fail_json(msg="gem fetch did not leave a .gem file for %s in %s" % (name, cache_dir))
+        paths.append(path)
+    return paths
+
+def uninstall(module, names):
 
     if module.check_mode:
         return
@@ -164,10 +241,10 @@ def uninstall(module):
     else:
         cmd.append('--all')
         cmd.append('--executable')
-    cmd.append(module.params['name'])
+    cmd.extend(names)
     module.run_command(cmd, check_rc=True)
 
-def install(module):
+def install(module, names):
 
     if module.check_mode:
         return
@@ -178,9 +255,19 @@ def install(module):
     else:
         major = None
 
+    cwd = None
+    if module.params['gem_source']:
+        sources = [ module.params['gem_source'] ]
+    elif module.params['cache_dir']:
+        # Dependencies are taken from .gem files in the working directory too
+        sources = fetch(module, names)
+        cwd = module.params['cache_dir']
+    else:
+        sources = names
+
     cmd = get_rubygems_path(module)
     cmd.append('install')
-    if module.params['version']:
+    if module.params['version'] and sources is names:
         cmd.extend([ '--version', module.params['version'] ])
     if module.params['repository']:
         cmd.extend([ '--source', module.params['repository'] ])
@@ -201,10 +288,10 @@ def install(module):
             cmd.append('--no-ri')
         else:
             cmd.append('--no-document')
-    cmd.append(module.params['gem_source'])
+    cmd.extend(sources)
     if module.params['build_flags']:
         cmd.extend([ '--', module.params['build_flags'] ])
-    module.run_command(cmd, check_rc=True)
+    module.run_command(cmd, check_rc=True, cwd=cwd)
 
 def main():
 
@@ -213,7 +300,7 @@ def main():
             executable           = dict(required=False, type='path'),
             gem_source           = dict(required=False, type='path'),
             include_dependencies = dict(required=False, default=True, type='bool'),
-            name                 = dict(required=True, type='str'),
+            name                 = dict(required=True, type='list'),
             repository           = dict(required=False, aliases=['source'], type='str'),
             state                = dict(required=False, default='present', choices=['present','absent','latest'], type='str'),
             user_install         = dict(required=False, default=True, type='bool'),
@@ -221,9 +308,10 @@ def main():
             include_doc         = dict(required=False, default=False, type='bool'),
             version              = dict(required=False, type='str'),
             build_flags          = dict(required=False, type='str'),
+            cache_dir            = dict(required=False, type='path'),
         ),
         supports_check_mode = True,
-        mutually_exclusive = [ ['gem_source','repository'], ['gem_source','version'] ],
+        mutually_exclusive = [ ['gem_source','repository'], ['gem_source','version'], ['gem_source','cache_dir'] ],
     )
 
     if module.params['version'] and module.params['state'] == 'latest':
@@ -231,29 +319,36 @@ def main():
     if module.params['gem_source'] and module.params['state'] == 'latest':
         module.fail_json(msg="Cannot maintain state=latest when installing from local source")
 
-    if not module.params['gem_source']:
-        module.params['gem_source'] = module.params['name']
+    names = module.params['name']
+    if len(names) > 1 and (module.params['version'] or module.params['gem_source']):
+        module.fail_json(msg="version and gem_source can only be used with a single name")
 
     changed = False
 
     if module.params['state'] in [ 'present', 'latest']:
-        if not exists(module):
-            install(module)
+        missing = [ name for name in names if not exists(module, name) ]
+        if missing:
+            install(module, missing)
             changed = True
     elif module.params['state'] == 'absent':
-        if exists(module):
-            uninstall(module)
+        installed = [ name for name in names if exists(module, name) ]
+        if installed:
+            uninstall(module, installed)
             changed = True
 
     result = {}
-    result['name'] = module.params['name']
+    if len(names) == 1:
+        result['name'] = names[0]
+    else:
+        result['name'] = names
     result['state'] = module.params['state']
-    if module.params['version']:
-        result['version'] = module.params['version']
+    if len(names) == 1 and wanted_version(module, names[0]):
+        result['version'] = wanted_version(module, names[0])
     result['changed'] = changed
 
     module.exit_json(**result)
 
 # import module snippets
 from ansible.module_utils.basic import *
-main()
+if __name__ == '__main__':
+    main()
@@ -19,6 +19,7 @@
 # along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import glob
 import tempfile
 import re
 import os
@@ -36,11 +37,17 @@ options:
   name:
     description:
       - The name of a Python library to install or the url of the remote package.
+      - As of 2.1 this can be a list of names, and those not yet in the
+        requested state are handled by a single pip run. A comma separated
+        string is split into names too, but the commas of a version range
+        such as C(Django>=1.8,<1.9) are kept with their name.
     required: false
     default: null
   version:
     description:
-      - The version number to install of the Python library specified in the I(name) parameter
+      - The version number to install of the Python library specified in the I(name) parameter.
+        Only valid with a single I(name).
+      - With I(state=absent) the library is only removed when this version of it is installed.
     required: false
     default: null
   requirements:
@@ -127,6 +134,29 @@ options:
     version_added: "2.1"
     required: false
     default: null
+  requirements_diff:
+    description:
+      - With I(requirements) and I(state=present), read the requirements file
+        (and the files it includes with C(-r)) and hand pip only the lines the
+        installed distributions do not already satisfy, without running pip at
+        all when every line is met. The lines already met are passed to pip as
+        constraints (C(-c), pip 7.1 or later), so the lines it installs cannot
+        upgrade or downgrade them. Plain names and C(==), C(!=), C(<), C(<=),
+        C(>), C(>=) on numeric versions are checked locally, every other line
+        (editables, URLs, extras, environment markers) always goes to pip.
+    required: false
+    default: "no"
+    choices: [ "yes", "no" ]
+    version_added: "2.1"
+  cache_dir:
+    description:
+      - A directory pip keeps downloaded and built wheels in and looks in
+        before downloading (pip's C(--cache-dir), pip 6.0 or later). Pointing
+        several hosts at a shared directory saves each of them from fetching
+        the same artifacts.
+    required: false
+    default: null
+    version_added: "2.1"
 
 notes:
    - Please note that virtualenv (U(http://www.virtualenv.org/)) must be installed on the remote host if the virtualenv parameter is specified and the virtualenv needs to be initialized.
@@ -138,6 +168,9 @@ EXAMPLES = '''
 # Install (Bottle) python package.
 - pip: name=bottle
 
+# Install (Bottle) and (Jinja2) with a single pip run, keeping downloads in a shared cache.
+- pip: name=bottle,jinja2 cache_dir=/srv/cache/pip
+
 # Install (Bottle) python package on version 0.11.
 - pip: name=bottle version=0.11
 
@@ -165,6 +198,9 @@ EXAMPLES = '''
 # Install specified python requirements in indicated (virtualenv).
 - pip: requirements=/my_app/requirements.txt virtualenv=/my_app/venv
 
+# Install only the lines of (requirements.txt) not already satisfied in (virtualenv).
+- pip: requirements=/my_app/requirements.txt virtualenv=/my_app/venv requirements_diff=yes
+
 # Install specified python requirements and custom Index URL.
 - pip: requirements=/my_app/requirements.txt extra_args='-i https://example.com/pypi/simple'
 
@@ -190,6 +226,21 @@ def _get_cmd_options(module, cmd):
     return cmd_options
 
 
+def _split_names(value):
+    """
+    name as a list. A YAML list is taken as it is, a string is split on the
+    commas between names but not on those of a version range such as
+    Django>=1.8,<1.9
+    """
+    if value is None or isinstance(value, list):
+        return value
+    names = []
+    for pkg in re.split(r',(?=\s*[^\s<>=!~])', value):
+        if pkg.strip():
+            names.append(pkg.strip())
+    return names
+
+
 def _get_full_name(name, version=None):
     if version is None:
         resp = name
@@ -197,18 +248,328 @@ def _get_full_name(name, version=None):
         resp = name + '==' + version
     return resp
 
+def _canonical_name(name):
+    # PEP 503: runs of -, _ and . are all the same, zope_interface is zope.interface
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
 def _is_present(name, version, installed_pkgs):
-    for pkg in installed_pkgs:
+    key = _canonical_name(name)
+    return key in installed_pkgs and (version is None or installed_pkgs[key] == version)
+
+
+def _pending(names, version, state, installed_pkgs):
+    """ The names that state=present/absent still has to act on """
+    pending = []
+    for name in names:
+        if re.match(r'[A-Za-z0-9][A-Za-z0-9._-]*$', name):
+            present = _is_present(name, version, installed_pkgs)
+        elif state == 'present':
+            # names with their own version specifiers, bottle>=0.10, are
+            # judged like requirement lines, the rest is left to pip
+            present = version is None and _requirement_satisfied(name, installed_pkgs)
+        else:
+            # pip uninstall takes no notice of the specifiers, only whether
+            # the name is installed counts
+            m = re.match(r'([A-Za-z0-9][A-Za-z0-9._-]*)\s*(\[[^\]]*\])?\s*(==|!=|<=|>=|<|>|~=)[^/:@;]*$', name)
+            present = m is None or _is_present(m.group(1), None, installed_pkgs)
+        if present == (state == 'absent'):
+            pending.append(name)
+    return pending
+
+
+def _parse_freeze(out):
+    installed_pkgs = {}
+    for pkg in out.split():
         if '==' not in pkg:
             continue
 
-        [pkg_name, pkg_version] = pkg.split('==')
+        [pkg_name, pkg_version] = pkg.split('==', 1)
+        installed_pkgs[_canonical_name(pkg_name)] = pkg_version
+
+    return installed_pkgs
+
+
+def _read_pkg_info(path):
+    """ Name and version from the headers of a METADATA/PKG-INFO file """
+    name = None
+    version = None
+    try:
+        f = open(path)
+    except IOError:
+        return None
+    try:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if not line:
+                break
+            if line.startswith('Name:'):
+                name = line[5:].strip()
+            elif line.startswith('Version:'):
+                version = line[8:].strip()
+    finally:
+        f.close()
+    if name and version:
+        return name, version
+    return None
+
+
+def _installed_distributions(site_dirs):
+    """
+    Index the distributions in site_dirs by canonical project name, as
+    pip freeze would list them, from their metadata files. The first
+    directory a project is found in wins, as on sys.path.
+    """
+    installed_pkgs = {}
+    for site_dir in site_dirs:
+        try:
+            entries = os.listdir(site_dir)
+        except OSError:
+            continue
+        entries.sort()
+        for entry in entries:
+            path = os.path.join(site_dir, entry)
+            dist = None
+            if entry.endswith('.dist-info'):
+                dist = _read_pkg_info(os.path.join(path, 'METADATA'))
+            elif entry.endswith('.egg-info'):
+                if os.path.isdir(path):
+                    path = os.path.join(path, 'PKG-INFO')
+                dist = _read_pkg_info(path)
+            elif entry.endswith('.egg'):
+                if os.path.isdir(path):
+                    dist = _read_pkg_info(os.path.join(path, 'EGG-INFO', 'PKG-INFO'))
+                elif entry.count('-') >= 2:
+                    dist = tuple(entry.split('-')[:2])
+            elif entry.endswith('.egg-link'):
+                # develop installs point at their source checkout
+                try:
+                    f = open(path)
+                    try:
+                        source = f.readline().strip()
+                    finally:
+                        f.close()
+                except IOError:
+                    continue
+                for egg_info in glob.glob(os.path.join(source, '*.egg-info')):
+                    dist = _read_pkg_info(os.path.join(egg_info, 'PKG-INFO'))
+                    if dist:
+                        break
+            if dist is None:
+                continue
+            key = _canonical_name(dist[0])
+            if key not in installed_pkgs:
+                installed_pkgs[key] = dist[1]
+
+    return installed_pkgs
+
+
+def _script_interpreter(module, script):
+    try:
+        f = open(script)
+        try:
+            line = f.readline(256)
+        finally:
+            f.close()
+    except IOError:
+        return None
+    if not line.startswith('#!'):
+        return None
+    words = line[2:].split()
+    if not words:
+        return None
+    if os.path.basename(words[0]) == 'env' and len(words) > 1:
+        return module.get_bin_path(words[1], False)
+    return words[0]
+
+
+def _venv_isolated(env):
+    cfg = os.path.join(env, 'pyvenv.cfg')
+    if os.path.exists(cfg):
+        f = open(cfg)
+        try:
+            for line in f:
+                if '=' in line:
+                    key, value = line.split('=', 1)
+                    if key.strip() == 'include-system-site-packages':
+                        return value.strip().lower() != 'true'
+        finally:
+            f.close()
+        return True
+    return bool(glob.glob(os.path.join(env, 'lib', 'python*', 'no-global-site-packages.txt')))
+
+
+def _site_packages(module, pip, env):
+    """
+    The directories pip installs into and reports from, or None when that
+    can't be told without running pip.
+    """
+    if env:
+        if os.path.dirname(pip) != os.path.join(env, 'bin') or not _venv_isolated(env):
+            return None
+        site_dirs = glob.glob(os.path.join(env, 'lib*', 'python*', 'site-packages'))
+    else:
+        # Without a virtualenv only a pip running on this very interpreter
+        # shares its sys.path
+        interpreter = _script_interpreter(module, pip)
+        if interpreter is None \
+                or os.path.realpath(interpreter) != os.path.realpath(sys.executable) \
+                or os.path.dirname(os.path.dirname(interpreter)) != sys.prefix:
+            return None
+        site_dirs = [p for p in sys.path if p and os.path.isdir(p)]
+
+    # lib64 is usually a symlink to lib
+    seen = []
+    for site_dir in site_dirs:
+        site_dir = os.path.realpath(site_dir)
+        if site_dir not in seen:
+            seen.append(site_dir)
+    return seen
+
+
+def _get_packages(module, pip, chdir, site_dirs):
+    """
+    Return (cmd, out, err, installed_pkgs) with cmd the pip freeze command
+    if one had to be run, and installed_pkgs None if that failed.
+    """
+    if site_dirs is not None:
+        return None, '', '', _installed_distributions(site_dirs)
+
+    freeze_cmd = '%s freeze' % pip
+    rc, out, err = module.run_command(freeze_cmd, cwd=chdir)
+    if rc != 0:
+        return freeze_cmd, out, err, None
+    return freeze_cmd, out, err, _parse_freeze(out)
+
+
+
+def _read_requirements(module, path, options, reqs, seen=None):
+    """
+    Flatten a requirements file and the ones it includes with -r into
+    option lines and requirement lines, making the relative paths of -c
+    and -f absolute.
+    """
+    path = os.path.abspath(path)
+    if seen is None:
+        seen = []
+    if path in seen:
+        return
+    seen.append(path)
+
+    try:
+        f = open(path)
+        try:
+            content = f.read()
+        finally:
+            f.close()
+    except IOError:
+        module.fail_json(msg="Unable to read requirements file %s: %s" % (path, str(sys.exc_info()[1])))
+
+    base = os.path.dirname(path)
+    for line in content.replace('\\\n', ' ').splitlines():
+        if line.lstrip().startswith('#'):
+            continue
+        line = re.sub(r'(^|\s)#.*$', '', line).strip()
+        if not line:
+            continue
+        # pip takes these paths relative to the file they are in
+        m = re.match(r'(-r|--requirement|-c|--constraint|-f|--find-links)(?:\s*=?\s*)(\S+)$', line)
+        if m and '://' in m.group(2):
+            if m.group(1) in ('-r', '--requirement'):
+                # cannot be flattened, so always goes to pip
+                reqs.append(line)
+            else:
+                options.append(line)
+        elif m:
+            included = os.path.join(base, os.path.expanduser(m.group(2)))
+            if m.group(1) in ('-r', '--requirement'):
+                _read_requirements(module, included, options, reqs, seen)
+            else:
+                options.append('%s %s' % (m.group(1), os.path.abspath(included)))
+        elif line.startswith('-') and not re.match(r'(-e|--editable)\b', line):
+            options.append(line)
+        else:
+            reqs.append(line)
+
 
-        if pkg_name == name and (version is None or version == pkg_version):
-            return True
+def _version_key(version):
+    if not re.match(r'\d+(\.\d+)*$', version):
+        return None
+    key = [int(part) for part in version.split('.')]
+    while len(key) > 1 and key[-1] == 0:
+        key.pop()
+    return key
 
-    return False
 
+def _requirement_spec(line):
+    """ A requirement line without its per-requirement options such as --hash """
+    return line.split(' --', 1)[0].strip()
+
+
+def _write_temp_requirements(lines):
+    fd, path = tempfile.mkstemp(prefix='ansible-pip-', suffix='.txt')
+    f = os.fdopen(fd, 'w')
+    try:
+        f.write('\n'.join(lines) + '\n')
+    finally:
+        f.close()
+    return path
+
+
+def _requirement_satisfied(line, installed_pkgs):
+    """
+    Whether the installed distributions satisfy a requirement line. Only
+    plain names with ==, !=, <, <=, > and >= on numeric versions are
+    judged, everything else (extras, markers, URLs, editables) is left to
+    pip.
+    """
+    line = _requirement_spec(line)
+    m = re.match(r'([A-Za-z0-9][A-Za-z0-9._-]*)\s*(.*)$', line)
+    if not m or re.search(r'[\[;@/:~*]', line):
+        return False
+    key = _canonical_name(m.group(1))
+    if key not in installed_pkgs:
+        return False
+
+    installed = installed_pkgs[key]
+    specs = m.group(2).strip()
+    if not specs:
+        return True
+    for spec in specs.split(','):
+        sm = re.match(r'\s*(==|!=|<=|>=|<|>)\s*(\S+)\s*$', spec)
+        if not sm:
+            return False
+        op, wanted = sm.groups()
+        if op == '==' and installed == wanted:
+            continue
+        have = _version_key(installed)
+        want = _version_key(wanted)
+        if have is None or want is None:
+            return False
+        if not {'==': have == want, '!=': have != want,
+                '<': have < want, '<=': have <= want,
+                '>': have > want, '>=': have >= want}[op]:
+            return False
+    return True
+
+
+def _diff_requirements(module, path, installed_pkgs):
+    """
+    Split a requirements file into its options, the requirement lines the
+    installed distributions do not satisfy, and the ones they do, stripped
+    of their per-requirement options for use as constraints.
+    """
+    options = []
+    reqs = []
+    _read_requirements(module, path, options, reqs)
+    unsatisfied = []
+    satisfied = []
+    for line in reqs:
+        if _requirement_satisfied(line, installed_pkgs):
+            satisfied.append(_requirement_spec(line))
+        else:
+            unsatisfied.append(line)
+    return options, unsatisfied, satisfied
 
 
 def _get_pip(module, env=None, executable=None):
@@ -264,7 +625,7 @@ def main():
     module = AnsibleModule(
         argument_spec=dict(
             state=dict(default='present', choices=state_map.keys()),
-            name=dict(default=None, required=False),
+            name=dict(default=None, required=False, type='raw'),
             version=dict(default=None, required=False, type='str'),
             requirements=dict(default=None, required=False),
             virtualenv=dict(default=None, required=False),
@@ -277,6 +638,8 @@ def main():
             chdir=dict(default=None, required=False, type='path'),
             executable=dict(default=None, required=False),
             umask=dict(required=False,default=None),
+            requirements_diff=dict(default='no', type='bool'),
+            cache_dir=dict(default=None, required=False, type='path'),
         ),
         required_one_of=[['name', 'requirements']],
         mutually_exclusive=[['name', 'requirements'], ['executable', 'virtualenv']],
@@ -284,7 +647,7 @@ def main():
     )
 
     state = module.params['state']
-    name = module.params['name']
+    name = _split_names(module.params['name'])
     version = module.params['version']
     requirements = module.params['requirements']
     extra_args = module.params['extra_args']
@@ -303,9 +666,12 @@ def main():
     old_umask = None
     if umask != None:
         old_umask = os.umask(umask)
+    tmp_requirements = []
     try:
         if state == 'latest' and version is not None:
             module.fail_json(msg='version is incompatible with state=latest')
+        if name and len(name) > 1 and version is not None:
+            module.fail_json(msg='version is ambiguous with several names, put the version constraints in name instead')
 
         if chdir is None:
             # this is done to avoid permissions issues with privilege escalation and virtualenvs
@@ -360,7 +726,10 @@ def main():
 
         # Automatically apply -e option to extra_args when source is a VCS url. VCS
         # includes those beginning with svn+, git+, hg+ or bzr+
-        has_vcs = bool(name and re.match(r'(svn|git|hg|bzr)\+', name))
+        has_vcs = False
+        for pkg in name or []:
+            if re.match(r'(svn|git|hg|bzr)\+', pkg):
+                has_vcs = True
         if has_vcs and module.params['editable']:
             args_list = []  # used if extra_args is not used at all
             if extra_args:
@@ -370,13 +739,36 @@ def main():
                 # Ok, we will reconstruct the option string
                 extra_args = ' '.join(args_list)
 
+        site_dirs = _site_packages(module, pip, env)
+
+        # Hand pip only the requirements the environment does not already meet
+        requirements_file = requirements
+        if requirements and module.params['requirements_diff'] and state == 'present':
+            installed_pkgs = _get_packages(module, pip, chdir, site_dirs)[3]
+            if installed_pkgs is not None:
+                options, unsatisfied, satisfied = _diff_requirements(module, os.path.join(chdir, requirements), installed_pkgs)
+                if not unsatisfied:
+                    module.exit_json(changed=False, name=module.params['name'], version=version,
+                                     state=state, requirements=requirements, virtualenv=env,
+                                     stdout=out, stderr=err)
+                if module.check_mode:
+                    module.exit_json(changed=True)
+
+                # The lines already met stay pins as constraints, so that
+                # what the unmet lines pull in cannot move them
+                if satisfied:
+                    constraints_file = _write_temp_requirements(satisfied)
+                    tmp_requirements.append(constraints_file)
+                    options.append('-c %s' % constraints_file)
+                requirements_file = _write_temp_requirements(options + unsatisfied)
+                tmp_requirements.append(requirements_file)
+
         if extra_args:
             cmd += ' %s' % extra_args
-        if name:
-            cmd += ' %s' % _get_full_name(name, version)
-        elif requirements:
-            cmd += ' -r %s' % requirements
-
+        if module.params['cache_dir'] and state != 'absent':
+            cmd += ' --cache-dir %s' % module.params['cache_dir']
+        if requirements:
+            cmd += ' -r %s' % requirements_file
 
         if module.check_mode:
             if extra_args or requirements or state == 'latest' or not name:
@@ -384,26 +776,33 @@ def main():
             elif has_vcs:
                 module.exit_json(changed=True)
 
-            freeze_cmd = '%s freeze' % pip
+            freeze_cmd, out_pip, err_pip, installed_pkgs = _get_packages(module, pip, chdir, site_dirs)
 
-            rc, out_pip, err_pip = module.run_command(freeze_cmd, cwd=chdir)
-
-            if rc != 0:
+            if installed_pkgs is None:
                 module.exit_json(changed=True)
 
             out += out_pip
             err += err_pip
 
-            is_present = _is_present(name, version, out.split())
-
-            changed = (state == 'present' and not is_present) or (state == 'absent' and is_present)
+            changed = state in ('present', 'absent') and bool(_pending(name, version, state, installed_pkgs))
             module.exit_json(changed=changed, cmd=freeze_cmd, stdout=out, stderr=err)
 
-        if requirements or has_vcs:
-            freeze_cmd = '%s freeze' % pip
-            out_freeze_before = module.run_command(freeze_cmd, cwd=chdir)[1]
-        else:
-            out_freeze_before = None
+        # Plain names already (un)installed need no pip run, and knowing
+        # which they are does not need pip either
+        packages = name
+        if name and not has_vcs and not extra_args and site_dirs is not None \
+                and state in ('present', 'absent'):
+            packages = _pending(name, version, state, _installed_distributions(site_dirs))
+            if not packages:
+                module.exit_json(changed=False, name=module.params['name'], version=version,
+                                 state=state, requirements=requirements, virtualenv=env,
+                                 stdout=out, stderr=err)
+        if packages:
+            cmd += ' %s' % ' '.join([_get_full_name(pkg, version) for pkg in packages])
+
+        track_changes = requirements or has_vcs
+        if track_changes:
+            installed_before = _get_packages(module, pip, chdir, site_dirs)[3]
 
         rc, out_pip, err_pip = module.run_command(cmd, path_prefix=path_prefix, cwd=chdir)
         out += out_pip
@@ -416,24 +815,23 @@ def main():
 
         if state == 'absent':
             changed = 'Successfully uninstalled' in out_pip
+        elif not track_changes:
+            changed = 'Successfully installed' in out_pip
         else:
-            if out_freeze_before is None:
-                changed = 'Successfully installed' in out_pip
-            else:
-                if out_freeze_before is None:
-                    changed = 'Successfully installed' in out_pip
-                else:
-                    out_freeze_after = module.run_command(freeze_cmd, cwd=chdir)[1]
-                    changed = out_freeze_before != out_freeze_after
+            installed_after = _get_packages(module, pip, chdir, site_dirs)[3]
+            changed = installed_before != installed_after
 
-        module.exit_json(changed=changed, cmd=cmd, name=name, version=version,
+        module.exit_json(changed=changed, cmd=cmd, name=module.params['name'], version=version,
                          state=state, requirements=requirements, virtualenv=env,
                          stdout=out, stderr=err)
     finally:
         if old_umask != None:
             os.umask(old_umask)
+        for path in tmp_requirements:
+            os.remove(path)
 
 # import module snippets
 from ansible.module_utils.basic import *
 
-main()
+if __name__ == '__main__':
+    main()
@@ -194,9 +194,16 @@ import warnings
 warnings.filterwarnings('ignore', "apt API not stable yet", FutureWarning)
 
 import os
+import bisect
 import datetime
 import fnmatch
 import itertools
+import tempfile
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
 # APT related constants
 APT_ENV_VARS = dict(
@@ -215,6 +222,12 @@ APT_GET_ZERO = "\n0 upgraded, 0 newly installed"
 APTITUDE_ZERO = "\n0 packages upgraded, 0 newly installed"
 APT_LISTS_PATH = "/var/lib/apt/lists"
 APT_UPDATE_SUCCESS_STAMP_PATH = "/var/lib/apt/periodic/update-success-stamp"
+DPKG_STATUS_PATH = "/var/lib/dpkg/status"
+# a single file, rewritten whenever pkgcache.bin changes and never removed by apt
+APT_NAME_INDEX_PATH = "/var/lib/apt/ansible-package-names.json"
+
+# the PackageNameIndex of this run, built on the first wildcard
+package_name_index = None
 
 HAS_PYTHON_APT = True
 try:
@@ -333,6 +346,97 @@ def expand_dpkg_options(dpkg_options_compressed):
                        % (dpkg_options, dpkg_option)
     return dpkg_options.strip()
 
+class PackageNameIndex(object):
+    """
+    The names of all packages with versions in the apt cache, sorted, so a
+    pattern with a literal prefix only has to be matched against the names
+    sharing that prefix.  Kept as JSON next to the apt lists for as long as
+    pkgcache.bin does not change.
+    """
+
+    def __init__(self, m, cache):
+        self.m = m
+        try:
+            pkgcache = apt_pkg.config.find_file('Dir::Cache::pkgcache')
+        except AttributeError:
+            pkgcache = apt_pkg.Config.FindFile('Dir::Cache::pkgcache')
+        try:
+            st = os.stat(pkgcache)
+            version = [st.st_mtime, st.st_size]
+        except OSError:
+            version = None
+
+        self.names = None
+        if version is not None:
+            self.names = self.load(version)
+        if self.names is None:
+            self.names = self.build(cache)
+            if version is not None and not m.check_mode:
+                self.save(version)
+        self.native = [name for name in self.names if ':' not in name]
+
+    def load(self, version):
+        try:
+            f = open(APT_NAME_INDEX_PATH)
+            try:
+                data = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return None
+        if not isinstance(data, dict) or data.get('pkgcache') != version:
+            return None
+        return data.get('names')
+
+    def build(self, cache):
+        names = []
+        try:
+            for pkg in cache._cache.packages:
+                if pkg.has_versions:
+                    names.append(pkg.get_fullname(True))
+        except AttributeError:
+            # python-apt without get_fullname, let apt.Cache name them
+            names = cache.keys()
+        names.sort()
+        return names
+
+    def save(self, version):
+        tempname = None
+        try:
+            fd, tempname = tempfile.mkstemp(dir=os.path.dirname(APT_NAME_INDEX_PATH))
+            f = os.fdopen(fd, 'w')
+            try:
+                json.dump(dict(pkgcache=version, names=self.names), f)
+            finally:
+                f.close()
+            os.chmod(tempname, 0644)
+            os.rename(tempname, APT_NAME_INDEX_PATH)
+        except (IOError, OSError, TypeError, ValueError):
+            # without the file the next run builds the index again
+            if tempname is not None:
+                try:
+                    os.unlink(tempname)
+                except OSError:
+                    pass
+
+    def match(self, pattern, multiarch):
+        if multiarch:
+            names = self.names
+        else:
+            names = self.native
+
+        prefix = re.split(r'[*?\[]', pattern, 1)[0]
+        if not prefix:
+            return fnmatch.filter(names, pattern)
+
+        matches = []
+        for i in xrange(bisect.bisect_left(names, prefix), len(names)):
+            if not names[i].startswith(prefix):
+                break
+            if fnmatch.fnmatch(names[i], pattern):
+                matches.append(names[i])
+        return matches
+
 def expand_pkgspec_from_fnmatches(m, pkgspec, cache):
     # Note: apt-get does implicit regex matching when an exact package name
     # match is not found.  Something like this:
@@ -342,25 +446,18 @@ def expand_pkgspec_from_fnmatches(m, pkgspec, cache):
     # We have decided not to do similar implicit regex matching but might take
     # a PR to add some sort of explicit regex matching:
     # https://github.com/ansible/ansible-modules-core/issues/1258
+    global package_name_index
     new_pkgspec = []
     for pkgspec_pattern in pkgspec:
         pkgname_pattern, version = package_split(pkgspec_pattern)
 
         # note that none of these chars is allowed in a (debian) pkgname
         if frozenset('*?[]!').intersection(pkgname_pattern):
+            if package_name_index is None:
+                package_name_index = PackageNameIndex(m, cache)
             # handle multiarch pkgnames, the idea is that "apt*" should
             # only select native packages. But "apt*:i386" should still work
-            if not ":" in pkgname_pattern:
-                try:
-                    pkg_name_cache = _non_multiarch
-                except NameError:
-                    pkg_name_cache = _non_multiarch = [pkg.name for pkg in cache if not ':' in pkg.name]
-            else:
-                try:
-                    pkg_name_cache = _all_pkg_names
-                except NameError:
-                    pkg_name_cache = _all_pkg_names = [pkg.name for pkg in cache]
-            matches = fnmatch.filter(pkg_name_cache, pkgname_pattern)
+            matches = package_name_index.match(pkgname_pattern, ":" in pkgname_pattern)
 
             if len(matches) == 0:
                 m.fail_json(msg="No package(s) matching '%s' available" % str(pkgname_pattern))
@@ -371,6 +468,72 @@ def expand_pkgspec_from_fnmatches(m, pkgspec, cache):
             new_pkgspec.append(pkgspec_pattern)
     return new_pkgspec
 
+def dpkg_installed(names):
+    """
+    Stream through the dpkg status file and return {(name, arch): version}
+    for the installed packages among names.
+    """
+    try:
+        status_path = apt_pkg.config.find_file('Dir::State::status')
+    except AttributeError:
+        status_path = DPKG_STATUS_PATH
+
+    installed = {}
+    fields = {}
+    f = open(status_path)
+    try:
+        for line in itertools.chain(f, ['\n']):
+            if line == '\n':
+                if fields.get('package') in names and fields.get('status', '').split()[-1:] == ['installed']:
+                    installed[(fields['package'], fields.get('architecture'))] = fields.get('version')
+                fields = {}
+            elif line[0] not in ' \t' and ':' in line:
+                field, value = line.split(':', 1)
+                field = field.lower()
+                if field in ('package', 'status', 'architecture', 'version'):
+                    fields[field] = value.strip()
+    finally:
+        f.close()
+    return installed
+
+def installed_per_dpkg_status(m, packages):
+    """
+    Whether the dpkg status file alone shows every package of a state=present
+    list as installed, for lists of plain names and exact name=version specs.
+    Anything else is for the apt cache to decide.
+    """
+    specs = []
+    for package in packages:
+        name, version = package_split(package)
+        if package.count('=') > 1 or frozenset('*?[]!').intersection(package):
+            return False
+        arch = None
+        if ':' in name:
+            name, arch = name.split(':', 1)
+        specs.append((name, arch, version))
+
+    try:
+        native = apt_pkg.config.find('APT::Architecture')
+    except AttributeError:
+        native = apt_pkg.Config.Find('APT::Architecture')
+    try:
+        installed = dpkg_installed(set([name for name, arch, version in specs]))
+    except IOError:
+        return False
+
+    for name, arch, version in specs:
+        if arch is None:
+            archs = (native, 'all')
+        else:
+            archs = (arch,)
+        found = False
+        for a in archs:
+            if (name, a) in installed and (version is None or installed[(name, a)] == version):
+                found = True
+        if not found:
+            return False
+    return True
+
 def parse_diff(output):
     diff = output.splitlines()
     try:
@@ -477,17 +640,33 @@ def get_field_of_deb(m, deb_file, field="Version"):
         m.fail_json(msg="%s failed" % cmd, stdout=stdout, stderr=stderr)
     return stdout.strip('\n')
 
+def deb_control_field(m, pkg, deb_file, field):
+    try:
+        # the control data DebPackage has already read
+        return pkg[field]
+    except (KeyError, AttributeError, TypeError):
+        # python-apt before 0.7.9 has no access to it
+        return get_field_of_deb(m, deb_file, field)
+
 def install_deb(m, debs, cache, force, install_recommends, allow_unauthenticated, dpkg_options):
     changed=False
     deps_to_install = []
     pkgs_to_install = []
+    # read every deb against the one cache of the run instead of opening a
+    # cache for each, the marks a check leaves are cleared after it
+    to_check = []
+    deb_names = set()
     for deb_file in debs.split(','):
         try:
-            pkg = apt.debfile.DebPackage(deb_file)
-            pkg_name = get_field_of_deb(m, deb_file, "Package")
-            pkg_version = get_field_of_deb(m, deb_file, "Version")
             try:
-                installed_pkg = apt.Cache()[pkg_name]
+                pkg = apt.debfile.DebPackage(deb_file, cache=cache)
+            except TypeError:
+                # python-apt too old to take a cache
+                pkg = apt.debfile.DebPackage(deb_file)
+            pkg_name = deb_control_field(m, pkg, deb_file, "Package")
+            pkg_version = deb_control_field(m, pkg, deb_file, "Version")
+            try:
+                installed_pkg = cache[pkg_name]
                 installed_version = installed_pkg.installed.version
                 if package_version_compare(pkg_version, installed_version) == 0:
                     # Does not need to down-/upgrade, move on to next package
@@ -495,13 +674,27 @@ def install_deb(m, debs, cache, force, install_recommends, allow_unauthenticated
             except Exception, e:
                 # Must not be installed, continue with installation
                 pass
+        except Exception:
+            e = get_exception()
+            m.fail_json(msg="Unable to install package: %s" % str(e))
+        to_check.append((deb_file, pkg))
+        deb_names.add(pkg_name)
+
+    for deb_file, pkg in to_check:
+        try:
             # Check if package is installable
             if not pkg.check() and not force:
                 m.fail_json(msg=pkg._failure_string)
 
-            # add any missing deps to the list of deps we need
-            # to install so they're all done in one shot
-            deps_to_install.extend(pkg.missing_deps)
+            # add any missing deps to the list of deps we need to install
+            # so they're all done in one shot, leaving out the ones that
+            # are among the debs themselves
+            for dep in pkg.missing_deps:
+                if dep not in deb_names and dep not in deps_to_install:
+                    deps_to_install.append(dep)
+            # the dependencies check() marked would otherwise be part of
+            # what install() and the next check see
+            cache.clear()
 
         except Exception:
             e = get_exception()
@@ -730,6 +923,13 @@ def main():
     if p['state'] == 'removed':
         p['state'] = 'absent'
 
+    # Opening the cache is the expensive part of a run, a list of packages
+    # that dpkg already has installed needs none of it
+    if p['state'] == 'present' and p['package'] and not p['update_cache'] \
+            and not p['upgrade'] and not p['deb']:
+        if installed_per_dpkg_status(module, p['package']):
+            module.exit_json(changed=False, cache_updated=False, cache_update_time=0)
+
     try:
         cache = apt.Cache()
         if p['default_release']:
@@ -22,11 +22,17 @@
 #
 
 import os
+import fnmatch
 import yum
 import rpm
 import platform
 import tempfile
 import shutil
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
 from distutils.version import LooseVersion
 
 try:
@@ -115,6 +121,19 @@ options:
     choices: ["yes", "no"]
     aliases: []
 
+  rpmdb_snapshot:
+    description:
+      - Keep a snapshot of the installed packages and their provides in the
+        yum cache dir, and answer from it whether the packages of
+        I(state=present) are already installed, before going to yum for the
+        rest. The snapshot is rebuilt whenever the Packages file of the rpmdb
+        changes size or mtime. Names with wildcards, versions or file paths
+        always go to yum.
+    required: false
+    version_added: "2.1"
+    default: "no"
+    choices: ["yes", "no"]
+
   validate_certs:
     description:
       - This only applies if using a https url as the source of the rpm. e.g. for localinstall. If set to C(no), the SSL certificates will not be validated.
@@ -179,6 +198,9 @@ EXAMPLES = '''
 - name: install the 'Development tools' package group
   yum: name="@Development tools" state=present
 
+- name: install a long list of base packages, checking the installed ones from a snapshot
+  yum: name={{ base_packages }} state=present rpmdb_snapshot=yes
+
 - name: install the 'Gnome desktop' environment group
   yum: name="@^gnome-desktop-environment" state=present
 '''
@@ -207,6 +229,357 @@ def yum_base(conf_file=None):
 
     return my
 
+def po_names(po):
+    """the names a package can be asked for by, the forms yum's parsePackages() matches"""
+
+    return [po.name,
+            '%s.%s' % (po.name, po.arch),
+            '%s-%s' % (po.name, po.version),
+            '%s-%s-%s' % (po.name, po.version, po.release),
+            '%s-%s-%s.%s' % (po.name, po.version, po.release, po.arch),
+            '%s:%s-%s-%s.%s' % (po.epoch, po.name, po.version, po.release, po.arch),
+            '%s-%s:%s-%s.%s' % (po.name, po.epoch, po.version, po.release, po.arch)]
+
+def match_specs(pkgs, specs):
+    """map each of specs to the packages of pkgs it names, wildcards allowed"""
+
+    matches = {}
+    plain = {}
+    globs = []
+    for spec in specs:
+        matches[spec] = []
+        if set(['*', '?', '[']).intersection(set(spec)):
+            globs.append(spec)
+        else:
+            plain[spec] = True
+
+    for po in pkgs:
+        names = po_names(po)
+        for spec in specs:
+            if spec in plain:
+                if spec in names:
+                    matches[spec].append(po)
+            else:
+                for name in names:
+                    if fnmatch.fnmatchcase(name, spec):
+                        matches[spec].append(po)
+                        break
+    return matches
+
+class YumCache(object):
+    """
+    One YumBase for every lookup of the run with a given conf_file and repo
+    setup, so the rpmdb and the repo metadata are loaded once, and what was
+    looked up in them is remembered.
+    """
+
+    def __init__(self, my):
+        self.my = my
+        self.installed = {}
+        self.installed_deps = {}
+        self.available = {}
+        self.available_deps = {}
+        self.provides = {}
+        self.updates = None
+
+    def match_installed(self, specs):
+        """packages in the rpmdb matching each of specs, found with one matchPackageNames()"""
+
+        missing = [spec for spec in specs if spec not in self.installed]
+        if missing:
+            e, m, u = self.my.rpmdb.matchPackageNames(missing)
+            self.installed.update(match_specs(e + m, missing))
+        return dict([(spec, self.installed[spec]) for spec in specs])
+
+    def match_available(self, specs):
+        """packages in the enabled repos matching each of specs, found with one matchPackageNames()"""
+
+        missing = [spec for spec in specs if spec not in self.available]
+        if missing:
+            e, m, u = self.my.pkgSack.matchPackageNames(missing)
+            self.available.update(match_specs(e + m, missing))
+        return dict([(spec, self.available[spec]) for spec in specs])
+
+    def installed_by_dep(self, spec):
+        if spec not in self.installed_deps:
+            self.installed_deps[spec] = self.my.returnInstalledPackagesByDep(spec)
+        return self.installed_deps[spec]
+
+    def available_by_dep(self, spec):
+        if spec not in self.available_deps:
+            self.available_deps[spec] = self.my.returnPackagesByDep(spec)
+        return self.available_deps[spec]
+
+    def update_list(self):
+        if self.updates is None:
+            self.updates = self.my.doPackageLists(pkgnarrow='updates').updates
+        return self.updates
+
+    def forget_installed(self):
+        """drop all that came from the rpmdb, before a transaction changes it"""
+
+        self.my.closeRpmDB()
+        self.installed = {}
+        self.installed_deps = {}
+        self.provides = {}
+        self.updates = None
+
+# YumCache objects of this run per (conf_file, enabled repos, disabled repos)
+yum_caches = {}
+
+def yum_cache(conf_file, en_repos=None, dis_repos=None):
+    if en_repos is None:
+        en_repos = []
+    if dis_repos is None:
+        dis_repos = []
+
+    key = (conf_file, tuple(en_repos), tuple(dis_repos))
+    if key not in yum_caches:
+        my = yum_base(conf_file)
+        for rid in dis_repos:
+            my.repos.disableRepo(rid)
+        for rid in en_repos:
+            my.repos.enableRepo(rid)
+        yum_caches[key] = YumCache(my)
+    return yum_caches[key]
+
+def forget_installed():
+    """called before running a yum transaction, which leaves every rpmdb lookup stale"""
+
+    for cache in yum_caches.values():
+        cache.forget_installed()
+    rpm_answers.clear()
+
+# rpm and repoquery answers of this run, see rpm_query() and repoquery_names()
+rpm_answers = {}
+repoquery_answers = {}
+repoquery_provides = {}
+
+# rpm -q reports on its arguments in order, so an argument that never matches
+# put after each spec marks where the answer for that spec ends
+RPM_SEPARATOR = 'ansible-yum-query-separator'
+
+def rpm_query(module, specs, whatprovides=False, qf=def_qf):
+    """
+    rpm -q, or rpm -q --whatprovides, for all specs in one process.
+    Return a dict mapping each spec to the packages it matched, formatted with qf.
+    """
+
+    global rpmbin
+    if not rpmbin:
+        rpmbin = module.get_bin_path('rpm', required=True)
+    if not qf.endswith('\n'):
+        qf += '\n'
+
+    missing = []
+    for spec in specs:
+        if (whatprovides, qf, spec) not in rpm_answers and spec not in missing:
+            missing.append(spec)
+    # rpm options such as -a take no separators, they get a process each
+    batches = [[spec] for spec in missing if spec.startswith('-')]
+    plain = [spec for spec in missing if not spec.startswith('-')]
+    if plain:
+        batches.append(plain)
+
+    # rpm localizes messages and we're screen scraping so make sure we use
+    # the C locale
+    lang_env = dict(LANG='C', LC_ALL='C', LC_MESSAGES='C')
+    for batch in batches:
+        cmd = [rpmbin, '-q', '--qf', qf]
+        if whatprovides:
+            cmd.append('--whatprovides')
+        separated = not batch[0].startswith('-')
+        for i, spec in enumerate(batch):
+            cmd.append(spec)
+            if separated:
+                cmd.append('%s-%d' % (RPM_SEPARATOR, i))
+
+        rc, out, err = module.run_command(cmd, environ_update=lang_env)
+        if rc != 0 and 'is not installed' not in out and 'no package provides' not in out:
+            module.fail_json(msg='Error from rpm: %s: %s' % (cmd, err))
+
+        answers = [[]]
+        for line in out.replace('(none)', '0').split('\n'):
+            if RPM_SEPARATOR in line:
+                answers.append([])
+            elif line.strip() and 'is not installed' not in line and 'no package provides' not in line:
+                answers[-1].append(line)
+        if separated and len(answers) != len(batch) + 1:
+            module.fail_json(msg='Unexpected output from rpm: %s: %s' % (cmd, out + err))
+        for i, spec in enumerate(batch):
+            rpm_answers[(whatprovides, qf, spec)] = answers[i]
+
+    return dict([(spec, rpm_answers[(whatprovides, qf, spec)]) for spec in specs])
+
+class QueriedPackage(object):
+    """a package as repoquery described it, with what po_names() needs"""
+
+    def __init__(self, line):
+        self.name, self.epoch, self.version, self.release, self.arch = line.split('|')
+
+    def format(self, qf):
+        for tag in ('name', 'epoch', 'version', 'release', 'arch'):
+            qf = qf.replace('%%{%s}' % tag, getattr(self, tag))
+        return qf
+
+def repoquery_cmd(repoq, en_repos, dis_repos):
+    myrepoq = list(repoq)
+    myrepoq.extend(['--disablerepo', ','.join(dis_repos)])
+    myrepoq.extend(['--enablerepo', ','.join(en_repos)])
+    return myrepoq
+
+def repoquery_names(module, repoq, specs, en_repos, dis_repos, qf=def_qf):
+    """
+    The packages of the repos each of specs names, from one repoquery process
+    for all of them. Return a dict mapping each spec to packages formatted with qf.
+    """
+
+    repos = (tuple(en_repos), tuple(dis_repos))
+    missing = []
+    for spec in specs:
+        if (repos, spec) not in repoquery_answers and spec not in missing:
+            missing.append(spec)
+
+    if missing:
+        cmd = repoquery_cmd(repoq, en_repos, dis_repos) + ['--qf', '%{name}|%{epoch}|%{version}|%{release}|%{arch}'] + missing
+        rc, out, err = module.run_command(cmd)
+        if rc != 0:
+            module.fail_json(msg='Error from repoquery: %s: %s' % (cmd, err))
+        pkgs = [QueriedPackage(line) for line in out.split('\n') if line.count('|') == 4]
+        for spec, matched in match_specs(pkgs, missing).items():
+            repoquery_answers[(repos, spec)] = matched
+
+    result = {}
+    for spec in specs:
+        result[spec] = [po.format(qf) for po in repoquery_answers[(repos, spec)]]
+    return result
+
+def prefetch_installed(module, repoq, specs, conf_file, en_repos, dis_repos, is_pkg=False):
+    """
+    Look up in one go what is_installed() will be asked about specs, so that
+    each of those calls is answered from memory.
+    """
+
+    if not specs:
+        return
+    if not repoq:
+        try:
+            cache = yum_cache(conf_file, en_repos, dis_repos)
+            cache.match_installed(specs)
+        except Exception, e:
+            module.fail_json(msg="Failure talking to yum: %s" % e)
+        return
+
+    installed = rpm_query(module, specs)
+    if not is_pkg:
+        rpm_query(module, [spec for spec in specs if not installed[spec]], whatprovides=True)
+
+def prefetch_provides(module, repoq, specs, en_repos, dis_repos):
+    """repoquery for what the repos call each of specs, one process for all of them"""
+
+    if repoq and specs:
+        repoquery_names(module, repoq, specs, en_repos, dis_repos)
+
+def rpmdb_version():
+    """(mtime, size) of the rpmdb file that changes with every transaction, None if not found"""
+
+    dbpath = rpm.expandMacro('%{_dbpath}')
+    for name in ('Packages', 'rpmdb.sqlite'):
+        try:
+            st = os.stat(os.path.join(dbpath, name))
+        except OSError:
+            continue
+        return [st.st_mtime, st.st_size]
+    return None
+
+class InstalledSnapshot(object):
+    """
+    The installed packages and what they provide, read from the rpm headers
+    and kept as JSON in the yum cache dir while the rpmdb stays unchanged.
+    File provides are left out, they fall back to the yum lookups.
+    """
+
+    def __init__(self, module, cachedir):
+        self.module = module
+        self.path = os.path.join(cachedir, 'ansible-installed.json')
+        self.names = {}
+        self.provides = {}
+
+        version = rpmdb_version()
+        data = None
+        try:
+            f = open(self.path)
+            try:
+                data = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            pass
+        if not isinstance(data, dict) or data.get('version') != 1 or version is None or data.get('rpmdb') != version:
+            data = self.build(version)
+            if not module.check_mode and version is not None:
+                self.save(data)
+
+        for n, e, v, r, a in data['packages']:
+            po = QueriedPackage('|'.join((n, e, v, r, a)))
+            for name in po_names(po):
+                self.names.setdefault(name, []).append(po)
+        for cap in data['provides']:
+            self.provides[cap] = True
+
+    def build(self, version):
+        packages = []
+        provides = {}
+        ts = rpm.TransactionSet()
+        for hdr in ts.dbMatch():
+            epoch = hdr[rpm.RPMTAG_EPOCH]
+            if epoch is None:
+                epoch = 0
+            packages.append([hdr[rpm.RPMTAG_NAME], str(epoch), hdr[rpm.RPMTAG_VERSION],
+                             hdr[rpm.RPMTAG_RELEASE], hdr[rpm.RPMTAG_ARCH]])
+            for cap in hdr[rpm.RPMTAG_PROVIDENAME] or []:
+                if not cap.startswith('/'):
+                    provides[cap] = True
+        return dict(version=1, rpmdb=version, packages=packages, provides=list(provides.keys()))
+
+    def save(self, data):
+        try:
+            fd, tempname = tempfile.mkstemp(dir=os.path.dirname(self.path))
+            f = os.fdopen(fd, 'w')
+            try:
+                json.dump(data, f)
+            finally:
+                f.close()
+            os.rename(tempname, self.path)
+        except (IOError, OSError):
+            # without a snapshot on disk the next run only builds it again
+            pass
+
+    def answers(self, spec):
+        """whether spec is something the snapshot can tell is installed or not"""
+
+        return not set(['*', '?', '[', ' ', '<', '>', '=', '/']).intersection(set(spec))
+
+    def installed(self, spec):
+        """the nevras spec names, like is_installed(is_pkg=True)"""
+
+        return [po.format(def_qf) for po in self.names.get(spec, [])]
+
+    def provided(self, spec):
+        return spec in self.provides
+
+def installed_snapshot(module, conf_file):
+    """the InstalledSnapshot kept in the cache dir of yum, None if it cannot be had"""
+
+    try:
+        cachedir = yum_cache(conf_file).my.conf.cachedir
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        return InstalledSnapshot(module, cachedir)
+    except Exception:
+        # the snapshot only saves time, yum still has the answers
+        return None
+
 def ensure_yum_utils(module):
 
     repoquerybin = module.get_bin_path('repoquery', required=False)
@@ -235,48 +608,19 @@ def is_installed(module, repoq, pkgspec, conf_file, qf=def_qf, en_repos=None, di
     if not repoq:
         pkgs = []
         try:
-            my = yum_base(conf_file)
-            for rid in dis_repos:
-                my.repos.disableRepo(rid)
-            for rid in en_repos:
-                my.repos.enableRepo(rid)
-
-            e, m, u = my.rpmdb.matchPackageNames([pkgspec])
-            pkgs = e + m
+            cache = yum_cache(conf_file, en_repos, dis_repos)
+            pkgs = list(cache.match_installed([pkgspec])[pkgspec])
             if not pkgs and not is_pkg:
-                pkgs.extend(my.returnInstalledPackagesByDep(pkgspec))
+                pkgs.extend(cache.installed_by_dep(pkgspec))
         except Exception, e:
             module.fail_json(msg="Failure talking to yum: %s" % e)
 
         return [ po_to_nevra(p) for p in pkgs ]
 
     else:
-        global rpmbin
-        if not rpmbin:
-            rpmbin = module.get_bin_path('rpm', required=True)
-
-        cmd = [rpmbin, '-q', '--qf', qf, pkgspec]
-        # rpm localizes messages and we're screen scraping so make sure we use
-        # the C locale
-        lang_env = dict(LANG='C', LC_ALL='C', LC_MESSAGES='C')
-        rc, out, err = module.run_command(cmd, environ_update=lang_env)
-        if rc != 0 and 'is not installed' not in out:
-            module.fail_json(msg='Error from rpm: %s: %s' % (cmd, err))
-        if 'is not installed' in out:
-            out = ''
-
-        pkgs = [p for p in out.replace('(none)', '0').split('\n') if p.strip()]
+        pkgs = list(rpm_query(module, [pkgspec], qf=qf)[pkgspec])
         if not pkgs and not is_pkg:
-            cmd = [rpmbin, '-q', '--qf', qf, '--whatprovides', pkgspec]
-            rc2, out2, err2 = module.run_command(cmd, environ_update=lang_env)
-        else:
-            rc2, out2, err2 = (0, '', '')
-
-        if rc2 != 0 and 'no package provides' not in out2:
-            module.fail_json(msg='Error from rpm: %s: %s' % (cmd, err + err2))
-        if 'no package provides' in out2:
-            out2 = ''
-        pkgs += [p for p in out2.replace('(none)', '0').split('\n') if p.strip()]
+            pkgs += rpm_query(module, [pkgspec], whatprovides=True, qf=qf)[pkgspec]
         return pkgs
 
     return []
@@ -291,16 +635,10 @@ def is_available(module, repoq, pkgspec, conf_file, qf=def_qf, en_repos=None, di
 
         pkgs = []
         try:
-            my = yum_base(conf_file)
-            for rid in dis_repos:
-                my.repos.disableRepo(rid)
-            for rid in en_repos:
-                my.repos.enableRepo(rid)
-
-            e,m,u = my.pkgSack.matchPackageNames([pkgspec])
-            pkgs = e + m
+            cache = yum_cache(conf_file, en_repos, dis_repos)
+            pkgs = list(cache.match_available([pkgspec])[pkgspec])
             if not pkgs:
-                pkgs.extend(my.returnPackagesByDep(pkgspec))
+                pkgs.extend(cache.available_by_dep(pkgspec))
         except Exception, e:
             module.fail_json(msg="Failure talking to yum: %s" % e)
             
@@ -337,17 +675,11 @@ def is_update(module, repoq, pkgspec, conf_file, qf=def_qf, en_repos=None, dis_r
         updates = []
 
         try:
-            my = yum_base(conf_file)
-            for rid in dis_repos:
-                my.repos.disableRepo(rid)
-            for rid in en_repos:
-                my.repos.enableRepo(rid)
-
-            pkgs = my.returnPackagesByDep(pkgspec) + my.returnInstalledPackagesByDep(pkgspec)
+            cache = yum_cache(conf_file, en_repos, dis_repos)
+            pkgs = cache.available_by_dep(pkgspec) + cache.installed_by_dep(pkgspec)
             if not pkgs:
-                e,m,u = my.pkgSack.matchPackageNames([pkgspec])
-                pkgs = e + m
-            updates = my.doPackageLists(pkgnarrow='updates').updates 
+                pkgs = cache.match_available([pkgspec])[pkgspec]
+            updates = cache.update_list()
         except Exception, e:
             module.fail_json(msg="Failure talking to yum: %s" % e)
 
@@ -385,45 +717,35 @@ def what_provides(module, repoq, req_spec, conf_file,  qf=def_qf, en_repos=None,
 
         pkgs = []
         try:
-            my = yum_base(conf_file)
-            for rid in dis_repos:
-                my.repos.disableRepo(rid)
-            for rid in en_repos:
-                my.repos.enableRepo(rid)
+            cache = yum_cache(conf_file, en_repos, dis_repos)
+            if req_spec in cache.provides:
+                return set(cache.provides[req_spec])
 
-            pkgs = my.returnPackagesByDep(req_spec) + my.returnInstalledPackagesByDep(req_spec)
+            pkgs = cache.available_by_dep(req_spec) + cache.installed_by_dep(req_spec)
             if not pkgs:
-                e,m,u = my.pkgSack.matchPackageNames([req_spec])
-                pkgs.extend(e)
-                pkgs.extend(m)
-                e,m,u = my.rpmdb.matchPackageNames([req_spec])
-                pkgs.extend(e)
-                pkgs.extend(m)
+                pkgs.extend(cache.match_available([req_spec])[req_spec])
+                pkgs.extend(cache.match_installed([req_spec])[req_spec])
         except Exception, e:
             module.fail_json(msg="Failure talking to yum: %s" % e)
 
-        return set([ po_to_nevra(p) for p in pkgs ])
+        cache.provides[req_spec] = set([ po_to_nevra(p) for p in pkgs ])
+        return set(cache.provides[req_spec])
 
     else:
-        myrepoq = list(repoq)
-        r_cmd = ['--disablerepo', ','.join(dis_repos)]
-        myrepoq.extend(r_cmd)
-
-        r_cmd = ['--enablerepo', ','.join(en_repos)]
-        myrepoq.extend(r_cmd)
-
-        cmd = myrepoq + ["--qf", qf, "--whatprovides", req_spec]
-        rc,out,err = module.run_command(cmd)
-        cmd = myrepoq + ["--qf", qf, req_spec]
-        rc2,out2,err2 = module.run_command(cmd)
-        if rc == 0 and rc2 == 0:
-            out += out2
-            pkgs = set([ p for p in out.split('\n') if p.strip() ])
-            if not pkgs:
-                pkgs = is_installed(module, repoq, req_spec, conf_file, qf=qf)
-            return pkgs
-        else:
-            module.fail_json(msg='Error from repoquery: %s: %s' % (cmd, err + err2))
+        # repoquery lists what provides several specs as one set, so only
+        # the lookup by name can be shared between specs
+        key = ((tuple(en_repos), tuple(dis_repos)), qf, req_spec)
+        if key not in repoquery_provides:
+            cmd = repoquery_cmd(repoq, en_repos, dis_repos) + ["--qf", qf, "--whatprovides", req_spec]
+            rc,out,err = module.run_command(cmd)
+            if rc != 0:
+                module.fail_json(msg='Error from repoquery: %s: %s' % (cmd, err))
+            repoquery_provides[key] = [ p for p in out.split('\n') if p.strip() ]
+
+        pkgs = set(repoquery_provides[key] + repoquery_names(module, repoq, [req_spec], en_repos, dis_repos, qf)[req_spec])
+        if not pkgs:
+            pkgs = is_installed(module, repoq, req_spec, conf_file, qf=qf)
+        return pkgs
 
     return set()
 
@@ -558,6 +880,39 @@ def install(module, items, repoq, yum_basecmd, conf_file, en_repos, dis_repos):
     res['changed'] = False
     tempdir = tempfile.mkdtemp()
 
+    if module.params['rpmdb_snapshot']:
+        snapshot = installed_snapshot(module, conf_file)
+        if snapshot is not None:
+            remaining = []
+            for spec in items:
+                if spec.endswith('.rpm') or '://' in spec or spec.startswith('@') or not snapshot.answers(spec):
+                    remaining.append(spec)
+                    continue
+                installed_pkgs = snapshot.installed(spec)
+                if installed_pkgs:
+                    res['results'].append('%s providing %s is already installed' % (installed_pkgs[0], spec))
+                elif snapshot.provided(spec):
+                    res['results'].append('package providing %s is already installed' % (spec))
+                else:
+                    remaining.append(spec)
+            items = remaining
+
+    # one rpmdb query for every name that is looked up as is below, and
+    # one for each later phase of the loop, for the specs that get there
+    specs = [spec for spec in items if not spec.endswith('.rpm') and '://' not in spec
+             and not spec.startswith('@')]
+    names = [spec for spec in specs if not set(['*', '?']).intersection(set(spec))]
+    prefetch_installed(module, repoq, names, conf_file, en_repos, dis_repos, is_pkg=True)
+    if repoq:
+        installed = rpm_query(module, names)
+        specs = [spec for spec in specs if spec not in installed or not installed[spec]]
+        prefetch_provides(module, repoq, specs, en_repos, dis_repos)
+        provided = []
+        for spec in specs:
+            provided.extend(what_provides(module, repoq, spec, conf_file, en_repos=en_repos, dis_repos=dis_repos))
+        prefetch_installed(module, repoq, provided, conf_file, en_repos, dis_repos, is_pkg=True)
+        prefetch_installed(module, repoq, specs, conf_file, en_repos, dis_repos)
+
     for spec in items:
         pkg = None
 
@@ -671,6 +1026,7 @@ def install(module, items, repoq, yum_basecmd, conf_file, en_repos, dis_repos):
 
         changed = True
 
+        forget_installed()
         lang_env = dict(LANG='C', LC_ALL='C', LC_MESSAGES='C')
         rc, out, err = module.run_command(cmd, environ_update=lang_env)
 
@@ -719,6 +1075,8 @@ def remove(module, items, repoq, yum_basecmd, conf_file, en_repos, dis_repos):
     res['changed'] = False
     res['rc'] = 0
 
+    prefetch_installed(module, repoq, [pkg for pkg in items if not pkg.startswith('@')],
+                       conf_file, en_repos, dis_repos)
     for pkg in items:
         is_group = False
         # group remove - this is doom on a stick
@@ -738,6 +1096,7 @@ def remove(module, items, repoq, yum_basecmd, conf_file, en_repos, dis_repos):
         if module.check_mode:
             module.exit_json(changed=True, results=res['results'], changes=dict(removed=pkgs))
 
+        forget_installed()
         rc, out, err = module.run_command(cmd)
 
         res['rc'] = rc
@@ -750,7 +1109,8 @@ def remove(module, items, repoq, yum_basecmd, conf_file, en_repos, dis_repos):
         # of the process
 
         # at this point we should check to see if the pkg is no longer present
-        
+        prefetch_installed(module, repoq, [pkg for pkg in pkgs if not pkg.startswith('@')],
+                           conf_file, en_repos, dis_repos)
         for pkg in pkgs:
             if not pkg.startswith('@'): # we can't sensibly check for a group being uninstalled reliably
                 # look to see if the pkg shows up from is_installed. If it doesn't
@@ -812,6 +1172,9 @@ def latest(module, items, repoq, yum_basecmd, conf_file, en_repos, dis_repos):
     else:
         will_update = set()
         will_update_from_other_package = dict()
+        specs = [spec for spec in items if not spec.startswith('@')]
+        prefetch_installed(module, repoq, specs, conf_file, en_repos, dis_repos)
+        prefetch_provides(module, repoq, specs, en_repos, dis_repos)
         for spec in items:
             # some guess work involved with groups. update @<group> will install the group if missing
             if spec.startswith('@'):
@@ -881,6 +1244,7 @@ def latest(module, items, repoq, yum_basecmd, conf_file, en_repos, dis_repos):
         return res
 
     # run commands
+    forget_installed()
     if cmd:     # update all
         rc, out, err = module.run_command(cmd)
         res['changed'] = True
@@ -1009,6 +1373,7 @@ def main():
             validate_certs=dict(required=False, default="yes", type='bool'),
             # this should not be needed, but exists as a failsafe
             install_repoquery=dict(required=False, default="yes", type='bool'),
+            rpmdb_snapshot=dict(required=False, default="no", type='bool'),
         ),
         required_one_of = [['name','list']],
         mutually_exclusive = [['name','list']],
@@ -1028,7 +1393,7 @@ def main():
         # the system then users will see an error message using the yum API.
         # Use repoquery in those cases.
 
-        my = yum_base(params['conf_file'])
+        my = yum_cache(params['conf_file']).my
         # A sideeffect of accessing conf is that the configuration is
         # loaded and plugins are discovered
         my.conf
@@ -0,0 +1,164 @@
+import imp
+import os
+
+import mock
+import pytest
+
+copy = imp.load_source('ansible_module_copy',
+                       os.path.join(os.path.dirname(__file__), '..', '..', '..', 'files', 'copy.py'))
+
+
+class AnsibleFail(Exception):
+    pass
+
+
+class AnsibleExit(Exception):
+    pass
+
+
+class TestCopyTree(object):
+
+    def setup_method(self, method):
+        self.module = mock.MagicMock()
+        self.module.check_mode = False
+        self.module.params = dict(force=True, backup=False, directory_mode=None)
+        self.module.load_file_common_arguments.side_effect = lambda params: dict(path=None, mode=None)
+        self.module.set_fs_attributes_if_different.side_effect = lambda args, changed: changed
+        self.module.fail_json.side_effect = AnsibleFail()
+        self.module.exit_json.side_effect = AnsibleExit()
+
+    def tree(self, tmpdir):
+        src = tmpdir.mkdir('src')
+        src.join('new').write('new content')
+        src.mkdir('sub').join('inner').write('inner content')
+        src.join('link').mksymlinkto('new')
+        dest = tmpdir.mkdir('dest').mkdir('src')
+        dest.join('new').write('old')
+        dest.join('link').mksymlinkto('elsewhere')
+        return str(src), str(tmpdir.join('dest'))
+
+    def copy_tree(self, src, dest):
+        pytest.raises(AnsibleExit, copy.copy_tree, self.module, src, dest)
+        return self.module.exit_json.call_args[1]
+
+    def test_force_replaces_existing(self, tmpdir):
+        src, dest = self.tree(tmpdir)
+        result = self.copy_tree(src, dest)
+        assert result['changed']
+        assert open(os.path.join(dest, 'src', 'new')).read() == 'new content'
+        assert os.readlink(os.path.join(dest, 'src', 'link')) == 'new'
+        assert open(os.path.join(dest, 'src', 'sub', 'inner')).read() == 'inner content'
+
+    def test_no_force_keeps_existing(self, tmpdir):
+        self.module.params['force'] = False
+        src, dest = self.tree(tmpdir)
+        result = self.copy_tree(src, dest)
+        assert open(os.path.join(dest, 'src', 'new')).read() == 'old'
+        assert os.readlink(os.path.join(dest, 'src', 'link')) == 'elsewhere'
+        # what was missing is still copied
+        assert open(os.path.join(dest, 'src', 'sub', 'inner')).read() == 'inner content'
+        changed = sorted([c['dest'] for c in result['changed_files']])
+        assert changed == [os.path.join(dest, 'src', 'sub'), os.path.join(dest, 'src', 'sub', 'inner')]
+
+    def test_no_force_nothing_missing(self, tmpdir):
+        self.module.params['force'] = False
+        src, dest = self.tree(tmpdir)
+        self.copy_tree(src, dest)
+        result = self.copy_tree(src, dest)
+        assert not result['changed']
+        assert result['changed_files'] == []
+
+    def test_contents_only_with_trailing_slash(self, tmpdir):
+        src, dest = self.tree(tmpdir)
+        self.copy_tree(src + os.sep, dest)
+        assert open(os.path.join(dest, 'new')).read() == 'new content'
+
+    def test_check_mode_changes_nothing(self, tmpdir):
+        self.module.check_mode = True
+        src, dest = self.tree(tmpdir)
+        result = self.copy_tree(src, dest)
+        assert result['changed']
+        assert open(os.path.join(dest, 'src', 'new')).read() == 'old'
+        assert not os.path.exists(os.path.join(dest, 'src', 'sub'))
+
+    def test_special_files_skipped(self, tmpdir):
+        src, dest = self.tree(tmpdir)
+        fifo = os.path.join(src, 'fifo')
+        os.mkfifo(fifo)
+        result = self.copy_tree(src, dest)
+        assert result['skipped_files'] == [fifo]
+        assert not os.path.lexists(os.path.join(dest, 'src', 'fifo'))
+        assert open(os.path.join(dest, 'src', 'new')).read() == 'new content'
+
+
+class TestCopyData(object):
+
+    def setup_method(self, method):
+        self.patchers = [mock.patch.object(copy, 'fcntl', None)]
+        for patcher in self.patchers:
+            patcher.start()
+
+    def teardown_method(self, method):
+        for patcher in self.patchers:
+            patcher.stop()
+
+    def kernel_copies(self, *calls):
+        patcher = mock.patch.object(copy, 'kernel_copies', lambda in_fd, out_fd: list(calls))
+        patcher.start()
+        self.patchers.append(patcher)
+
+    def files(self, tmpdir):
+        tmpdir.join('src').write('x' * 1000 + 'y' * 1000)
+        return str(tmpdir.join('src')), str(tmpdir.join('dest'))
+
+    def test_read_write_without_kernel_copies(self, tmpdir):
+        self.kernel_copies()
+        src, dest = self.files(tmpdir)
+        assert copy.copy_data(src, dest) == 'read/write'
+        assert open(dest).read() == open(src).read()
+
+    def test_kernel_copy(self, tmpdir):
+        src, dest = self.files(tmpdir)
+        out = []
+
+        def call(count, offset):
+            # 300 bytes at a time, written at the current position of dest like sendfile
+            f = open(src, 'rb')
+            try:
+                f.seek(offset)
+                data = f.read(min(count, 300))
+            finally:
+                f.close()
+            out[0].write(data)
+            out[0].flush()
+            return len(data)
+
+        real_open = open
+        self.kernel_copies(('fake', call))
+        copy_data = copy.copy_data
+
+        def tracking_open(path, mode='r'):
+            f = real_open(path, mode)
+            if path == dest:
+                out.append(f)
+            return f
+        patcher = mock.patch.object(copy, 'open', tracking_open, create=True)
+        patcher.start()
+        self.patchers.append(patcher)
+        assert copy_data(src, dest) == 'fake'
+        assert real_open(dest).read() == real_open(src).read()
+
+    def test_failed_kernel_copy_falls_back(self, tmpdir):
+        src, dest = self.files(tmpdir)
+
+        def call(count, offset):
+            fd = os.open(dest, os.O_WRONLY)
+            try:
+                os.write(fd, 'partial'.encode('ascii'))
+            finally:
+                os.close(fd)
+            raise OSError(18, 'Invalid cross-device link')
+
+        self.kernel_copies(('fake', call))
+        assert copy.copy_data(src, dest) == 'read/write'
+        assert open(dest).read() == open(src).read()
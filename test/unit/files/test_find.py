@@ -0,0 +1,166 @@
+import imp
+import os
+import re
+import hashlib
+
+import mock
+import pytest
+
+find = imp.load_source('ansible_module_find',
+                       os.path.join(os.path.dirname(__file__), '..', '..', '..', 'files', 'find.py'))
+
+
+class AnsibleFail(Exception):
+    pass
+
+
+def make_module(**params):
+    module = mock.MagicMock()
+    module.params = dict(paths=[], patterns=['*'], contains=None, contains_mode='first',
+                         max_read_bytes=None, file_type='file', age=None, age_stamp='mtime',
+                         size=None, recurse=False, hidden=False, follow=False,
+                         get_checksum=False, checksum_algorithm=['sha1'], use_regex=False,
+                         excludes=None, index=None, index_max_size='32m', threads=1)
+    module.params.update(params)
+    module.fail_json.side_effect = AnsibleFail()
+    return module
+
+
+class TestContentSearch(object):
+
+    def search(self, tmpdir, content, *args):
+        path = tmpdir.join('file.txt')
+        path.write(content)
+        return find.ContentSearch(*args).search(str(path), os.stat(str(path)))
+
+    def test_first_stops_at_one_match(self, tmpdir):
+        assert self.search(tmpdir, 'foo\nbar\nfoo\n', 'foo', 'first') == 1
+
+    def test_count_counts_every_line(self, tmpdir):
+        assert self.search(tmpdir, 'foo\nbar\nfoo\n', 'foo', 'count') == 2
+
+    def test_matches_at_line_start_only(self, tmpdir):
+        assert self.search(tmpdir, 'a foo\n', 'foo', 'first') == 0
+
+    def test_match_stays_on_its_line(self, tmpdir):
+        assert self.search(tmpdir, 'bar\nfoo\n', 'bar\\sfoo', 'first') == 0
+        assert self.search(tmpdir, 'bar\nfoo\n', '[^x]*foo', 'count') == 1
+        assert self.search(tmpdir, '\n  foo\n  foo\n', '\\s+foo', 'count') == 2
+
+    def test_match_takes_the_newline(self, tmpdir):
+        # like re.match() against a line read from the file
+        assert self.search(tmpdir, 'foo\nbar\n', 'foo\\s', 'count') == 1
+        assert self.search(tmpdir, 'foo\n', 'foo\\s', 'first') == 1
+
+    def test_read_budget(self, tmpdir):
+        assert self.search(tmpdir, 'bar\nfoo\n', 'foo', 'first', 4) == 0
+        assert self.search(tmpdir, 'bar\nfoo\n', 'foo', 'first', 7) == 1
+
+    def test_empty_file(self, tmpdir):
+        assert self.search(tmpdir, '', 'foo', 'count') == 0
+
+    def test_invalid_pattern(self):
+        pytest.raises(re.error, find.ContentSearch, 'foo(', 'first')
+
+    def test_finder_fails_on_invalid_pattern(self):
+        module = make_module(contains='foo(')
+        pytest.raises(AnsibleFail, find.Finder, module)
+        assert module.fail_json.call_args[1]['contains'] == 'foo('
+
+
+class TestDirIndex(object):
+
+    def tree(self, tmpdir):
+        tmpdir.join('match.log').write('log')
+        tmpdir.join('other.txt').write('txt')
+        tmpdir.mkdir('sub')
+        tmpdir.join('link').mksymlinkto('match.log')
+        return str(tmpdir)
+
+    def run(self, root, index):
+        finder = find.Finder(make_module(patterns=['*.log', 'link']), index=index)
+        # pretend the directory was last changed long enough ago to be indexed
+        finder.now += 10
+        finder.run([root])
+        return finder
+
+    def test_only_matches_are_statted(self, tmpdir):
+        root = self.tree(tmpdir.mkdir('tree'))
+        index = find.DirIndex(str(tmpdir.join('index')), 1024 * 1024)
+        finder = self.run(root, index)
+        assert [r['path'] for r in finder.filelist] == [os.path.join(root, 'link'), os.path.join(root, 'match.log')]
+
+        rows = dict((row[0], row[1:]) for row in index.dirs[root][3])
+        assert rows['other.txt'] == [False, False, True, None]
+        assert rows['sub'] == [False, True, False, None]
+        assert rows['match.log'][:3] == [False, False, True]
+        assert rows['match.log'][3] is not None
+        assert rows['link'][:3] == [True, False, True]
+        assert rows['link'][3] is not None
+
+    def test_hit_stats_new_matches_lazily(self, tmpdir):
+        root = self.tree(tmpdir.mkdir('tree'))
+        index = find.DirIndex(str(tmpdir.join('index')), 1024 * 1024)
+        self.run(root, index)
+        index.save()
+
+        index = find.DirIndex(str(tmpdir.join('index')), 1024 * 1024)
+        finder = find.Finder(make_module(patterns=['*.txt']), index=index)
+        finder.run([root])
+        assert index.hits == 1
+        assert [r['path'] for r in finder.filelist] == [os.path.join(root, 'other.txt')]
+        assert finder.filelist[0]['size'] == 3
+        rows = dict((row[0], row[1:]) for row in index.dirs[root][3])
+        assert rows['other.txt'][3] is not None
+
+
+class TestFinderChecksum(object):
+
+    def setup_method(self, method):
+        self.checksummer = find.Checksummer(['sha1'])
+
+    def tree(self, tmpdir):
+        tmpdir.join('data').write('content')
+        tmpdir.mkdir('sub').join('inner').write('more')
+        return str(tmpdir)
+
+    def test_checksums_files(self, tmpdir):
+        root = self.tree(tmpdir)
+        finder = find.Finder(make_module(get_checksum=True), checksummer=self.checksummer)
+        finder.run([root])
+        assert [r['path'] for r in finder.filelist] == [os.path.join(root, 'data')]
+        assert finder.filelist[0]['checksum'] == hashlib.sha1('content'.encode('ascii')).hexdigest()
+        assert finder.hashed['files'] == 1
+        assert finder.msg == ''
+
+    def test_skips_directories(self, tmpdir):
+        root = self.tree(tmpdir)
+        finder = find.Finder(make_module(get_checksum=True, file_type='directory'), checksummer=self.checksummer)
+        finder.run([root])
+        assert [r['path'] for r in finder.filelist] == [os.path.join(root, 'sub')]
+        assert 'checksum' not in finder.filelist[0]
+        assert finder.hashed['files'] == 0
+        assert finder.msg == ''
+
+    def test_several_algorithms(self, tmpdir):
+        root = self.tree(tmpdir)
+        finder = find.Finder(make_module(get_checksum=True), checksummer=find.Checksummer(['sha256', 'md5']))
+        finder.run([root])
+        result = finder.filelist[0]
+        assert result['checksum'] == hashlib.sha256('content'.encode('ascii')).hexdigest()
+        assert result['checksums']['md5'] == hashlib.md5('content'.encode('ascii')).hexdigest()
+
+    def test_without_hashlib(self, tmpdir):
+        root = self.tree(tmpdir)
+        module = make_module(get_checksum=True)
+        module.sha1.side_effect = lambda path: 'sha1 of %s' % os.path.basename(path)
+        finder = find.Finder(module, checksummer=find.ModuleChecksummer(module))
+        finder.run([root])
+        assert finder.filelist[0]['checksum'] == 'sha1 of data'
+        assert 'checksums' not in finder.filelist[0]
+        assert finder.hashed['bytes'] == len('content')
+
+    def test_without_hashlib_missing_file(self, tmpdir):
+        module = make_module()
+        module.sha1.return_value = None
+        pytest.raises(IOError, find.ModuleChecksummer(module).digest, str(tmpdir.join('missing')))
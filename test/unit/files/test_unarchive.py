@@ -0,0 +1,156 @@
+import imp
+import io
+import os
+import tarfile
+
+import mock
+import pytest
+
+unarchive = imp.load_source('ansible_module_unarchive',
+                            os.path.join(os.path.dirname(__file__), '..', '..', '..', 'files', 'unarchive.py'))
+
+
+def make_tar(path, members):
+    ''' members are (name, type, data or link target) '''
+    tf = tarfile.open(path, 'w')
+    try:
+        for name, kind, value in members:
+            info = tarfile.TarInfo(name)
+            info.type = kind
+            if kind == tarfile.REGTYPE:
+                data = value.encode('ascii')
+                info.size = len(data)
+                tf.addfile(info, io.BytesIO(data))
+            else:
+                info.linkname = value
+                tf.addfile(info)
+    finally:
+        tf.close()
+    return path
+
+
+class TestNativeTarLinks(object):
+
+    def setup_method(self, method):
+        self.module = mock.MagicMock()
+        self.module.params = dict(exclude=[], keep_newer=False, compare='checksum')
+        self.file_args = dict(mode=None, owner=None, group=None)
+
+    def handler(self, src, dest):
+        return unarchive.NativeTarArchive(src, dest, self.file_args, self.module)
+
+    def test_hardlink_inside_dest(self, tmpdir):
+        src = make_tar(str(tmpdir.join('ok.tar')), [
+            ('data', tarfile.REGTYPE, 'content'),
+            ('hard', tarfile.LNKTYPE, 'data'),
+        ])
+        dest = str(tmpdir.mkdir('dest'))
+        result = self.handler(src, dest).is_unarchived()
+        assert not result['unarchived']
+        assert os.path.samefile(os.path.join(dest, 'data'), os.path.join(dest, 'hard'))
+
+        # a second run finds everything in place
+        assert self.handler(src, dest).is_unarchived()['unarchived']
+
+    def test_hardlink_through_symlink_out_of_dest(self, tmpdir):
+        outside = tmpdir.mkdir('outside')
+        outside.join('secret').write('secret')
+        src = make_tar(str(tmpdir.join('evil.tar')), [
+            ('link', tarfile.SYMTYPE, str(outside)),
+            ('hard', tarfile.LNKTYPE, 'link/secret'),
+        ])
+        dest = str(tmpdir.mkdir('dest'))
+        pytest.raises(unarchive.UnarchiveError, self.handler(src, dest).is_unarchived)
+        assert not os.path.lexists(os.path.join(dest, 'hard'))
+        assert os.stat(str(outside.join('secret'))).st_nlink == 1
+
+    def test_hardlink_to_path_outside_dest(self, tmpdir):
+        src = make_tar(str(tmpdir.join('evil.tar')), [
+            ('hard', tarfile.LNKTYPE, '../secret'),
+        ])
+        dest = str(tmpdir.mkdir('dest'))
+        pytest.raises(unarchive.UnarchiveError, self.handler(src, dest).is_unarchived)
+
+    def test_hardlink_to_file_not_in_archive(self, tmpdir):
+        dest = tmpdir.mkdir('dest')
+        dest.join('existing').write('not from the archive')
+        src = make_tar(str(tmpdir.join('evil.tar')), [
+            ('hard', tarfile.LNKTYPE, 'existing'),
+        ])
+        pytest.raises(unarchive.UnarchiveError, self.handler(src, str(dest)).is_unarchived)
+        assert not os.path.lexists(str(dest.join('hard')))
+
+    def test_hardlink_to_symlink(self, tmpdir):
+        src = make_tar(str(tmpdir.join('evil.tar')), [
+            ('data', tarfile.REGTYPE, 'content'),
+            ('link', tarfile.SYMTYPE, 'data'),
+            ('hard', tarfile.LNKTYPE, 'link'),
+        ])
+        dest = str(tmpdir.mkdir('dest'))
+        # the symlink resolves to a file of the archive in dest
+        self.handler(src, dest).is_unarchived()
+        assert os.path.samefile(os.path.join(dest, 'data'), os.path.join(dest, 'hard'))
+        assert not os.path.islink(os.path.join(dest, 'hard'))
+
+    def test_member_outside_dest(self, tmpdir):
+        src = make_tar(str(tmpdir.join('evil.tar')), [
+            ('../escaped', tarfile.REGTYPE, 'content'),
+        ])
+        dest = str(tmpdir.mkdir('dest'))
+        pytest.raises(unarchive.UnarchiveError, self.handler(src, dest).is_unarchived)
+        assert not tmpdir.join('escaped').check()
+
+    def test_symlink_parent_out_of_dest(self, tmpdir):
+        outside = tmpdir.mkdir('outside')
+        outside.join('victim').write('content')
+        victim = str(outside.join('victim'))
+        src = make_tar(str(tmpdir.join('evil.tar')), [
+            ('link', tarfile.SYMTYPE, str(outside)),
+            ('link/victim', tarfile.REGTYPE, 'CONTENT'),
+        ])
+        # same size and mtime, so the content would be compared
+        mtime = tarfile.open(src).getmember('link/victim').mtime
+        os.utime(victim, (mtime, mtime))
+        dest = str(tmpdir.mkdir('dest'))
+        pytest.raises(unarchive.UnarchiveError, self.handler(src, dest).is_unarchived)
+        assert outside.listdir() == [outside.join('victim')]
+        assert outside.join('victim').read() == 'content'
+
+
+class TestNativeTempFiles(object):
+
+    def setup_method(self, method):
+        self.module = mock.MagicMock()
+        self.module.params = dict(exclude=[], keep_newer=False, compare='checksum')
+        self.file_args = dict(mode=None, owner=None, group=None)
+
+    def test_failed_extract_removes_temp_file(self, tmpdir):
+        src = make_tar(str(tmpdir.join('ok.tar')), [
+            ('data', tarfile.REGTYPE, 'content'),
+        ])
+        dest = tmpdir.mkdir('dest')
+        dest.join('data').write('CONTENT')
+        mtime = tarfile.open(src).getmember('data').mtime
+        os.utime(str(dest.join('data')), (mtime, mtime))
+        handler = unarchive.NativeTarArchive(src, str(dest), self.file_args, self.module)
+        patcher = mock.patch.object(unarchive.os, 'rename', side_effect=OSError(13, 'Permission denied'))
+        patcher.start()
+        try:
+            pytest.raises(unarchive.UnarchiveError, handler.is_unarchived)
+        finally:
+            patcher.stop()
+        assert dest.listdir() == [dest.join('data')]
+
+    def test_failed_write_removes_temp_file(self, tmpdir):
+        src = make_tar(str(tmpdir.join('ok.tar')), [
+            ('data', tarfile.REGTYPE, 'content'),
+        ])
+        dest = tmpdir.mkdir('dest')
+        handler = unarchive.NativeTarArchive(src, str(dest), self.file_args, self.module)
+        patcher = mock.patch.object(unarchive.shutil, 'copyfileobj', side_effect=IOError(28, 'No space left on device'))
+        patcher.start()
+        try:
+            pytest.raises(unarchive.UnarchiveError, handler.is_unarchived)
+        finally:
+            patcher.stop()
+        assert dest.listdir() == []
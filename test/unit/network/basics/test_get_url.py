@@ -0,0 +1,267 @@
+import imp
+import os
+import re
+import threading
+
+import mock
+import pytest
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+get_url = imp.load_source('ansible_module_get_url',
+                          os.path.join(os.path.dirname(__file__), '..', '..', '..', '..', 'network', 'basics', 'get_url.py'))
+
+CONTENT = os.urandom(get_url.CHUNK_SIZE * 4 + 123)
+
+
+class AnsibleFail(Exception):
+    pass
+
+
+class AnsibleExit(Exception):
+    pass
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    ''' serves the content of the server, answering Range and If-None-Match requests the way it says '''
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(self.headers.get('Range'))
+        self.server.conditions.append(self.headers.get('If-None-Match'))
+        if self.headers.get('If-None-Match') == self.server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        content = self.server.content
+        match = re.match(r'bytes=(\d+)-(\d+)$', self.headers.get('Range') or '')
+        if match and match.group(0) in self.server.broken:
+            self.send_response(503)
+            self.end_headers()
+            return
+        if match and self.server.ranges(match.group(0)):
+            start, end = int(match.group(1)), int(match.group(2))
+            body = content[start:end + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, len(content)))
+        else:
+            body = content
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', self.server.etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class Server(HTTPServer):
+
+    def __init__(self, ranges):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), RangeHandler)
+        self.ranges = ranges
+        self.requests = []
+        self.conditions = []
+        self.broken = set()
+        self.content = CONTENT
+        self.etag = '"v1"'
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def handle_error(self, request, client_address):
+        # clients hang up on answers they do not want
+        pass
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/disk.img' % self.server_address[1]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def make_module():
+    module = mock.MagicMock()
+    module.params = dict(validate_certs=True, http_agent='ansible-httpget', force_basic_auth=False)
+    module.fail_json.side_effect = AnsibleFail()
+    module.exit_json.side_effect = AnsibleExit()
+    return module
+
+
+class TestParseContentRange(object):
+
+    def test_length(self):
+        assert get_url.parse_content_range('bytes 0-0/1234') == 1234
+        assert get_url.parse_content_range('bytes  100-199/200') == 200
+
+    def test_no_length(self):
+        assert get_url.parse_content_range('bytes 0-0/*') is None
+        assert get_url.parse_content_range('bytes */1234') is None
+        assert get_url.parse_content_range('') is None
+        assert get_url.parse_content_range(None) is None
+
+
+class TestRanges(object):
+
+    def ranges(self, total, segments):
+        return get_url.SegmentedDownload(None, 'http://example.com/', total, None, segments, '/nonexistent', True, 10, None).ranges
+
+    def test_cover_the_file(self):
+        total = get_url.CHUNK_SIZE * 10 + 7
+        ranges = self.ranges(total, 3)
+        assert len(ranges) == 3
+        assert ranges[0][0] == 0
+        assert ranges[-1][1] == total - 1
+        for previous, span in zip(ranges, ranges[1:]):
+            assert span[0] == previous[1] + 1
+        for span in ranges:
+            assert span[2] == span[0]
+
+    def test_no_range_below_one_chunk(self):
+        assert len(self.ranges(get_url.CHUNK_SIZE * 2, 8)) == 2
+        assert self.ranges(10, 4) == [[0, 9, 0]]
+
+
+class TestSegmentedDownload(object):
+
+    def setup_method(self, method):
+        self.server = None
+
+    def teardown_method(self, method):
+        if self.server is not None:
+            self.server.stop()
+
+    def url_get(self, tmpdir, ranges, segments=4):
+        if self.server is None:
+            self.server = Server(ranges)
+        hashes = {'sha1': get_url.hashlib.new('sha1')}
+        tempname, info = get_url.url_get(make_module(), self.server.url, str(tmpdir.join('dest')), True, None, False,
+                                         tmp_dest=str(tmpdir), hashes=hashes, segments=segments)
+        content = open(tempname, 'rb').read()
+        assert hashes['sha1'].hexdigest() == get_url.hashlib.sha1(content).hexdigest()
+        return content, info
+
+    def test_ranges_assembled(self, tmpdir):
+        content, info = self.url_get(tmpdir, lambda value: True)
+        assert content == CONTENT
+        assert info['msg'] == 'OK (%d bytes in 4 segments)' % len(CONTENT)
+        assert self.server.requests[0] == 'bytes=0-0'
+        assert len(self.server.requests) == 5
+        # the segment state is gone once the file is complete
+        assert not [name for name in os.listdir(str(tmpdir)) if name.endswith('.json')]
+
+    def test_probe_answered_with_whole_file(self, tmpdir):
+        # a server without range support sends everything for the probe,
+        # which then is the download
+        content, info = self.url_get(tmpdir, lambda value: False)
+        assert content == CONTENT
+        assert info['status'] == 200
+        assert 'resumed' not in info
+        assert self.server.requests == ['bytes=0-0']
+        assert get_url.segment_path(str(tmpdir), self.server.url) is not None
+        assert not os.path.exists(get_url.segment_path(str(tmpdir), self.server.url))
+
+    def fail_ranges(self, tmpdir, spans):
+        ''' a first attempt on which the given segments get a 503 '''
+        self.server = Server(lambda value: True)
+        ranges = get_url.SegmentedDownload(None, self.server.url, len(CONTENT), None, 4, '/nonexistent', True, 10, None).ranges
+        broken = ['bytes=%d-%d' % (ranges[i][0], ranges[i][1]) for i in spans]
+        self.server.broken.update(broken)
+        module = make_module()
+        pytest.raises(AnsibleFail, get_url.url_get, module, self.server.url, str(tmpdir.join('dest')), True, None, False,
+                      tmp_dest=str(tmpdir), segments=4)
+        assert 'status 503' in module.fail_json.call_args[1]['msg']
+        self.server.broken.clear()
+        del self.server.requests[:]
+        return broken
+
+    def test_resume_from_segment_files(self, tmpdir):
+        broken = self.fail_ranges(tmpdir, [1, 2])
+
+        # what failed is kept under the name derived from the url
+        part = get_url.segment_path(str(tmpdir), self.server.url)
+        assert os.path.basename(part) == '.get_url-%s.part' % get_url.hashlib.sha1(self.server.url.encode('utf-8')).hexdigest()
+        state = get_url.json.load(open(part + '.json'))
+        assert state['validator'] == '"v1"'
+        assert [span[2] > span[1] for span in state['ranges']] == [True, False, False, True]
+
+        content, info = self.url_get(tmpdir, None)
+        assert content == CONTENT
+        assert info['resumed']
+        # only the probe and the missing ranges are fetched again
+        assert sorted(self.server.requests) == sorted(['bytes=0-0'] + broken)
+        assert not os.path.exists(part + '.json')
+
+    def test_no_resume_after_change(self, tmpdir):
+        self.fail_ranges(tmpdir, [0])
+        # the resource is replaced, the saved ranges belong to the old one
+        self.server.content = CONTENT[::-1]
+        self.server.etag = '"v2"'
+        content, info = self.url_get(tmpdir, None)
+        assert content == CONTENT[::-1]
+        assert not info['resumed']
+        assert len(self.server.requests) == 5
+
+    def test_server_ignoring_later_ranges(self, tmpdir):
+        # the probe gets a partial answer, the ranges the whole file
+        pytest.raises(AnsibleFail, self.url_get, tmpdir, lambda value: value == 'bytes=0-0')
+        # what was fetched cannot be resumed and is removed
+        assert os.listdir(str(tmpdir)) == []
+
+
+class TestHttpCache(object):
+
+    def setup_method(self, method):
+        self.server = Server(lambda value: False)
+
+    def teardown_method(self, method):
+        self.server.stop()
+
+    def main(self, tmpdir):
+        module = make_module()
+        module.params.update(url=self.server.url, dest=str(tmpdir.join('dest')), backup=False, force=True,
+                             sha256sum='', checksum='', use_proxy=True, timeout=10, headers=None, tmp_dest='',
+                             segments=1, http_cache=str(tmpdir.join('cache')), http_cache_entries=10)
+        module.sha1.side_effect = lambda path: get_url.hashlib.sha1(open(path, 'rb').read()).hexdigest()
+        module.set_fs_attributes_if_different.side_effect = lambda args, changed: changed
+        patcher = mock.patch.object(get_url, 'AnsibleModule', return_value=module)
+        constructor = patcher.start()
+        try:
+            pytest.raises(AnsibleExit, get_url.main)
+        finally:
+            patcher.stop()
+        assert constructor.call_args[1]['argument_spec']['http_cache']['type'] == 'path'
+        return module.exit_json.call_args[1]
+
+    def test_not_modified_reuses_dest(self, tmpdir):
+        assert self.main(tmpdir)['changed']
+        mtime = os.path.getmtime(str(tmpdir.join('dest')))
+        result = self.main(tmpdir)
+        assert not result['changed']
+        assert self.server.conditions == [None, '"v1"']
+        # a 304 ends the run before anything is downloaded or compared
+        assert 'checksum_src' not in result
+        assert os.path.getmtime(str(tmpdir.join('dest'))) == mtime
+        assert tmpdir.join('dest').read('rb') == CONTENT
+
+    def test_changed_validator_downloads_again(self, tmpdir):
+        assert self.main(tmpdir)['changed']
+        self.server.etag = '"v2"'
+        self.server.content = CONTENT[::-1]
+        assert self.main(tmpdir)['changed']
+        assert tmpdir.join('dest').read('rb') == CONTENT[::-1]
+        # and the new validator is the one asked with next time
+        assert not self.main(tmpdir)['changed']
+        assert self.server.conditions == [None, '"v1"', '"v2"']
+
+    def test_changed_dest_downloads_again(self, tmpdir):
+        assert self.main(tmpdir)['changed']
+        tmpdir.join('dest').write('edited')
+        assert self.main(tmpdir)['changed']
+        assert self.server.conditions == [None, None]
+        assert tmpdir.join('dest').read('rb') == CONTENT
@@ -0,0 +1,177 @@
+import imp
+import os
+import threading
+
+import mock
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+uri = imp.load_source('ansible_module_uri',
+                      os.path.join(os.path.dirname(__file__), '..', '..', '..', '..', 'network', 'basics', 'uri.py'))
+
+BIG = 'x' * (uri.CHUNK_SIZE * 2)
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    ''' answers every request on a keep-alive connection, recording which connection it came on '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body, headers=None):
+        self.server.requests.append((self.command, self.path, self.client_address[1]))
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode('ascii'))
+
+    def do_GET(self):
+        if self.path == '/redirect':
+            self.reply(302, 'moved', {'Location': '/data'})
+        elif self.path == '/elsewhere':
+            self.reply(302, 'moved', {'Location': self.server.elsewhere + '/big'})
+        elif self.path == '/big':
+            self.reply(200, BIG)
+        else:
+            self.reply(200, 'data at %s' % self.path)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.do_GET()
+
+
+class Server(HTTPServer):
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), KeepAliveHandler)
+        self.requests = []
+        self.elsewhere = None
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def handle_error(self, request, client_address):
+        # clients hang up on bodies they do not want
+        pass
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def connections(self):
+        return len(set([port for method, path, port in self.requests]))
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def make_module(**params):
+    module = mock.MagicMock()
+    module.params = dict(url_username=None, url_password=None, force_basic_auth=False, http_agent='ansible-httpget',
+                         use_proxy=False, validate_certs=True, follow_redirects='safe', timeout=10)
+    module.params.update(params)
+    module.boolean.side_effect = bool
+    return module
+
+
+class TestConnectionPool(object):
+
+    def setup_method(self, method):
+        self.server = Server()
+        self.pool = None
+
+    def teardown_method(self, method):
+        if self.pool is not None:
+            self.pool.close()
+        self.server.stop()
+
+    def request(self, method, path, body=None, **params):
+        if self.pool is None:
+            self.pool = uri.ConnectionPool(make_module(**params), 10)
+        resp, info = self.pool.request(method, self.server.url + path, body)
+        content = resp.read()
+        return info, content
+
+    def test_keep_alive(self):
+        for path in ('/a', '/b', '/c'):
+            info, content = self.request('GET', path)
+            assert info['status'] == 200
+            assert content == ('data at %s' % path).encode('ascii')
+        assert len(self.server.requests) == 3
+        assert self.server.connections() == 1
+
+    def test_new_connection_after_discard(self):
+        self.request('GET', '/a')
+        self.pool.discard(self.server.url + '/a')
+        self.request('GET', '/b')
+        assert self.server.connections() == 2
+
+    def test_safe_follows_get(self):
+        info, content = self.request('GET', '/redirect')
+        assert info['status'] == 200
+        assert info['url'] == self.server.url + '/data'
+        assert content == 'data at /data'.encode('ascii')
+        # the redirect was read to the end and its connection reused
+        assert self.server.connections() == 1
+
+    def test_safe_stops_at_post(self):
+        info, content = self.request('POST', '/redirect', 'body')
+        assert info['status'] == 302
+        assert info['url'] == self.server.url + '/redirect'
+
+    def test_all_follows_post(self):
+        info, content = self.request('POST', '/redirect', 'body', follow_redirects='all')
+        assert info['status'] == 200
+        assert self.server.requests[-1][:2] == ('GET', '/data')
+
+    def test_no_and_none_do_not_follow(self):
+        for follow in ('no', 'none', False):
+            self.pool = None
+            info, content = self.request('GET', '/redirect', follow_redirects=follow)
+            assert info['status'] == 302
+
+    def test_yes_follows(self):
+        info, content = self.request('POST', '/redirect', 'body', follow_redirects='yes')
+        assert info['status'] == 200
+
+
+class TestRunRequests(object):
+
+    def setup_method(self, method):
+        self.server = Server()
+
+    def teardown_method(self, method):
+        self.server.stop()
+
+    def run(self, module, items, max_bytes=None):
+        return uri.run_requests(module, self.server.url + '/', items, 'GET', None, 'raw', {}, [200], True, max_bytes)
+
+    def test_requests_share_a_connection(self):
+        results = self.run(make_module(), ['a', {'url': 'b', 'method': 'POST', 'body': 'x'}, 'redirect'])
+        assert [r['content'] for r in results] == ['data at /a', 'data at /b', 'data at /data']
+        assert [r['redirected'] for r in results] == [False, False, True]
+        assert self.server.connections() == 1
+
+    def test_truncated_body_discards_the_connection_used(self):
+        elsewhere = Server()
+        try:
+            self.server.elsewhere = elsewhere.url
+            patcher = mock.patch.object(uri.ConnectionPool, 'discard', autospec=True)
+            discard = patcher.start()
+            try:
+                results = self.run(make_module(), ['elsewhere'], max_bytes=10)
+            finally:
+                patcher.stop()
+            assert results[0]['content_truncated']
+            assert results[0]['content'] == 'x' * 10
+            assert discard.call_args[0][1] == elsewhere.url + '/big'
+        finally:
+            elsewhere.stop()
@@ -0,0 +1,79 @@
+import imp
+import os
+
+import mock
+import pytest
+
+gem = imp.load_source('ansible_module_gem',
+                      os.path.join(os.path.dirname(__file__), '..', '..', '..', '..', 'packaging', 'language', 'gem.py'))
+
+
+class AnsibleFail(Exception):
+    pass
+
+
+class TestCachedGem(object):
+
+    def cache(self, tmpdir, *names):
+        for name in names:
+            tmpdir.join(name).write('')
+        return str(tmpdir)
+
+    def test_newest_version(self, tmpdir):
+        cache_dir = self.cache(tmpdir, 'rake-10.0.gem', 'rake-9.2.2.gem', 'rake-12.3.3.gem')
+        assert gem.cached_gem(cache_dir, 'rake') == os.path.join(cache_dir, 'rake-12.3.3.gem')
+
+    def test_exact_version(self, tmpdir):
+        cache_dir = self.cache(tmpdir, 'rake-10.0.gem', 'rake-10.0.1.gem')
+        assert gem.cached_gem(cache_dir, 'rake', '10.0') == os.path.join(cache_dir, 'rake-10.0.gem')
+        assert gem.cached_gem(cache_dir, 'rake', '11.0') is None
+
+    def test_other_gem_with_same_prefix(self, tmpdir):
+        cache_dir = self.cache(tmpdir, 'rake-compiler-1.0.gem')
+        assert gem.cached_gem(cache_dir, 'rake') is None
+        assert gem.cached_gem(cache_dir, 'rake-compiler') == os.path.join(cache_dir, 'rake-compiler-1.0.gem')
+
+    def test_platform_gem(self, tmpdir):
+        cache_dir = self.cache(tmpdir, 'nokogiri-1.6.8-x86_64-linux.gem')
+        assert gem.cached_gem(cache_dir, 'nokogiri', '1.6.8') == os.path.join(cache_dir, 'nokogiri-1.6.8-x86_64-linux.gem')
+
+    def test_empty_cache(self, tmpdir):
+        assert gem.cached_gem(str(tmpdir), 'rake') is None
+
+
+class TestInstalledVersions(object):
+
+    def setup_method(self, method):
+        gem.gem_queries.clear()
+        self.module = mock.MagicMock()
+        self.module.params = dict(name=['rake', 'a.b'], executable='gem', repository=None,
+                                  state='present', version=None)
+        self.module.run_command.return_value = (0, 'rake (12.3.3, 10.0)\na.b (1.0)\n', '')
+
+    def teardown_method(self, method):
+        gem.gem_queries.clear()
+
+    def test_one_query_for_all_names(self):
+        assert gem.exists(self.module, 'rake')
+        assert gem.exists(self.module, 'a.b')
+        assert not gem.exists(self.module, 'missing')
+        assert self.module.run_command.call_count == 1
+        cmd = self.module.run_command.call_args[0][0]
+        assert cmd == ['gem', 'query', '-n', '^(rake|a\\.b)$']
+
+    def test_version(self):
+        self.module.params['version'] = '10.0'
+        assert gem.exists(self.module, 'rake')
+        self.module.params['version'] = '11.0'
+        assert not gem.exists(self.module, 'rake')
+
+
+class TestFetch(object):
+
+    @mock.patch.object(gem.os, 'makedirs', side_effect=OSError(13, 'Permission denied'))
+    def test_unwritable_cache_dir(self, makedirs, tmpdir):
+        module = mock.MagicMock()
+        module.params = dict(cache_dir=str(tmpdir.join('cache')))
+        module.fail_json.side_effect = AnsibleFail()
+        pytest.raises(AnsibleFail, gem.fetch, module, ['rake'])
+        assert 'Permission denied' in module.fail_json.call_args[1]['msg']
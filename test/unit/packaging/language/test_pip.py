@@ -0,0 +1,178 @@
+import imp
+import os
+
+import mock
+import pytest
+
+pip = imp.load_source('ansible_module_pip',
+                      os.path.join(os.path.dirname(__file__), '..', '..', '..', '..', 'packaging', 'language', 'pip.py'))
+
+
+class AnsibleFail(Exception):
+    pass
+
+
+class TestCanonicalName(object):
+
+    def test_pep503(self):
+        for name in ('zope.interface', 'zope_interface', 'zope-interface', 'Zope__Interface', 'ZOPE-.interface'):
+            assert pip._canonical_name(name) == 'zope-interface'
+
+    def test_absent_matches_other_spelling(self):
+        installed = {pip._canonical_name('zope.interface'): '4.1.3'}
+        assert pip._pending(['zope_interface'], None, 'absent', installed) == ['zope_interface']
+        assert pip._pending(['zope-interface'], None, 'present', installed) == []
+
+    def test_absent_respects_version(self):
+        installed = {'foo': '2.0'}
+        assert pip._pending(['foo'], '1.0', 'absent', installed) == []
+        assert pip._pending(['foo'], '2.0', 'absent', installed) == ['foo']
+        assert pip._pending(['foo'], None, 'absent', installed) == ['foo']
+
+    def test_absent_with_version_specifiers(self):
+        installed = {'bottle': '0.12.9'}
+        for name in ('bottle==0.11', 'bottle>=0.10', 'Bottle >= 0.10, < 0.13', 'bottle[dev]==0.12.9'):
+            assert pip._pending([name], None, 'absent', installed) == [name]
+            assert pip._pending([name], None, 'absent', {}) == []
+        # and what is no plain requirement goes to pip
+        assert pip._pending(['git+https://github.com/bottlepy/bottle'], None, 'absent', {}) == \
+            ['git+https://github.com/bottlepy/bottle']
+
+    def test_present_with_version_specifiers(self):
+        installed = {'bottle': '0.12.9'}
+        assert pip._pending(['bottle>=0.10', 'bottle==0.12.9'], None, 'present', installed) == []
+        assert pip._pending(['bottle==0.11', 'bottle<0.12'], None, 'present', installed) == ['bottle==0.11', 'bottle<0.12']
+        assert pip._pending(['bottle>=0.10'], None, 'present', {}) == ['bottle>=0.10']
+        assert pip._pending(['bottle[dev]>=0.10'], None, 'present', installed) == ['bottle[dev]>=0.10']
+
+
+class TestInstalledDistributions(object):
+
+    def test_reads_metadata(self, tmpdir):
+        site = tmpdir.mkdir('site-packages')
+        site.mkdir('Django-1.8.4.dist-info').join('METADATA').write('Metadata-Version: 2.0\nName: Django\nVersion: 1.8.4\n\nbody\n')
+        site.mkdir('zope.interface-4.1.3-py2.7.egg-info').join('PKG-INFO').write('Name: zope.interface\nVersion: 4.1.3\n')
+        site.join('six-1.10.0-py2.7.egg-info').write('Name: six\nVersion: 1.10.0\n')
+        installed = pip._installed_distributions([str(site)])
+        assert installed == {'django': '1.8.4', 'zope-interface': '4.1.3', 'six': '1.10.0'}
+
+    def test_first_directory_wins(self, tmpdir):
+        for name, version in (('first', '2.0'), ('second', '1.0')):
+            tmpdir.mkdir(name).mkdir('six-%s.dist-info' % version).join('METADATA').write('Name: six\nVersion: %s\n' % version)
+        installed = pip._installed_distributions([str(tmpdir.join('first')), str(tmpdir.join('second'))])
+        assert installed == {'six': '2.0'}
+
+
+class TestSplitNames(object):
+
+    def test_keeps_version_ranges(self):
+        assert pip._split_names('Django>=1.8,<1.9') == ['Django>=1.8,<1.9']
+        assert pip._split_names('foo>=1, !=1.5') == ['foo>=1, !=1.5']
+
+    def test_splits_names(self):
+        assert pip._split_names('bottle,jinja2') == ['bottle', 'jinja2']
+        assert pip._split_names('Django>=1.8,<1.9, bottle') == ['Django>=1.8,<1.9', 'bottle']
+
+    def test_list_taken_as_is(self):
+        assert pip._split_names(['a>=1,<2', 'b']) == ['a>=1,<2', 'b']
+        assert pip._split_names(None) is None
+
+
+class TestRequirementSatisfied(object):
+
+    installed = {'django': '1.8.4', 'six': '1.10.0', 'foo-bar': '2.0rc1'}
+
+    def check(self, line):
+        return pip._requirement_satisfied(line, self.installed)
+
+    def test_plain_name(self):
+        assert self.check('six')
+        assert self.check('Foo_Bar')
+        assert not self.check('missing')
+
+    def test_pins(self):
+        assert self.check('Django==1.8.4')
+        assert self.check('six==1.10')
+        assert not self.check('six==1.9.0')
+        assert self.check('foo-bar==2.0rc1')
+
+    def test_ranges(self):
+        assert self.check('Django>=1.8,<1.9')
+        assert not self.check('Django>=1.9')
+        assert self.check('six!=1.9.0')
+        assert not self.check('six!=1.10.0')
+
+    def test_non_numeric_range_goes_to_pip(self):
+        assert not self.check('foo-bar>=1.0')
+
+    def test_line_options_ignored(self):
+        assert self.check('six==1.10.0 --hash=sha256:abcd')
+
+    def test_left_to_pip(self):
+        for line in ('Django[bcrypt]==1.8.4', 'six; python_version < "3"', 'six~=1.10',
+                     '-e git+https://example.com/six#egg=six', 'https://example.com/six.tar.gz',
+                     './six'):
+            assert not self.check(line)
+
+
+class TestReadRequirements(object):
+
+    def setup_method(self, method):
+        self.module = mock.MagicMock()
+        self.module.fail_json.side_effect = AnsibleFail()
+
+    def read(self, path):
+        options = []
+        reqs = []
+        pip._read_requirements(self.module, path, options, reqs)
+        return options, reqs
+
+    def test_flattens_includes(self, tmpdir):
+        tmpdir.mkdir('sub').join('base.txt').write('six==1.10.0\n-r ../requirements.txt\n')
+        tmpdir.join('requirements.txt').write(
+            '# comment\n'
+            '-i https://example.com/simple\n'
+            '-r sub/base.txt\n'
+            'Django>=1.8,<1.9  # trailing comment\n'
+            'foo==1.0 \\\n'
+            '    --hash=sha256:abcd\n'
+            '\n'
+            '-e git+https://example.com/bar#egg=bar\n')
+        options, reqs = self.read(str(tmpdir.join('requirements.txt')))
+        assert options == ['-i https://example.com/simple']
+        assert reqs[0] == 'six==1.10.0'
+        assert reqs[1] == 'Django>=1.8,<1.9'
+        assert reqs[2].split() == ['foo==1.0', '--hash=sha256:abcd']
+        assert reqs[3] == '-e git+https://example.com/bar#egg=bar'
+        assert len(reqs) == 4
+
+    def test_relative_paths_made_absolute(self, tmpdir):
+        tmpdir.join('requirements.txt').write(
+            '-c constraints.txt\n'
+            '--find-links ./wheels\n'
+            '-f=https://example.com/wheels\n'
+            '-r https://example.com/requirements.txt\n')
+        options, reqs = self.read(str(tmpdir.join('requirements.txt')))
+        assert options == ['-c %s' % tmpdir.join('constraints.txt'),
+                           '--find-links %s' % tmpdir.join('wheels'),
+                           '-f=https://example.com/wheels']
+        assert reqs == ['-r https://example.com/requirements.txt']
+
+    def test_missing_file(self, tmpdir):
+        pytest.raises(AnsibleFail, self.read, str(tmpdir.join('missing.txt')))
+
+
+class TestDiffRequirements(object):
+
+    def test_met_lines_become_constraints(self, tmpdir):
+        tmpdir.join('requirements.txt').write(
+            '-i https://example.com/simple\n'
+            'six==1.10.0 --hash=sha256:abcd\n'
+            'Django>=1.8,<1.9\n'
+            'needs-newer-six==2.0\n')
+        module = mock.MagicMock()
+        installed = {'six': '1.10.0', 'django': '1.8.4'}
+        options, unsatisfied, satisfied = pip._diff_requirements(module, str(tmpdir.join('requirements.txt')), installed)
+        assert options == ['-i https://example.com/simple']
+        assert unsatisfied == ['needs-newer-six==2.0']
+        assert satisfied == ['six==1.10.0', 'Django>=1.8,<1.9']
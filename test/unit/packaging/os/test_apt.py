@@ -0,0 +1,231 @@
+import imp
+import os
+
+import mock
+
+apt = imp.load_source('ansible_module_apt',
+                      os.path.join(os.path.dirname(__file__), '..', '..', '..', '..', 'packaging', 'os', 'apt.py'))
+
+DPKG_STATUS = '''\
+Package: libc6
+Status: install ok installed
+Architecture: amd64
+Version: 2.23-0ubuntu3
+Description: GNU C Library
+ Multi-Arch: same, in a continuation line
+
+Package: libc6
+Status: install ok installed
+Architecture: i386
+Version: 2.23-0ubuntu3
+
+Package: tzdata
+Status: hold ok installed
+Architecture: all
+Version: 2016d-0ubuntu0.16.04
+
+Package: nginx
+Status: deinstall ok config-files
+Architecture: amd64
+Version: 1.10.0-0ubuntu0.16.04.1
+
+Package: vim
+Status: install ok installed
+Architecture: amd64
+Version: 2:7.4.1689-3ubuntu1'''
+
+
+class FakePackage(object):
+
+    def __init__(self, fullname, has_versions=True):
+        self.fullname = fullname
+        self.has_versions = has_versions
+
+    def get_fullname(self, pretty=False):
+        return self.fullname
+
+
+def fake_cache(*names):
+    cache = mock.MagicMock()
+    cache._cache.packages = [FakePackage(name) for name in names] + [FakePackage('virtual-only', False)]
+    return cache
+
+
+def fake_apt_pkg(tmpdir):
+    apt_pkg = mock.MagicMock()
+    paths = {
+        'Dir::State::status': str(tmpdir.join('status')),
+        'Dir::Cache::pkgcache': str(tmpdir.join('pkgcache.bin')),
+    }
+    apt_pkg.config.find_file.side_effect = lambda key: paths[key]
+    apt_pkg.config.find.return_value = 'amd64'
+    return apt_pkg
+
+
+def with_apt_pkg(tmpdir, func, *args):
+    ''' calls func with apt_pkg reading its files from tmpdir '''
+    patchers = [mock.patch.object(apt, 'apt_pkg', fake_apt_pkg(tmpdir), create=True),
+                mock.patch.object(apt, 'APT_NAME_INDEX_PATH', str(tmpdir.join('names.json')))]
+    for patcher in patchers:
+        patcher.start()
+    try:
+        return func(*args)
+    finally:
+        for patcher in patchers:
+            patcher.stop()
+
+
+class TestPackageNameIndex(object):
+
+    def setup_method(self, method):
+        self.module = mock.MagicMock()
+        self.module.check_mode = False
+
+    def index(self, tmpdir, *names):
+        if not tmpdir.join('pkgcache.bin').check():
+            tmpdir.join('pkgcache.bin').write('cache')
+        return with_apt_pkg(tmpdir, apt.PackageNameIndex, self.module, fake_cache(*names))
+
+    def test_match(self, tmpdir):
+        index = self.index(tmpdir, 'python3', 'python', 'python-apt', 'perl', 'python:i386', 'apython')
+        assert index.match('python*', False) == ['python', 'python-apt', 'python3']
+        assert index.match('python*', True) == ['python', 'python-apt', 'python3', 'python:i386']
+        assert index.match('python-?pt', False) == ['python-apt']
+        assert index.match('*python', False) == ['apython', 'python']
+        assert index.match('ruby*', False) == []
+        assert index.match('virtual*', False) == []
+
+    def test_saved_and_loaded(self, tmpdir):
+        self.index(tmpdir, 'python', 'perl')
+        assert tmpdir.join('names.json').check()
+        # a later run answers from the file, not the cache
+        index = self.index(tmpdir)
+        assert index.names == ['perl', 'python']
+
+    def test_rebuilt_when_pkgcache_changes(self, tmpdir):
+        self.index(tmpdir, 'python', 'perl')
+        tmpdir.join('pkgcache.bin').write('a bigger cache')
+        index = self.index(tmpdir, 'ruby')
+        assert index.names == ['ruby']
+
+    def test_failed_save_leaves_no_temp_file(self, tmpdir):
+        # a non empty directory in the way of the rename
+        tmpdir.mkdir('names.json').join('keep').write('')
+        self.index(tmpdir, 'python')
+        assert sorted(os.listdir(str(tmpdir))) == ['names.json', 'pkgcache.bin']
+
+
+class TestDpkgStatus(object):
+
+    def setup_method(self, method):
+        self.module = mock.MagicMock()
+
+    def installed(self, tmpdir, packages):
+        tmpdir.join('status').write(DPKG_STATUS)
+        return with_apt_pkg(tmpdir, apt.installed_per_dpkg_status, self.module, packages)
+
+    def test_dpkg_installed(self, tmpdir):
+        tmpdir.join('status').write(DPKG_STATUS)
+        installed = with_apt_pkg(tmpdir, apt.dpkg_installed, set(['libc6', 'tzdata', 'nginx']))
+        assert installed == {
+            ('libc6', 'amd64'): '2.23-0ubuntu3',
+            ('libc6', 'i386'): '2.23-0ubuntu3',
+            ('tzdata', 'all'): '2016d-0ubuntu0.16.04',
+        }
+
+    def test_names(self, tmpdir):
+        assert self.installed(tmpdir, ['libc6', 'tzdata', 'vim'])
+        assert not self.installed(tmpdir, ['libc6', 'nginx'])
+        assert not self.installed(tmpdir, ['missing'])
+
+    def test_versions(self, tmpdir):
+        assert self.installed(tmpdir, ['vim=2:7.4.1689-3ubuntu1'])
+        assert not self.installed(tmpdir, ['vim=2:7.4.1689'])
+
+    def test_architectures(self, tmpdir):
+        assert self.installed(tmpdir, ['libc6:i386'])
+        assert self.installed(tmpdir, ['tzdata:all'])
+        assert not self.installed(tmpdir, ['vim:i386'])
+
+    def test_left_to_the_cache(self, tmpdir):
+        assert not self.installed(tmpdir, ['libc*'])
+        assert not self.installed(tmpdir, ['vim=2:7.4*'])
+        assert not self.installed(tmpdir, ['vim==2'])
+
+    def test_missing_status_file(self, tmpdir):
+        assert not with_apt_pkg(tmpdir, apt.installed_per_dpkg_status, self.module, ['vim'])
+
+
+class FakeCache(object):
+    ''' an apt.Cache that only knows which packages are marked '''
+
+    def __init__(self):
+        self.marks = set()
+
+    def __getitem__(self, name):
+        raise KeyError(name)
+
+    def clear(self):
+        self.marks.clear()
+
+
+class FakeDebPackage(object):
+
+    depends = {'/tmp/a.deb': ['liba', 'b'], '/tmp/b.deb': ['libb', 'liba']}
+
+    def __init__(self, filename, cache):
+        self.filename = filename
+        self.cache = cache
+        self.missing_deps = []
+        self.marks_seen = None
+
+    def __getitem__(self, field):
+        return dict(Package=os.path.basename(self.filename)[0], Version='1.0')[field]
+
+    def check(self):
+        self.marks_seen = set(self.cache.marks)
+        for dep in self.depends[self.filename]:
+            self.cache.marks.add(dep)
+            self.missing_deps.append(dep)
+        return True
+
+
+class TestInstallDeb(object):
+
+    def setup_method(self, method):
+        self.debs = []
+        self.marks_at_install = None
+        python_apt = mock.MagicMock()
+        python_apt.debfile.DebPackage.side_effect = self.deb_package
+        self.patchers = [mock.patch.object(apt, 'apt', python_apt, create=True),
+                         mock.patch.object(apt, 'install', self.install)]
+        for patcher in self.patchers:
+            patcher.start()
+
+    def teardown_method(self, method):
+        for patcher in self.patchers:
+            patcher.stop()
+
+    def deb_package(self, filename, cache):
+        deb = FakeDebPackage(filename, cache)
+        self.debs.append(deb)
+        return deb
+
+    def install(self, m, pkgspec, cache, install_recommends, dpkg_options):
+        self.marks_at_install = set(cache.marks)
+        self.deps = pkgspec
+        return True, dict(changed=True)
+
+    def test_checks_leave_no_marks(self):
+        cache = FakeCache()
+        module = mock.MagicMock()
+        module.check_mode = False
+        module.run_command.return_value = (0, '', '')
+        apt.install_deb(module, '/tmp/a.deb,/tmp/b.deb', cache, False, True, False, 'force-confdef')
+        # the second deb is checked against a cache without the marks of the first
+        assert [deb.marks_seen for deb in self.debs] == [set(), set()]
+        assert self.marks_at_install == set()
+        assert cache.marks == set()
+        # the debs themselves are no dependencies to install
+        assert self.deps == ['liba', 'libb']
+        assert module.run_command.call_args[0][0].endswith(' -i /tmp/a.deb /tmp/b.deb')
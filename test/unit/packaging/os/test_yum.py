@@ -0,0 +1,298 @@
+import imp
+import os
+import sys
+
+import mock
+
+# the yum and rpm bindings only exist on the hosts the module runs on
+patcher = mock.patch.dict(sys.modules, {'yum': mock.MagicMock(), 'rpm': mock.MagicMock()})
+patcher.start()
+try:
+    yum = imp.load_source('ansible_module_yum',
+                          os.path.join(os.path.dirname(__file__), '..', '..', '..', '..', 'packaging', 'os', 'yum.py'))
+finally:
+    patcher.stop()
+
+INSTALLED = [
+    'bash|0|4.2.46|19.el7|x86_64',
+    'python|0|2.7.5|39.el7|x86_64',
+    'python-libs|0|2.7.5|39.el7|x86_64',
+    'kernel|0|3.10.0|327.el7|x86_64',
+    'kernel|0|3.10.0|514.el7|x86_64',
+    'openssl|1|1.0.1e|51.el7|x86_64',
+]
+
+
+def packages(lines):
+    return [yum.QueriedPackage(line) for line in lines]
+
+
+def names(pkgs):
+    return sorted([po.format(yum.def_qf) for po in pkgs])
+
+
+class TestMatchSpecs(object):
+
+    def setup_method(self, method):
+        self.my = mock.MagicMock()
+        # like yum, the rpmdb hands out candidates and match_specs() sorts them to the specs
+        self.my.rpmdb.matchPackageNames.side_effect = lambda specs: (packages(INSTALLED), [], [])
+        self.cache = yum.YumCache(self.my)
+
+    def test_names(self):
+        matches = yum.match_specs(packages(INSTALLED), ['bash', 'kernel', 'python.x86_64'])
+        assert names(matches['bash']) == ['bash-4.2.46-19.el7.x86_64']
+        assert names(matches['kernel']) == ['kernel-3.10.0-327.el7.x86_64', 'kernel-3.10.0-514.el7.x86_64']
+        assert names(matches['python.x86_64']) == ['python-2.7.5-39.el7.x86_64']
+
+    def test_name_version(self):
+        matches = yum.match_specs(packages(INSTALLED), ['kernel-3.10.0-514.el7', 'bash-4.2.46', '1:openssl-1.0.1e-51.el7.x86_64',
+                                                        'openssl-1:1.0.1e-51.el7.x86_64', 'bash-4.2'])
+        assert names(matches['kernel-3.10.0-514.el7']) == ['kernel-3.10.0-514.el7.x86_64']
+        assert names(matches['bash-4.2.46']) == ['bash-4.2.46-19.el7.x86_64']
+        assert names(matches['1:openssl-1.0.1e-51.el7.x86_64']) == ['openssl-1.0.1e-51.el7.x86_64']
+        assert names(matches['openssl-1:1.0.1e-51.el7.x86_64']) == ['openssl-1.0.1e-51.el7.x86_64']
+        # versions are not prefixes
+        assert matches['bash-4.2'] == []
+
+    def test_globs(self):
+        matches = yum.match_specs(packages(INSTALLED), ['python*', 'kernel-3.10.0-3*', 'ba?h', '[bk]*.x86_64'])
+        assert names(matches['python*']) == ['python-2.7.5-39.el7.x86_64', 'python-libs-2.7.5-39.el7.x86_64']
+        assert names(matches['kernel-3.10.0-3*']) == ['kernel-3.10.0-327.el7.x86_64']
+        assert names(matches['ba?h']) == ['bash-4.2.46-19.el7.x86_64']
+        # a package is matched once, however many of its names fit
+        assert len(matches['[bk]*.x86_64']) == 3
+
+    def test_unmatched(self):
+        assert yum.match_specs(packages(INSTALLED), ['zsh', 'zsh*', 'bash-5']) == {'zsh': [], 'zsh*': [], 'bash-5': []}
+        assert yum.match_specs([], ['bash']) == {'bash': []}
+
+    def test_match_installed_once(self):
+        assert names(self.cache.match_installed(['bash', 'zsh'])['bash']) == ['bash-4.2.46-19.el7.x86_64']
+        result = self.cache.match_installed(['bash', 'zsh', 'python*'])
+        assert result['zsh'] == []
+        assert len(result['python*']) == 2
+        # only what was not asked before goes to the rpmdb
+        assert self.my.rpmdb.matchPackageNames.call_args_list == [mock.call(['bash', 'zsh']), mock.call(['python*'])]
+
+    def test_provides(self):
+        self.my.returnInstalledPackagesByDep.side_effect = lambda spec: packages(INSTALLED[1:2])
+        yum.yum_caches.clear()
+        patcher = mock.patch.object(yum, 'yum_base', return_value=self.my)
+        patcher.start()
+        try:
+            module = mock.MagicMock()
+            # no package is called that, so is_installed() asks what provides it
+            assert yum.is_installed(module, None, '/usr/bin/python', None) == ['python-2.7.5-39.el7.x86_64']
+            assert yum.is_installed(module, None, '/usr/bin/python', None) == ['python-2.7.5-39.el7.x86_64']
+            assert yum.is_installed(module, None, 'python(abi)', None, is_pkg=True) == []
+            self.my.returnInstalledPackagesByDep.assert_called_once_with('/usr/bin/python')
+        finally:
+            patcher.stop()
+            yum.yum_caches.clear()
+
+
+class FakeRpm(object):
+    ''' answers run_command() the way rpm -q and repoquery print '''
+
+    def __init__(self):
+        self.calls = []
+        self.installed = {'bash': ['bash-4.2.46-19.el7.x86_64'],
+                          'kernel': ['kernel-3.10.0-327.el7.x86_64', 'kernel-3.10.0-514.el7.x86_64']}
+        self.provides = {'/bin/sh': ['bash-4.2.46-19.el7.x86_64']}
+        self.available = ['zsh|0|5.0.2|25.el7|x86_64', 'zsh-html|0|5.0.2|25.el7|x86_64']
+
+    def __call__(self, cmd, environ_update=None):
+        self.calls.append(cmd)
+        if cmd[0] == 'repoquery':
+            return 0, '\n'.join(self.available) + '\n', ''
+        whatprovides = '--whatprovides' in cmd
+        rc = 0
+        out = []
+        for arg in cmd[4 + int(whatprovides):]:
+            if whatprovides:
+                lines = self.provides.get(arg)
+                missing = 'no package provides %s' % arg
+            else:
+                lines = self.installed.get(arg)
+                missing = 'package %s is not installed' % arg
+            if lines:
+                out.extend(lines)
+            else:
+                out.append(missing)
+                rc = 1
+        return rc, '\n'.join(out) + '\n', ''
+
+
+class TestBatchedQueries(object):
+
+    def setup_method(self, method):
+        self.module = mock.MagicMock()
+        self.module.get_bin_path.return_value = '/bin/rpm'
+        self.rpm = self.module.run_command.side_effect = FakeRpm()
+        yum.rpm_answers.clear()
+        yum.repoquery_answers.clear()
+
+    def test_not_installed_mid_batch(self):
+        result = yum.rpm_query(self.module, ['bash', 'nonexistent', 'kernel'])
+        assert result['bash'] == ['bash-4.2.46-19.el7.x86_64']
+        assert result['nonexistent'] == []
+        assert len(result['kernel']) == 2
+        assert len(self.rpm.calls) == 1
+        assert self.rpm.calls[0][4:] == ['bash', yum.RPM_SEPARATOR + '-0', 'nonexistent', yum.RPM_SEPARATOR + '-1',
+                                         'kernel', yum.RPM_SEPARATOR + '-2']
+
+    def test_multiple_lines_for_one_spec(self):
+        result = yum.rpm_query(self.module, ['kernel', 'bash'])
+        assert result['kernel'] == ['kernel-3.10.0-327.el7.x86_64', 'kernel-3.10.0-514.el7.x86_64']
+        assert result['bash'] == ['bash-4.2.46-19.el7.x86_64']
+
+    def test_answers_kept(self):
+        yum.rpm_query(self.module, ['bash', 'nonexistent'])
+        yum.rpm_query(self.module, ['bash', 'kernel', 'nonexistent'])
+        assert self.rpm.calls[1][4:] == ['kernel', yum.RPM_SEPARATOR + '-0']
+        assert yum.is_installed(self.module, ['repoquery'], 'kernel', None, is_pkg=True) == self.rpm.installed['kernel']
+        assert len(self.rpm.calls) == 2
+
+    def test_empty_batch(self):
+        assert yum.rpm_query(self.module, []) == {}
+        assert yum.repoquery_names(self.module, ['repoquery'], [], [], []) == {}
+        yum.prefetch_installed(self.module, ['repoquery'], [], None, [], [])
+        yum.prefetch_provides(self.module, ['repoquery'], [], [], [])
+        assert self.rpm.calls == []
+
+    def test_unexpected_output(self):
+        self.module.fail_json.side_effect = SystemExit
+        self.module.run_command.side_effect = lambda cmd, environ_update=None: (0, 'bash-4.2.46-19.el7.x86_64\n', '')
+        try:
+            yum.rpm_query(self.module, ['bash', 'kernel'])
+        except SystemExit:
+            pass
+        assert self.module.fail_json.call_args[1]['msg'].startswith('Unexpected output from rpm')
+
+    def test_prefetch_installed(self):
+        yum.prefetch_installed(self.module, ['repoquery'], ['bash', '/bin/sh', 'nonexistent'], None, [], [])
+        # what is not a package name is looked up by what provides it, in a second process
+        assert len(self.rpm.calls) == 2
+        assert self.rpm.calls[1][4:] == ['--whatprovides', '/bin/sh', yum.RPM_SEPARATOR + '-0', 'nonexistent',
+                                         yum.RPM_SEPARATOR + '-1']
+        assert yum.is_installed(self.module, ['repoquery'], '/bin/sh', None) == ['bash-4.2.46-19.el7.x86_64']
+        assert yum.is_installed(self.module, ['repoquery'], 'nonexistent', None) == []
+        assert len(self.rpm.calls) == 2
+
+    def test_repoquery_names(self):
+        yum.prefetch_provides(self.module, ['repoquery'], ['zsh', 'zsh*', 'vim'], [], [])
+        result = yum.repoquery_names(self.module, ['repoquery'], ['zsh', 'zsh*', 'vim'], [], [])
+        assert result['zsh'] == ['zsh-5.0.2-25.el7.x86_64']
+        assert sorted(result['zsh*']) == ['zsh-5.0.2-25.el7.x86_64', 'zsh-html-5.0.2-25.el7.x86_64']
+        assert result['vim'] == []
+        assert len(self.rpm.calls) == 1
+
+    def test_forget_installed(self):
+        assert yum.rpm_query(self.module, ['zsh'])['zsh'] == []
+        yum.repoquery_names(self.module, ['repoquery'], ['zsh'], [], [])
+        # the transaction installs zsh
+        self.rpm.installed['zsh'] = ['zsh-5.0.2-25.el7.x86_64']
+        yum.forget_installed()
+        assert yum.rpm_query(self.module, ['zsh'])['zsh'] == ['zsh-5.0.2-25.el7.x86_64']
+        # what the repos have is still known
+        yum.repoquery_names(self.module, ['repoquery'], ['zsh'], [], [])
+        assert len(self.rpm.calls) == 3
+
+
+class TestInstalledSnapshot(object):
+
+    def setup_method(self, method):
+        self.module = mock.MagicMock()
+        self.module.check_mode = False
+        self.version = [1467000000.0, 4096]
+        self.built = []
+        self.patchers = [mock.patch.object(yum, 'rpmdb_version', lambda: self.version),
+                         mock.patch.object(yum.InstalledSnapshot, 'build', self.build)]
+        for patcher in self.patchers:
+            patcher.start()
+
+    def teardown_method(self, method):
+        for patcher in self.patchers:
+            patcher.stop()
+
+    def build(self, version):
+        self.built.append(version)
+        packages = [line.split('|') for line in INSTALLED]
+        return dict(version=1, rpmdb=version, packages=packages, provides=['/bin/sh', 'python(abi)'])
+
+    def snapshot(self, cachedir):
+        snapshot = yum.InstalledSnapshot(self.module, str(cachedir))
+        assert snapshot.installed('bash') == ['bash-4.2.46-19.el7.x86_64']
+        assert snapshot.provided('python(abi)')
+        return snapshot
+
+    def saved(self, cachedir):
+        return yum.json.load(open(str(cachedir.join('ansible-installed.json'))))
+
+    def test_built_once(self, tmpdir):
+        self.snapshot(tmpdir)
+        self.snapshot(tmpdir)
+        assert self.built == [self.version]
+        assert self.saved(tmpdir)['rpmdb'] == self.version
+
+    def test_stale_key(self, tmpdir):
+        self.snapshot(tmpdir)
+        # a transaction changed the rpmdb since
+        self.version = [1467000100.0, 8192]
+        self.snapshot(tmpdir)
+        assert len(self.built) == 2
+        assert self.saved(tmpdir)['rpmdb'] == self.version
+
+    def test_corrupt(self, tmpdir):
+        for content in ('{"version": 1, "rpm', '[1, 2]', 'null', '{"version": 2}'):
+            tmpdir.join('ansible-installed.json').write(content)
+            self.snapshot(tmpdir)
+            assert self.saved(tmpdir)['version'] == 1
+        assert len(self.built) == 4
+
+    def test_unreadable(self, tmpdir):
+        # whatever the user, a directory cannot be read as the snapshot or replaced by one
+        tmpdir.join('ansible-installed.json').mkdir()
+        self.snapshot(tmpdir)
+        self.snapshot(tmpdir)
+        assert len(self.built) == 2
+
+    def test_unwritable_cachedir(self, tmpdir):
+        self.snapshot(tmpdir.join('nonexistent'))
+        assert not tmpdir.join('nonexistent').check()
+
+    def test_check_mode(self, tmpdir):
+        self.module.check_mode = True
+        self.snapshot(tmpdir)
+        assert tmpdir.listdir() == []
+
+    def test_no_rpmdb(self, tmpdir):
+        # without a version to compare with, nothing on disk can be trusted
+        self.version = None
+        self.snapshot(tmpdir)
+        self.snapshot(tmpdir)
+        assert len(self.built) == 2
+        assert tmpdir.listdir() == []
+
+    def test_answers(self, tmpdir):
+        snapshot = self.snapshot(tmpdir)
+        assert snapshot.answers('kernel-3.10.0-514.el7')
+        for spec in ('kernel*', 'bash >= 4', '/bin/sh'):
+            assert not snapshot.answers(spec)
+        assert snapshot.installed('kernel-3.10.0-514.el7') == ['kernel-3.10.0-514.el7.x86_64']
+        assert snapshot.installed('zsh') == []
+        assert not snapshot.provided('/usr/bin/zsh')
+
+    def test_installed_snapshot_without_cachedir(self, tmpdir):
+        tmpdir.join('file').write('')
+        my = mock.MagicMock()
+        my.conf.cachedir = str(tmpdir.join('file', 'cache'))
+        yum.yum_caches.clear()
+        yum.yum_caches[(None, (), ())] = yum.YumCache(my)
+        try:
+            assert yum.installed_snapshot(self.module, None) is None
+            my.conf.cachedir = str(tmpdir.join('cache'))
+            assert yum.installed_snapshot(self.module, None).installed('bash')
+        finally:
+            yum.yum_caches.clear()